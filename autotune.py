@@ -0,0 +1,492 @@
+import argparse
+import json
+import os
+import platform
+import time
+from contextlib import redirect_stdout
+import numpy as np
+from utils import color_codes, time_to_string, default_device
+from profiling import StageTimer
+
+
+def parse_inputs():
+    parser = argparse.ArgumentParser(
+        description='Throughput autotuner for the training and testing of '
+                    'the tree detection network.'
+    )
+    parser.add_argument(
+        '-f', '--filters',
+        dest='filters', type=int, nargs='+', default=[32, 64, 128, 256],
+        help='Filters of the Unet'
+    )
+    parser.add_argument(
+        '-i', '--inputs',
+        dest='n_inputs', type=int, default=4,
+        help='Number of input channels'
+    )
+    parser.add_argument(
+        '-s', '--image-shape',
+        dest='image_shape', type=int, nargs=2, default=[1024, 1024],
+        help='Shape of the (downsampled) images used for the benchmarks'
+    )
+    parser.add_argument(
+        '-t', '--patch-size',
+        dest='patch_size', type=int, default=64,
+        help='Training patch size'
+    )
+    parser.add_argument(
+        '-B', '--batch-sizes',
+        dest='batch_sizes', type=int, nargs='+',
+        default=[8, 16, 32, 64, 128],
+        help='Candidate batch sizes (training)'
+    )
+    parser.add_argument(
+        '-w', '--workers',
+        dest='workers', type=int, nargs='+', default=[0, 1, 2, 4],
+        help='Candidate numbers of DataLoader workers (training)'
+    )
+    parser.add_argument(
+        '-T', '--tiles',
+        dest='tiles', type=int, nargs='+', default=[128, 256, 512, 0],
+        help='Candidate tile sizes (testing, 0 for the whole image)'
+    )
+    parser.add_argument(
+        '--threads',
+        dest='threads', type=int, nargs='+', default=None,
+        help='Candidate numbers of torch threads. By default, 1, half and '
+             'all the CPUs'
+    )
+    parser.add_argument(
+        '--steps',
+        dest='steps', type=int, default=10,
+        help='Number of timed training batches per candidate'
+    )
+    parser.add_argument(
+        '-r', '--repeats',
+        dest='repeats', type=int, default=3,
+        help='Number of timed runs per candidate (the median is used)'
+    )
+    parser.add_argument(
+        '-m', '--memory',
+        dest='memory', type=float, default=None,
+        help='Memory budget in MB for the memory used by a candidate on top '
+             'of the model and the data (device memory on cuda, resident '
+             'memory otherwise). By default, 80%% of the available memory'
+    )
+    parser.add_argument(
+        '-o', '--output',
+        dest='output', default=None,
+        help='JSON file to store the optimal configuration (the entries '
+             'of other machines or models are kept)'
+    )
+
+    options = vars(parser.parse_args())
+
+    return options
+
+
+"""
+Persistence
+"""
+
+
+def tuning_key(filters, n_inputs, patch_size, device=None):
+    """
+    Function to build the key of a tuning entry. Optimal configurations
+    depend on the machine, the device, the network and the patch size.
+    :param filters: Filters of the Unet.
+    :param n_inputs: Number of input channels.
+    :param patch_size: Training patch size.
+    :param device: Torch device (the default device if None).
+    :return: The key (string).
+    """
+    import torch
+    if device is None:
+        device = default_device()
+    if device.type == 'cuda':
+        device_name = torch.cuda.get_device_name(device)
+    else:
+        device_name = '{:} ({:d} CPUs)'.format(
+            platform.processor() or platform.machine(), os.cpu_count()
+        )
+    return '{:}/{:}/torch {:}/unet {:} in {:d}/patch {:d}'.format(
+        platform.node(), device_name, torch.__version__,
+        ','.join(str(f) for f in filters), n_inputs, patch_size
+    )
+
+
+def save_tuning(filename, key, tuning):
+    """
+    Function to store a tuning entry on a JSON file (other entries are
+    kept).
+    :param filename: Name of the JSON file.
+    :param key: Key of the entry (see tuning_key).
+    :param tuning: Dictionary with the optimal training and testing
+     configurations.
+    :return: None.
+    """
+    entries = {}
+    if os.path.isfile(filename):
+        with open(filename) as f:
+            entries = json.load(f)
+    entries[key] = dict(tuning, date=time.strftime('%Y-%m-%dT%H:%M:%S'))
+    with open(filename, 'w') as f:
+        json.dump(entries, f, indent=1)
+
+
+def load_tuning(filename, key):
+    """
+    Function to load a tuning entry.
+    :param filename: Name of the JSON file.
+    :param key: Key of the entry (see tuning_key).
+    :return: The tuning dictionary or None if there is no entry (or file).
+    """
+    try:
+        with open(filename) as f:
+            return json.load(f).get(key)
+    except (IOError, ValueError):
+        return None
+
+
+"""
+Benchmarks
+"""
+
+
+def available_memory(device):
+    """
+    Function to get the memory that can be used for the candidates.
+    :param device: Torch device.
+    :return: The free device memory (cuda) or the available system memory
+     in bytes.
+    """
+    import torch
+    if device.type == 'cuda':
+        free, _ = torch.cuda.mem_get_info(device)
+        return free
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def random_case(shape, n_inputs, density=1e-3, seed=42):
+    """
+    Function to create a random (normalised) case with sparse tree tops.
+    Throughput does not depend on the contents, only on the sizes.
+    :param shape: Shape of the image (rows, columns).
+    :param n_inputs: Number of input channels.
+    :param density: Fraction of positive pixels.
+    :param seed: Random seed.
+    :return: The inputs (channels, rows, columns) and the labels.
+    """
+    rng = np.random.default_rng(seed)
+    x = rng.normal(size=(n_inputs,) + tuple(shape)).astype(np.float32)
+    y = (rng.random(shape) < density).astype(np.uint8)
+    return x, y
+
+
+def _measure(f, device, timer, name, repeats=1, **info):
+    """
+    Function to time a candidate and measure its peak memory. The memory
+    is the increase over the memory in use before the candidate (the model,
+    the data and the interpreter are already loaded), so it can be compared
+    with the available memory.
+    :param f: Function to measure.
+    :param device: Torch device.
+    :param timer: StageTimer used to sample the resident memory.
+    :param name: Name of the stage.
+    :param repeats: Number of timed calls.
+    :param info: Extra information for the timer record.
+    :return: The median wall time, the peak memory increase (bytes) and the
+     error (None if the candidate finished).
+    """
+    import torch
+    cuda = device.type == 'cuda'
+    if cuda:
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(device)
+        baseline = torch.cuda.memory_allocated(device)
+    error = None
+    walls = []
+    with timer.stage(name, **info) as record:
+        try:
+            for _ in range(repeats):
+                t_in = time.perf_counter()
+                with open(os.devnull, 'w') as null, redirect_stdout(null):
+                    f()
+                if cuda:
+                    torch.cuda.synchronize(device)
+                walls.append(time.perf_counter() - t_in)
+        except RuntimeError as e:
+            if 'out of memory' not in str(e):
+                raise
+            error = 'oom'
+    if cuda:
+        peak = torch.cuda.max_memory_allocated(device) - baseline
+    else:
+        peak = record['peak_rss'] - record['rss_start']
+    wall = float(np.median(walls)) if walls else 0.
+    return wall, peak, error
+
+
+def tune_training(
+        net, x, y, patch_size, batch_sizes, workers, threads, steps=10,
+        budget=None, timer=None, repeats=3
+):
+    """
+    Function to benchmark the training throughput (samples per second of
+    BaseModel.mini_batch_loop, which includes data loading, forward,
+    backward and optimiser steps) for each combination of batch size,
+    DataLoader workers and torch threads. Batch sizes are tested in
+    increasing order and, once a batch size goes over the memory budget,
+    the larger ones are skipped.
+    :param net: Network to train.
+    :param x: Inputs of the training case (channels, rows, columns).
+    :param y: Labels of the training case.
+    :param patch_size: Training patch size.
+    :param batch_sizes: Candidate batch sizes.
+    :param workers: Candidate numbers of DataLoader workers.
+    :param threads: Candidate numbers of torch threads.
+    :param steps: Number of timed batches per candidate.
+    :param budget: Memory budget in bytes (None for no limit).
+    :param timer: StageTimer for the memory samples.
+    :param repeats: Number of timed epochs per candidate (the median
+     throughput is used).
+    :return: List of dictionaries with the results per candidate.
+    """
+    import torch
+    from torch.utils.data import DataLoader, Subset
+    from datasets import Cropping2DDataset
+    if timer is None:
+        timer = StageTimer()
+    dataset = Cropping2DDataset(
+        [x], [y], patch_size=(patch_size,) * 2,
+        overlap=(patch_size // 2,) * 2, filtered=True
+    )
+    rng = np.random.default_rng(42)
+    n_threads = torch.get_num_threads()
+    net.train()
+    results = []
+    for t in threads:
+        torch.set_num_threads(t)
+        for w in workers:
+            for batch_size in sorted(batch_sizes):
+                r = {
+                    'batch_size': batch_size, 'num_workers': w, 'threads': t,
+                    'samples_s': 0., 'peak_mb': 0., 'status': 'ok'
+                }
+                results.append(r)
+                over = [
+                    o for o in results if o['status'] != 'ok' and
+                    o['num_workers'] == w and o['threads'] == t
+                ]
+                if over:
+                    r['status'] = 'skipped'
+                    continue
+                n_samples = batch_size * steps
+                indices = rng.choice(
+                    len(dataset), n_samples, replace=len(dataset) < n_samples
+                )
+                warmup = DataLoader(
+                    Subset(dataset, indices[:batch_size]), batch_size
+                )
+                loader = DataLoader(
+                    Subset(dataset, indices), batch_size, num_workers=w
+                )
+
+                times = []
+
+                def train_loop():
+                    # The warmup batch is only run before the first epoch.
+                    if not times:
+                        net.mini_batch_loop(warmup)
+                    t_in = time.perf_counter()
+                    net.mini_batch_loop(loader)
+                    times.append(time.perf_counter() - t_in)
+
+                _, peak, error = _measure(
+                    train_loop, net.device, timer, 'train', repeats,
+                    batch_size=batch_size, num_workers=w, threads=t
+                )
+                r['peak_mb'] = peak / 2 ** 20
+                if error is not None:
+                    r['status'] = error
+                else:
+                    r['samples_s'] = n_samples / float(np.median(times))
+                    if budget is not None and peak > budget:
+                        r['status'] = 'over budget'
+    torch.set_num_threads(n_threads)
+    return results
+
+
+def tune_testing(
+        net, x, tiles, threads, budget=None, timer=None, repeats=3
+):
+    """
+    Function to benchmark the testing throughput (pixels per second of
+    Unet2D.test) for each combination of tile size and torch threads.
+    :param net: Network to test.
+    :param x: Inputs of the test case (channels, rows, columns).
+    :param tiles: Candidate tile sizes (None or 0 for the whole image).
+    :param threads: Candidate numbers of torch threads.
+    :param budget: Memory budget in bytes (None for no limit).
+    :param timer: StageTimer for the memory samples.
+    :param repeats: Number of timed runs per candidate (the median time is
+     used).
+    :return: List of dictionaries with the results per candidate.
+    """
+    import torch
+    if timer is None:
+        timer = StageTimer()
+    n_threads = torch.get_num_threads()
+    n_pixels = int(np.prod(x.shape[1:]))
+    tiles = [
+        tile if tile else None for tile in tiles
+        if not tile or tile <= min(x.shape[1:])
+    ]
+    results = []
+    for t in threads:
+        torch.set_num_threads(t)
+        # Warmup (first calls allocate the buffers).
+        with open(os.devnull, 'w') as null, redirect_stdout(null):
+            net.test([x[:, :128, :128]], patch_size=None, verbose=False)
+        for tile in tiles:
+            r = {
+                'tile': tile, 'threads': t, 'pixels_s': 0., 'peak_mb': 0.,
+                'status': 'ok'
+            }
+            wall, peak, error = _measure(
+                lambda: net.test([x], patch_size=tile, verbose=False),
+                net.device, timer, 'test', repeats, tile=tile, threads=t
+            )
+            r['peak_mb'] = peak / 2 ** 20
+            if error is not None:
+                r['status'] = error
+            else:
+                r['pixels_s'] = n_pixels / wall
+                if budget is not None and peak > budget:
+                    r['status'] = 'over budget'
+            results.append(r)
+    torch.set_num_threads(n_threads)
+    return results
+
+
+def best_candidate(results, metric):
+    """
+    Function to get the candidate with the highest throughput within the
+    memory budget.
+    :param results: List of results.
+    :param metric: Name of the throughput value.
+    :return: The best result (or None if no candidate was valid).
+    """
+    valid = [r for r in results if r['status'] == 'ok']
+    return max(valid, key=lambda r: r[metric]) if valid else None
+
+
+def results_table(results, columns):
+    """
+    Function to format a list of results as a text table.
+    :param results: List of results.
+    :param columns: Names of the columns.
+    :return: The table as a string.
+    """
+    cells = [
+        [
+            '{:.4g}'.format(r[k]) if isinstance(r[k], float) else str(r[k])
+            for k in columns
+        ] for r in results
+    ]
+    widths = [
+        max([len(k)] + [len(row[i]) for row in cells])
+        for i, k in enumerate(columns)
+    ]
+    lines = [' | '.join(k.rjust(w) for k, w in zip(columns, widths))]
+    lines.append('-' * len(lines[0]))
+    for row in cells:
+        lines.append(' | '.join(v.rjust(w) for v, w in zip(row, widths)))
+    return '\n'.join(lines)
+
+
+def main():
+    # Init
+    options = parse_inputs()
+    c = color_codes()
+    from models import Unet2D
+    device = default_device()
+    timer = StageTimer()
+    threads = options['threads']
+    if threads is None:
+        n_cpus = os.cpu_count()
+        threads = sorted({1, max(n_cpus // 2, 1), n_cpus})
+    budget = options['memory']
+    if budget is None:
+        budget = 0.8 * available_memory(device)
+    else:
+        budget *= 2 ** 20
+    x, y = random_case(options['image_shape'], options['n_inputs'])
+    net = Unet2D(options['filters'], n_inputs=options['n_inputs'])
+    t_start = time.time()
+
+    print(
+        '{:}[{:}]{:} Training candidates (budget {:.0f} MB){:}'.format(
+            c['c'], time.strftime("%H:%M:%S"), c['g'], budget / 2 ** 20,
+            c['nc']
+        )
+    )
+    train_results = tune_training(
+        net, x, y, options['patch_size'], options['batch_sizes'],
+        options['workers'], threads, options['steps'], budget, timer,
+        options['repeats']
+    )
+    print(results_table(
+        train_results,
+        ['batch_size', 'num_workers', 'threads', 'samples_s', 'peak_mb',
+         'status']
+    ))
+
+    print(
+        '{:}[{:}]{:} Testing candidates{:}'.format(
+            c['c'], time.strftime("%H:%M:%S"), c['g'], c['nc']
+        )
+    )
+    test_results = tune_testing(
+        net, x, options['tiles'], threads, budget, timer, options['repeats']
+    )
+    print(results_table(
+        test_results, ['tile', 'threads', 'pixels_s', 'peak_mb', 'status']
+    ))
+    timer.close()
+
+    best_train = best_candidate(train_results, 'samples_s')
+    best_test = best_candidate(test_results, 'pixels_s')
+    tuning = {
+        'train': None if best_train is None else {
+            k: best_train[k] for k in ['batch_size', 'num_workers', 'threads']
+        },
+        'test': None if best_test is None else {
+            k: best_test[k] for k in ['tile', 'threads']
+        },
+    }
+    print(
+        '{:}Autotuning finished{:} ({:})'.format(
+            c['r'], c['nc'], time_to_string(time.time() - t_start)
+        )
+    )
+    print('Training: {:}'.format(tuning['train']))
+    print('Testing: {:}'.format(tuning['test']))
+    if options['output'] is not None:
+        key = tuning_key(
+            options['filters'], options['n_inputs'], options['patch_size'],
+            device
+        )
+        save_tuning(options['output'], key, tuning)
+        print('{:}Stored as{:} {:}'.format(c['b'], c['nc'], key))
+
+
+if __name__ == '__main__':
+    main()
@@ -6,15 +6,17 @@ import torch
 from torch import nn
 import torch.nn.functional as F
 from layers import AttentionGate2D, DownsampledMultiheadAttention2D
-from utils import time_to_string
+from utils import time_to_string, default_device
 
 
-def compute_filters(n_inputs, conv_filters):
+def compute_filters(n_inputs, conv_filters, skip_mult=1):
     conv_in = [n_inputs] + conv_filters[:-2]
     conv_out = conv_filters[:-1]
     down_out = conv_filters[-2::-1]
     up_out = conv_filters[:0:-1]
-    deconv_in = list(map(sum, zip(down_out, up_out)))
+    deconv_in = [
+        f_down * skip_mult + f_up for f_down, f_up in zip(down_out, up_out)
+    ]
     deconv_out = down_out
     return conv_in, conv_out, deconv_in, deconv_out
 
@@ -64,6 +66,7 @@ class BaseModel(nn.Module):
         self.test_loader = None
         self.log_file = None
         self.batch_file = None
+        self.profiler = None
 
     def forward(self, *inputs):
         """
@@ -97,21 +100,30 @@ class BaseModel(nn.Module):
         losses = list()
         mid_losses = list()
         n_batches = len(data)
+        if self.profiler is not None:
+            self.profiler.start_loop(
+                epoch=self.epoch, training=self.training,
+                loader='train' if data is self.train_loader else 'val'
+            )
         for batch_i, (x, y) in enumerate(data):
+            self.profile_mark('data')
             # In case we are training the the gradient to zero.
             if self.training:
                 self.optimizer_alg.zero_grad()
 
-            # First, we do a forward pass through the network.
+            # First, we move the data to the device and we do a forward
+            # pass through the network.
             if isinstance(x, list) or isinstance(x, tuple):
                 x_cuda = tuple(x_i.to(self.device) for x_i in x)
-                pred_labels = self(*x_cuda)
             else:
-                pred_labels = self(x.to(self.device))
+                x_cuda = (x.to(self.device),)
             if isinstance(y, list) or isinstance(y, tuple):
                 y_cuda = tuple(y_i.to(self.device) for y_i in y)
             else:
                 y_cuda = y.to(self.device)
+            self.profile_mark('h2d')
+            pred_labels = self(*x_cuda)
+            self.profile_mark('forward')
 
             # After that, we can compute the relevant losses.
             if train:
@@ -121,10 +133,13 @@ class BaseModel(nn.Module):
                     for l_f in self.train_functions
                 ]
                 batch_loss = sum(batch_losses)
+                self.profile_mark('loss')
                 if self.training:
                     batch_loss.backward()
+                    self.profile_mark('backward')
                     self.optimizer_alg.step()
                     self.batch_update(batch_i, len(data))
+                    self.profile_mark('step')
 
             else:
                 # Validation losses (applied to the validation data)
@@ -137,6 +152,7 @@ class BaseModel(nn.Module):
                     for l_f, l in zip(self.val_functions, batch_losses)
                 ])
                 mid_losses.append([loss.tolist() for loss in batch_losses])
+                self.profile_mark('loss')
 
             # It's important to compute the global loss in both cases.
             loss_value = batch_loss.tolist()
@@ -149,11 +165,17 @@ class BaseModel(nn.Module):
             self.print_progress(
                 batch_i, n_batches, loss_value, np.mean(losses)
             )
+            if self.profiler is not None:
+                self.profiler.step()
+
+        if self.profiler is not None:
+            self.profiler.end_loop()
 
         # Mean loss of the global loss (we don't need the loss for each batch).
         mean_loss = np.mean(losses)
-        torch.cuda.empty_cache()
-        torch.cuda.ipc_collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+            torch.cuda.ipc_collect()
 
         if train:
             return mean_loss
@@ -171,13 +193,28 @@ class BaseModel(nn.Module):
             epochs=100,
             patience=20,
             log_file=None,
-            verbose=True
+            verbose=True,
+            profiler=None
     ):
+        """
+        Method to train the network with early stopping.
+        :param train_loader: Dataloader for training.
+        :param val_loader: Dataloader for validation.
+        :param test_loader: Dataloader for testing (unused).
+        :param epochs: Maximum number of epochs.
+        :param patience: Number of epochs without improvement before
+         stopping.
+        :param log_file: CSV writer for the losses per epoch.
+        :param verbose: Whether to print the progress.
+        :param profiler: StepProfiler to time each phase of the batches.
+        :return: None.
+        """
         # Init
         self.train_loader = train_loader
         self.val_loader = val_loader
         self.test_loader = test_loader
         self.log_file = log_file
+        self.profiler = profiler
         best_e = 0
         l_names = ['train', ' val '] + [
             '{:^6s}'.format(l_f['name'][:6])
@@ -350,6 +387,16 @@ class BaseModel(nn.Module):
         else:
             return loss, mid_losses
 
+    def profile_mark(self, phase):
+        """
+        Method to close a phase of the current batch on the profiler (if
+        there is one).
+        :param phase: Name of the phase.
+        :return: None.
+        """
+        if self.profiler is not None:
+            self.profiler.mark(phase)
+
     def epoch_update(self, epochs):
         """
         Callback function to update something on the model after the epoch
@@ -527,9 +574,8 @@ class Autoencoder(BaseModel):
             norm=None,
             activation=None,
             block=None,
-            device=torch.device(
-                "cuda:0" if torch.cuda.is_available() else "cpu"
-            ),
+            skip_mult=1,
+            device=None,
     ):
         """
         Constructor of the class. It's heavily parameterisable to allow for
@@ -546,10 +592,15 @@ class Autoencoder(BaseModel):
         :param block: Main block. It has to be a pointer to a valid block from
          this python file (otherwise it will fail when trying to create a
          partial of it).
+        :param skip_mult: Multiplier for the channels of the skip connections
+         on the up path (for subclasses that transform the skip connections
+         before concatenating them).
         :param device: Device where the model is stored (default is the first
          cuda device).
         """
         super().__init__()
+        if device is None:
+            device = default_device()
         # Init
         if norm is None:
             norm = partial(lambda ch_in: nn.Sequential())
@@ -562,7 +613,7 @@ class Autoencoder(BaseModel):
         self.filters = conv_filters
 
         conv_in, conv_out, deconv_in, deconv_out = compute_filters(
-            n_inputs, conv_filters
+            n_inputs, conv_filters, skip_mult
         )
 
         # Down path
@@ -637,9 +688,7 @@ class AttentionAutoencoder(Autoencoder):
             block=None,
             attention=32,
             att_regions=4,
-            device=torch.device(
-                "cuda:0" if torch.cuda.is_available() else "cpu"
-            ),
+            device=None,
     ):
         """
         Constructor of the class. It's heavily parameterisable to allow for
@@ -664,9 +713,12 @@ class AttentionAutoencoder(Autoencoder):
         :param device: Device where the model is stored (default is the first
          cuda device).
         """
+        # With multiple regions, each gate returns one gated copy of the skip
+        # connection per region, so the up path needs more input channels.
         super().__init__(
             conv_filters=conv_filters, n_inputs=n_inputs, kernel=kernel,
-            norm=norm, activation=activation, block=block, device=device
+            norm=norm, activation=activation, block=block,
+            skip_mult=att_regions, device=device
         )
         # Init
         conv_in, conv_out, deconv_in, deconv_out = compute_filters(
@@ -730,9 +782,7 @@ class TransAutoencoder(BaseModel):
             heads=8,
             downsampling=2,
             att_regions=4,
-            device=torch.device(
-                "cuda:0" if torch.cuda.is_available() else "cpu"
-            ),
+            device=None,
     ):
         """
         Constructor of the class. It's heavily parameterisable to allow for
@@ -767,6 +817,8 @@ class TransAutoencoder(BaseModel):
          cuda device).
         """
         super().__init__()
+        if device is None:
+            device = default_device()
         # Init
         self.downsampling = downsampling
         if norm is None:
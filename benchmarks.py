@@ -0,0 +1,699 @@
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import cv2
+from multiprocessing import get_context
+import numpy as np
+import torch
+from torch.nn import functional as F
+from utils import color_codes, time_to_string, remove_small_regions
+from utils import default_device
+from utils import imread_reduced
+from utils import list_from_mask, peaks_from_probability
+from criteria import normalised_xcor, gradient
+from datasets import (
+    get_slices, Cropping2DDataset, PatchIndex, IndexedPatchDataset,
+    write_patch_bank, PatchBankDataset
+)
+from metrics import PointSetMatcher, match_points, threshold_curve
+from models import Unet2D
+from preprocessing import strip_stats, normalise_strips, threshold_labels
+from synthetic import synthetic_dataset
+from scipy import ndimage as nd
+from torch.utils.data import DataLoader
+
+
+def parse_inputs():
+    parser = argparse.ArgumentParser(
+        description='Throughput benchmarks for the tree detection code.'
+    )
+    parser.add_argument(
+        '-s', '--suites',
+        dest='suites', nargs='+', default=['criteria'],
+        choices=['criteria', 'regions', 'loading', 'pipeline', 'imports'],
+        help='Benchmark suites to run'
+    )
+    parser.add_argument(
+        '-r', '--repeats',
+        dest='repeats',
+        type=int, default=10,
+        help='Number of repetitions per measure'
+    )
+    parser.add_argument(
+        '-o', '--output',
+        dest='output', default=None,
+        help='JSON file to store the results'
+    )
+    parser.add_argument(
+        '-b', '--baseline',
+        dest='baseline', default=None,
+        help='JSON file with previous results to compare with'
+    )
+
+    options = vars(parser.parse_args())
+
+    return options
+
+
+def timeit(f, repeats=10, warmup=1, sync=False):
+    """
+    Function to time a callable. The first calls are discarded to avoid
+    measuring lazy initialisations (cudnn, memory pools, caches...).
+    :param f: Function to time (without parameters).
+    :param repeats: Number of timed calls.
+    :param warmup: Number of discarded calls.
+    :param sync: Whether to synchronise the cuda device after each call.
+    :return: The median time per call in seconds.
+    """
+    for _ in range(warmup):
+        f()
+    times = []
+    for _ in range(repeats):
+        t_in = time.perf_counter()
+        f()
+        if sync:
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - t_in)
+    return float(np.median(times))
+
+
+"""
+Criteria
+"""
+
+
+def loop_xcor(var_x, var_y):
+    """
+    Reference implementation of the normalised cross correlation with one
+    convolution per sample (the original implementation in criteria). It's
+    only used to compare results and speed.
+    :param var_x: First tensor.
+    :param var_y: Second tensor.
+    :return: A tensor with the normalised cross correlation
+    """
+    red_dim = tuple(range(2, len(var_x.shape)))
+    x_norm = (var_x - var_x.mean(red_dim, keepdim=True)) / \
+        var_x.std(red_dim, keepdim=True)
+    y_norm = (var_y - var_y.mean(red_dim, keepdim=True)) / \
+        var_y.std(red_dim, keepdim=True)
+    xcor = [
+        F.conv1d(x_i.view(1, len(x_i), -1), y_i.view(1, len(y_i), -1))
+        for x_i, y_i in zip(x_norm, y_norm)
+    ]
+    n_elem = var_x.numel() / len(var_x)
+    return torch.mean(torch.abs(torch.cat(xcor))) / n_elem
+
+
+def bench_criteria(
+        batch_sizes=(8, 32, 128), shape=(4, 64, 64), repeats=10,
+        device=None
+):
+    """
+    Benchmark for the regression losses in criteria. The loop version is
+    used as a reference for both the value and the time.
+    :param batch_sizes: Batch sizes to test.
+    :param shape: Shape of each sample (channels and spatial dimensions).
+    :param repeats: Number of repetitions per measure.
+    :param device: Device for the tensors (cuda if available by default).
+    :return: List of dictionaries with the results per batch size.
+    """
+    if device is None:
+        device = default_device()
+    sync = device.type == 'cuda'
+    results = []
+    for batch_size in batch_sizes:
+        x = torch.rand((batch_size,) + tuple(shape), device=device)
+        y = x + 0.5 * torch.rand_like(x)
+        t_loop = timeit(lambda: loop_xcor(x, y), repeats, sync=sync)
+        t_xcor = timeit(lambda: normalised_xcor(x, y), repeats, sync=sync)
+        t_grad = timeit(lambda: gradient(x), repeats, sync=sync)
+        error = torch.abs(loop_xcor(x, y) - normalised_xcor(x, y)).tolist()
+        results.append({
+            'batch_size': batch_size,
+            'xcor_loop_samples_s': batch_size / t_loop,
+            'xcor_samples_s': batch_size / t_xcor,
+            'xcor_speedup': t_loop / t_xcor,
+            'xcor_abs_error': error,
+            'gradient_samples_s': batch_size / t_grad,
+        })
+
+    return results
+
+
+"""
+Masks
+"""
+
+
+def random_blobs(shape, n_blobs, max_radius=10, seed=42):
+    """
+    Function to create a random binary mask with circular blobs of
+    different sizes (similar to thresholded tree top predictions).
+    :param shape: Shape of the mask.
+    :param n_blobs: Number of blobs.
+    :param max_radius: Maximum radius of the blobs.
+    :param seed: Random seed.
+    :return: Binary mask (uint8).
+    """
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(0, shape[0], n_blobs)
+    cols = rng.integers(0, shape[1], n_blobs)
+    radii = rng.integers(0, max_radius, n_blobs)
+    mask = np.zeros(shape, dtype=np.uint8)
+    mask[rows, cols] = 1
+    # A distance transform is a cheap way to grow each seed up to its
+    # radius without a python loop over the blobs.
+    dist, (r_idx, c_idx) = nd.distance_transform_edt(
+        1 - mask, return_indices=True
+    )
+    seed_radii = np.zeros(shape)
+    seed_radii[rows, cols] = radii
+    return (dist <= seed_radii[r_idx, c_idx]).astype(np.uint8)
+
+
+def loop_remove_small_regions(img_vol, min_size=3):
+    """
+    Reference implementation of remove_small_regions with one mask per label
+    (the original implementation in utils). It's only used to compare
+    results and speed on small masks.
+    :param img_vol: Binary mask.
+    :param min_size: Minimum size for the blobs.
+    :return: New mask without the small blobs.
+    """
+    blobs, _ = nd.label(
+        img_vol, nd.generate_binary_structure(img_vol.ndim, img_vol.ndim)
+    )
+    labels = list(filter(bool, np.unique(blobs)))
+    areas = [np.count_nonzero(np.equal(blobs, lab)) for lab in labels]
+    nu_labels = [lab for lab, a in zip(labels, areas) if a >= min_size]
+    nu_mask = np.zeros(img_vol.shape, dtype=bool)
+    for lab in nu_labels:
+        nu_mask = np.logical_or(nu_mask, np.equal(blobs, lab))
+    return nu_mask
+
+
+def bench_regions(
+        sizes=(1000, 4000, 8000), density=2e-4, min_size=20, repeats=10,
+        reference_size=1000
+):
+    """
+    Benchmark for the small region removal on prediction-like masks.
+    :param sizes: Side of the square masks.
+    :param density: Number of blobs per pixel.
+    :param min_size: Minimum blob size.
+    :param repeats: Number of repetitions per measure.
+    :param reference_size: Maximum size to run the reference version
+     (it is quadratic).
+    :return: List of dictionaries with the results per size.
+    """
+    results = []
+    for size in sizes:
+        mask = random_blobs((size, size), int(density * size * size))
+        t_new = timeit(
+            lambda: remove_small_regions(mask, min_size, 2), repeats
+        )
+        r = {
+            'size': size,
+            'mpixels_s': size * size / t_new / 1e6,
+        }
+        if size <= reference_size:
+            t_ref = timeit(
+                lambda: loop_remove_small_regions(mask, min_size), 1, 0
+            )
+            r['reference_mpixels_s'] = size * size / t_ref / 1e6
+            r['speedup'] = t_ref / t_new
+            r['equal'] = float(np.array_equal(
+                loop_remove_small_regions(mask, min_size),
+                remove_small_regions(mask, min_size, 2)
+            ))
+        results.append(r)
+
+    return results
+
+
+"""
+Loading
+"""
+
+
+def full_decode(filename, ratio):
+    """
+    Reference loading: full resolution decoding followed by a resize (the
+    original approach in tree_detection).
+    :param filename: Name of the image file.
+    :param ratio: Downsampling ratio.
+    :return: The downsampled image.
+    """
+    im = cv2.imread(filename)
+    return cv2.resize(
+        im, (im.shape[1] // ratio, im.shape[0] // ratio),
+        interpolation=cv2.INTER_AREA
+    )
+
+
+def _timed_load(loader, filename, ratio, repeats):
+    """
+    Function to time a loader inside a fresh process, so the peak resident
+    memory only accounts for that loader.
+    :param loader: Loading function (filename, ratio).
+    :param filename: Name of the image file.
+    :param ratio: Downsampling ratio.
+    :param repeats: Number of repetitions.
+    :return: The median time per call and the peak RSS in MB.
+    """
+    t = timeit(lambda: loader(filename, ratio), repeats, warmup=0)
+    # ru_maxrss is inherited from the parent through fork, while VmHWM is
+    # reset when the new process image is loaded.
+    with open('/proc/self/status') as f:
+        peak = [
+            int(line.split()[1]) for line in f if line.startswith('VmHWM')
+        ]
+    if not peak:
+        peak = [resource.getrusage(resource.RUSAGE_SELF).ru_maxrss]
+    return t, peak[0] / 1024
+
+
+def bench_loading(sizes=(4000, 10000), ratios=(4, 10), repeats=3):
+    """
+    Benchmark for the image loading with reduced resolution decoding. Each
+    measure runs on a new process to get meaningful peak memory values.
+    :param sizes: Side of the square synthetic JPEG images.
+    :param ratios: Downsampling ratios to test.
+    :param repeats: Number of repetitions per measure.
+    :return: List of dictionaries with the results per size and ratio.
+    """
+    results = []
+    ctx = get_context('spawn')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in sizes:
+            filename = os.path.join(tmp_dir, 'mosaic{:d}.jpg'.format(size))
+            rng = np.random.default_rng(42)
+            im = rng.integers(0, 256, (size // 8, size // 8, 3), np.uint8)
+            cv2.imwrite(
+                filename, cv2.resize(im, (size, size), cv2.INTER_LINEAR)
+            )
+            del im
+            for ratio in ratios:
+                with ctx.Pool(1) as pool:
+                    t_full, rss_full = pool.apply(
+                        _timed_load, (full_decode, filename, ratio, repeats)
+                    )
+                with ctx.Pool(1) as pool:
+                    t_red, rss_red = pool.apply(
+                        _timed_load, (imread_reduced, filename, ratio, repeats)
+                    )
+                results.append({
+                    'size': size,
+                    'ratio': ratio,
+                    'full_s': t_full,
+                    'reduced_s': t_red,
+                    'speedup': t_full / t_red,
+                    'full_peak_mb': rss_full,
+                    'reduced_peak_mb': rss_red,
+                })
+
+    return results
+
+
+"""
+Pipeline
+"""
+
+
+def bench_pipeline(
+        shape=(3000, 3000), n_cases=3, density=2e-4, ratio=10,
+        patch_size=(64, 64), overlap=(32, 32), batch_size=32,
+        train_steps=20, repeats=3,
+        device=None
+):
+    """
+    Benchmark for all the stages of the tree detection pipeline on
+    synthetic mosaics: loading, patch extraction (get_slices and
+    Cropping2DDataset), cross-validation folds over a shared PatchIndex,
+    DataLoader throughput (from the images and from a patch bank), training
+    steps, testing, tree top extraction and the metrics.
+    :param shape: Shape of the synthetic mosaics.
+    :param n_cases: Number of synthetic cases.
+    :param density: Number of trees per pixel.
+    :param ratio: Downsampling ratio (as in tree_detection).
+    :param patch_size: Training patch size.
+    :param overlap: Overlap between training patches.
+    :param batch_size: Training batch size.
+    :param train_steps: Number of timed training steps.
+    :param repeats: Number of repetitions per measure.
+    :param device: Device for the network (cuda if available by default).
+    :return: List with a dictionary of results.
+    """
+    if device is None:
+        device = default_device()
+    sync = device.type == 'cuda'
+    r = {
+        'shape': list(shape),
+        'cases': n_cases,
+        'ratio': ratio,
+    }
+    with tempfile.TemporaryDirectory() as d_path:
+        t_in = time.perf_counter()
+        manifest = synthetic_dataset(d_path, n_cases, shape, density)
+        r['synthetic_s'] = time.perf_counter() - t_in
+        cases = list(manifest)
+
+        def load():
+            x = []
+            y = []
+            for c_i in cases:
+                mosaic = imread_reduced(
+                    os.path.join(d_path, manifest[c_i]['mosaic']['name']),
+                    ratio, manifest[c_i]['mosaic']['shape']
+                )
+                dem = imread_reduced(
+                    os.path.join(d_path, manifest[c_i]['dems']['nDEM']['name']),
+                    ratio, manifest[c_i]['dems']['nDEM']['shape']
+                )
+                xi = np.moveaxis(
+                    np.concatenate([mosaic, dem[..., :1]], -1), -1, 0
+                )
+                x.append(normalise_strips(xi, *strip_stats(xi)))
+                y.append(threshold_labels(
+                    os.path.join(d_path, manifest[c_i]['gt']['name']),
+                    50, ratio
+                ))
+            return x, y
+
+        t_load = timeit(load, repeats, 0)
+        x, y = load()
+        mpixels = n_cases * shape[0] * shape[1] / 1e6
+        r['load_mpixels_s'] = mpixels / t_load
+
+        t_slices = timeit(
+            lambda: get_slices(y, patch_size, overlap), repeats
+        )
+        r['slices_s'] = t_slices
+        t_dataset = timeit(
+            lambda: Cropping2DDataset(
+                x, y, patch_size=patch_size, overlap=overlap, filtered=True
+            ), repeats
+        )
+        r['dataset_s'] = t_dataset
+        index = PatchIndex(y, patch_size, overlap)
+        r['folds_s'] = timeit(
+            lambda: [
+                IndexedPatchDataset(x, y, index, split)
+                for i in range(n_cases)
+                for split in index.fold(i).values()
+            ], repeats
+        )
+        dataset = Cropping2DDataset(
+            x, y, patch_size=patch_size, overlap=overlap, filtered=True
+        )
+        r['patches'] = len(dataset)
+
+        loader = DataLoader(dataset, batch_size, True)
+        t_in = time.perf_counter()
+        n_samples = sum(len(xb) for xb, _ in loader)
+        r['dataloader_samples_s'] = n_samples / (time.perf_counter() - t_in)
+
+        with tempfile.TemporaryDirectory() as bank_dir:
+            t_in = time.perf_counter()
+            bank = write_patch_bank(
+                bank_dir, x, y, index, np.flatnonzero(index.positive)
+            )
+            r['bank_write_s'] = time.perf_counter() - t_in
+            bank_loader = DataLoader(
+                PatchBankDataset(bank, batch_size=batch_size), None
+            )
+            t_in = time.perf_counter()
+            n_samples = sum(len(xb) for xb, _ in bank_loader)
+            r['bank_samples_s'] = n_samples / (
+                time.perf_counter() - t_in
+            )
+            del bank, bank_loader
+
+        net = Unet2D(device=device, n_inputs=len(x[0]))
+        net.train()
+        batches = []
+        while len(batches) < train_steps:
+            batches.extend(loader)
+        batches = batches[:train_steps]
+
+        def train_step(xb, yb):
+            net.optimizer_alg.zero_grad()
+            pred = net(xb.to(device))
+            loss = sum(
+                l_f['weight'] * l_f['f'](pred, yb.to(device))
+                for l_f in net.train_functions
+            )
+            loss.backward()
+            net.optimizer_alg.step()
+
+        train_step(*batches[0])
+        if sync:
+            torch.cuda.synchronize()
+        t_in = time.perf_counter()
+        for xb, yb in batches:
+            train_step(xb, yb)
+        if sync:
+            torch.cuda.synchronize()
+        r['train_steps_s'] = train_steps / (time.perf_counter() - t_in)
+
+        t_test = timeit(
+            lambda: net.test(x, patch_size=None, verbose=False), repeats
+        )
+        # The network only sees the downsampled inputs, so the throughput
+        # is measured on those pixels. The equivalent full resolution
+        # throughput is kept separately.
+        test_mpixels = sum(xi.shape[1] * xi.shape[2] for xi in x) / 1e6
+        r['test_mpixels_s'] = test_mpixels / t_test
+        r['test_mosaic_mpixels_s'] = mpixels / t_test
+        preds, _ = net.test(x, patch_size=None, verbose=False)
+
+        # The network is not trained, so we use the (downsampled) labels
+        # with some noise as predictions for the remaining stages.
+        rng = np.random.default_rng(42)
+        probs = [
+            nd.gaussian_filter(yi.astype(np.float32), 1) * 2 +
+            0.1 * rng.random(yi.shape)
+            for yi in y
+        ]
+        gt = [
+            np.mean(
+                cv2.imread(os.path.join(d_path, manifest[c_i]['gt']['name'])),
+                axis=-1
+            ) < 10
+            for c_i in cases
+        ]
+        t_gt = timeit(
+            lambda: [list_from_mask(gi.astype(np.uint8)) for gi in gt],
+            repeats
+        )
+        r['gt_points_mpixels_s'] = mpixels / t_gt
+        t_peaks = timeit(
+            lambda: [peaks_from_probability(p, shape) for p in probs],
+            repeats
+        )
+        r['peaks_s'] = t_peaks
+        gt_lists = [
+            np.reshape(list_from_mask(gi.astype(np.uint8)), (-1, 2))
+            for gi in gt
+        ]
+        pred_lists = [peaks_from_probability(p, shape) for p in probs]
+        r['gt_points'] = int(sum(len(g) for g in gt_lists))
+        r['pred_points'] = int(sum(len(p) for p in pred_lists))
+
+        def point_metrics():
+            for g, p in zip(gt_lists, pred_lists):
+                matcher = PointSetMatcher(g, p)
+                matcher.hausdorf_distance()
+                matcher.matched_percentage(150)
+                matcher.matched_percentage(150, inverse=True)
+                matcher.avg_euclidean_distance()
+
+        r['matcher_s'] = timeit(point_metrics, repeats)
+        r['match_points_s'] = timeit(
+            lambda: [
+                match_points(g, p, 150) for g, p in zip(gt_lists, pred_lists)
+            ], repeats
+        )
+        thresholds = np.linspace(0.1, 0.9, 9)
+        r['threshold_curve_s'] = timeit(
+            lambda: [
+                threshold_curve(p, g, thresholds, shape)
+                for g, p in zip(gt_lists, probs)
+            ], repeats
+        )
+        r['f1'] = float(np.mean([
+            match_points(g, p, 150)['f1']
+            for g, p in zip(gt_lists, pred_lists)
+        ]))
+        del preds
+
+    return [r]
+
+
+"""
+Startup
+"""
+
+
+def _startup_time(args, repeats):
+    """
+    Function to time a python command on a new interpreter (the whole
+    process, including the interpreter startup).
+    :param args: Arguments for the python interpreter.
+    :param repeats: Number of repetitions.
+    :return: The median time of the command.
+    """
+    code_path = os.path.dirname(os.path.abspath(__file__))
+    return timeit(
+        lambda: subprocess.run(
+            [sys.executable] + args, cwd=code_path, check=True,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        ), repeats, warmup=1
+    )
+
+
+def bench_imports(
+        modules=(
+            'utils', 'metrics', 'preprocessing', 'pyramid', 'profiling',
+            'pipeline', 'tree_detection', 'sweep', 'autotune', 'models'
+        ),
+        lazy=(
+            'utils', 'metrics', 'preprocessing', 'pyramid', 'profiling',
+            'pipeline', 'tree_detection', 'sweep', 'autotune'
+        ),
+        repeats=3
+):
+    """
+    Benchmark for the startup time of the modules and the command line
+    entry points. Each measure runs on a fresh interpreter and the time of
+    an empty interpreter is given as a reference. The heavy dependencies
+    (torch, scipy, sklearn and skimage) imported by each module at import
+    time are also listed, and the modules that should import them lazily
+    fail the check if any of them is loaded.
+    :param modules: Modules to import.
+    :param lazy: Modules that must not import any heavy dependency.
+    :param repeats: Number of repetitions per measure.
+    :return: List of dictionaries with the results per command (the check
+     is 'failed' for the lazy modules with heavy imports).
+    """
+    heavy = ['torch', 'scipy', 'sklearn', 'skimage']
+    commands = [('python', ['-c', 'pass'])] + [
+        ('import ' + m, ['-c', 'import ' + m]) for m in modules
+    ] + [
+        ('tree_detection.py --help', ['tree_detection.py', '--help']),
+        ('profiling.py --help', ['profiling.py', '--help']),
+    ]
+    code_path = os.path.dirname(os.path.abspath(__file__))
+    results = []
+    for name, args in commands:
+        r = {
+            'command': name,
+            'time_s': _startup_time(args, repeats),
+        }
+        if name.startswith('import '):
+            loaded = subprocess.run(
+                [
+                    sys.executable, '-c',
+                    '{:}; import sys; print(" ".join('
+                    'm for m in {:} if m in sys.modules))'.format(name, heavy)
+                ], cwd=code_path, check=True, capture_output=True, text=True
+            ).stdout.split()
+            r['heavy_imports'] = ','.join(loaded) if loaded else '-'
+            if name[len('import '):] in lazy:
+                r['check'] = 'failed' if loaded else 'ok'
+        results.append(r)
+
+    return results
+
+
+def compare(results, baseline):
+    """
+    Function to compare the results of a run with a baseline run. Only the
+    numeric values present on both are compared.
+    :param results: Dictionary of results (suite: list of dictionaries).
+    :param baseline: Dictionary of results of the baseline.
+    :return: List of (suite, index, key, value, baseline value, ratio).
+    """
+    comparison = []
+    for suite, suite_results in results.items():
+        for i, (r, b) in enumerate(zip(suite_results, baseline.get(suite, []))):
+            for k, v in r.items():
+                b_v = b.get(k)
+                numeric = isinstance(v, (int, float)) and \
+                    isinstance(b_v, (int, float))
+                if numeric and b_v != 0:
+                    comparison.append((suite, i, k, v, b_v, v / b_v))
+    return comparison
+
+
+def main():
+    # Init
+    options = parse_inputs()
+    c = color_codes()
+    suites = {
+        'criteria': bench_criteria,
+        'regions': bench_regions,
+        'loading': bench_loading,
+        'pipeline': bench_pipeline,
+        'imports': bench_imports,
+    }
+
+    results = {}
+    t_start = time.time()
+    for name in options['suites']:
+        print(
+            '{:}[{:}]{:} Running the {:} suite{:}'.format(
+                c['c'], time.strftime("%H:%M:%S"), c['g'], name, c['nc']
+            )
+        )
+        results[name] = suites[name](repeats=options['repeats'])
+        for r in results[name]:
+            print(
+                ' / '.join(
+                    '{:} = {:}'.format(
+                        k, '{:.4g}'.format(v) if isinstance(v, float) else v
+                    ) for k, v in r.items()
+                )
+            )
+
+    print(
+        '{:}Benchmarks finished{:} ({:})'.format(
+            c['r'], c['nc'], time_to_string(time.time() - t_start)
+        )
+    )
+    if options['baseline'] is not None:
+        with open(options['baseline']) as f:
+            baseline = json.load(f)
+        print('{:}Comparison with {:}{:}'.format(
+            c['b'], options['baseline'], c['nc']
+        ))
+        for suite, i, k, v, b_v, ratio in compare(results, baseline):
+            print(
+                '{:} [{:d}] {:} = {:.4g} (baseline {:.4g}, x{:.3f})'.format(
+                    suite, i, k, v, b_v, ratio
+                )
+            )
+    if options['output'] is not None:
+        with open(options['output'], 'w') as f:
+            json.dump(results, f, indent=2)
+
+    # Suites can also check for regressions (other than speed).
+    failed = [
+        (suite, i) for suite, suite_results in results.items()
+        for i, r in enumerate(suite_results) if r.get('check') == 'failed'
+    ]
+    for suite, i in failed:
+        print('{:}Check failed{:} {:} [{:d}] {:}'.format(
+            c['r'], c['nc'], suite, i, results[suite][i]
+        ))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
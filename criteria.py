@@ -20,19 +20,6 @@ def gradient(tensor):
     tensor_dims = len(tensor.shape)
     data_dims = tensor_dims - 2
 
-    # Since we want this function to be generic, we need a trick to define
-    # the gradient on each dimension.
-    all_slices = (slice(0, None),) * (tensor_dims - 1)
-    first = slice(0, -2)
-    last = slice(2, None)
-    slices = [
-        (
-            all_slices[:i + 2] + (first,) + all_slices[i + 2:],
-            all_slices[:i + 2] + (last,) + all_slices[i + 2:],
-        )
-        for i in range(data_dims)
-    ]
-
     # Remember that gradients moved the image 0.5 pixels while also reducing
     # 1 voxel per dimension. To deal with that we are technically interpolating
     # the gradient in between these positions. These is the equivalent of
@@ -40,16 +27,18 @@ def gradient(tensor):
     # [a, b, c, d] -> gradient0.5 = [a - b, b - c, c - d]
     # gradient1 = 0.5 * [(a - b) + (b - c), (b - c) + (c - d)] =
     # = 0.5 * [a - c, b - d] ~ [a - c, b - d]
+    # Since we want this function to be generic, we use narrow to get views
+    # of the shifted tensors (no copies, no python indexing tuples) and pad
+    # the difference back to the original size on that same dimension.
     no_pad = (0, 0)
     pad = (1, 1)
-    paddings = [
-        no_pad * i + pad + no_pad * (data_dims - i - 1)
-        for i in range(data_dims)[::-1]
-    ]
-
     gradients = [
-        0.5 * F.pad(tensor[si] - tensor[sf], p)
-        for p, (si, sf) in zip(paddings, slices)
+        0.5 * F.pad(
+            tensor.narrow(d + 2, 0, tensor.shape[d + 2] - 2) -
+            tensor.narrow(d + 2, 2, tensor.shape[d + 2] - 2),
+            no_pad * (data_dims - d - 1) + pad + no_pad * d
+        )
+        for d in range(data_dims)
     ]
 
     return torch.cat(gradients, dim=1)
@@ -270,14 +259,23 @@ def lesion_ppv(pred, target):
 """
 
 
-def normalise_var(var):
+def normalise_var(var, eps=1e-5):
+    """
+        Function to normalise (zero mean and unit variance) each sample and
+         channel of a tensor. The first two dimensions are assumed to be
+         samples and channels. Channels with a standard deviation below eps
+         are set to 0 instead of being removed, that way the shape is kept
+         and no data-dependent indexing (and host synchronisation) is needed.
+        :param var: Input tensor.
+        :param eps: Minimum standard deviation for a channel to be valid.
+        :return: The normalised tensor (with the same shape as the input).
+    """
     red_dim = tuple(range(2, len(var.shape)))
     mean = torch.mean(var.detach(), dim=red_dim, keepdim=True)
     std = torch.std(var.detach(), dim=red_dim, keepdim=True)
-    if (std < 1e-5).any():
-        norm = (var[std > 1e-5] - mean[std > 1e-5]) / std[std > 1e-5]
-    else:
-        norm = (var - mean) / std
+    norm = torch.where(
+        std > eps, (var - mean) / std.clamp(min=eps), torch.zeros_like(var)
+    )
 
     return norm
 
@@ -285,7 +283,9 @@ def normalise_var(var):
 def normalised_xcor(var_x, var_y):
     """
         Function that computes the normalised cross correlation between two
-         tensors.
+         tensors. The correlation of each sample is a dot product between the
+         flattened normalised tensors, so we compute all of them at once
+         with a batched product instead of a convolution per sample.
         :param var_x: First tensor.
         :param var_y: Second tensor.
         :return: A tensor with the normalised cross correlation
@@ -293,23 +293,20 @@ def normalised_xcor(var_x, var_y):
     # Init
     var_y = var_y.to(var_x.device)
 
-    # Computation
-    var_x_norm = normalise_var(var_x)
-    var_y_norm = normalise_var(var_y)
+    # With a single element per channel the standard deviation is not
+    # defined (NaN), and the correlation is considered perfect (1). This
+    # only depends on the shape, so there is no need to check the values.
+    if var_x[0, 0].numel() < 2:
+        return torch.ones((), dtype=var_x.dtype, device=var_x.device)
 
-    xcor = [
-        F.conv1d(
-            torch.unsqueeze(x_i, dim=0).view(1, len(x_i), -1),
-            torch.unsqueeze(y_i, dim=0).view(1, len(y_i), -1)
-        )
-        for x_i, y_i in zip(var_x_norm, var_y_norm)
-    ]
+    # Computation
+    var_x_norm = normalise_var(var_x).flatten(1)
+    var_y_norm = normalise_var(var_y).flatten(1)
 
-    n_elem = var_x.numel() / len(var_x)
-    xcor = torch.mean(torch.abs(torch.cat(xcor))) / n_elem
+    xcor = torch.einsum('bi,bi->b', var_x_norm, var_y_norm)
 
-    if torch.isnan(xcor):
-        xcor = torch.tensor(1., device=xcor.device)
+    n_elem = var_x_norm.shape[1]
+    xcor = torch.mean(torch.abs(xcor)) / n_elem
 
     return xcor
 
@@ -1,8 +1,11 @@
 import itertools
+import json
+import os
 from skimage.transform import resize as imresize
 import numpy as np
 import torch
-from torch.utils.data.dataset import Dataset
+from torch.utils.data import get_worker_info
+from torch.utils.data.dataset import Dataset, IterableDataset
 
 
 def centers_to_slice(voxels, patch_half):
@@ -66,37 +69,182 @@ def get_slices(masks, patch_size, overlap):
     return patch_slices
 
 
-class Cropping2DDataset(Dataset):
-    def __init__(
-            self,
-            data, labels, patch_size=32, overlap=16, filtered=False
-    ):
-        # Init
-        self.data = data
-        self.labels = labels
-        data_shape = self.data[0].shape
+def _positive_patches(label, starts, stops):
+    """
+    Function to check which patches of a case contain positive labels. For
+    2D labels, the sum of each patch is computed with a summed area table
+    (four lookups per patch), otherwise each patch is summed.
+    :param label: Label image of the case.
+    :param starts: First index of each patch (patches, dimensions).
+    :param stops: Last index (excluded) of each patch (patches, dimensions).
+    :return: Boolean array with one value per patch.
+    """
+    mask = np.asarray(label) > 0
+    if len(starts) == 0:
+        return np.zeros(0, dtype=bool)
+    # Patches that do not fit inside the image (images smaller than the
+    # patch size) keep the python slicing semantics of the loop.
+    inside = np.all(starts >= 0) and np.all(stops <= mask.shape)
+    if mask.ndim == 2 and inside:
+        sat = np.zeros(
+            (mask.shape[0] + 1, mask.shape[1] + 1), dtype=np.int64
+        )
+        sat[1:, 1:] = np.cumsum(np.cumsum(mask, axis=0), axis=1)
+        r0, c0 = starts.T
+        r1, c1 = stops.T
+        sums = sat[r1, c1] - sat[r0, c1] - sat[r1, c0] + sat[r0, c0]
+    else:
+        sums = np.array([
+            np.sum(mask[tuple(slice(a, b) for a, b in zip(ini, end))])
+            for ini, end in zip(starts, stops)
+        ])
+    return sums > 0
 
+
+class PatchIndex(object):
+    """
+    Index of all the patches (with a given size and overlap) of a list of
+    cases. Patches (the same ones as get_slices) are stored as arrays of
+    corners tagged with their case, and whether each patch contains
+    positive labels is computed only once.
+    Cross-validation splits are just masks (or index arrays) over the
+    index, so creating the datasets of a fold does not copy nor process
+    the image data.
+    """
+    def __init__(self, labels, patch_size=32, overlap=16):
+        """
+        :param labels: List of label images (one per case).
+        :param patch_size: Size of the patches.
+        :param overlap: Overlap on each dimension between consecutive
+         patches.
+        """
+        ndim = labels[0].ndim
         if type(patch_size) is not tuple:
-            patch_size = (patch_size,) * len(data_shape)
+            patch_size = (patch_size,) * ndim
+        if type(overlap) is not tuple:
+            overlap = (overlap,) * ndim
         self.patch_size = patch_size
         self.overlap = overlap
+        self.n_cases = len(labels)
+        patch_half = np.array([p_length // 2 for p_length in patch_size])
+        steps = [
+            max(p_length - o, 1) for p_length, o in zip(patch_size, overlap)
+        ]
+        starts = []
+        positive = []
+        for label in labels:
+            # Same centers as get_slices, but computed as arrays.
+            dim_ranges = [
+                np.concatenate([np.arange(ini, end, step), [end]])
+                for ini, end, step in zip(
+                    patch_half, np.array(label.shape) - patch_half, steps
+                )
+            ]
+            centers = np.stack(
+                np.meshgrid(*dim_ranges, indexing='ij'), axis=-1
+            ).reshape((-1, ndim)).astype(np.int64)
+            starts.append(centers - patch_half)
+            positive.append(
+                _positive_patches(
+                    label, centers - patch_half, centers + patch_half
+                )
+            )
+        self.cases = np.concatenate([
+            np.full(len(s), i, dtype=np.int32) for i, s in enumerate(starts)
+        ])
+        self.starts = np.concatenate(starts)
+        self.stops = self.starts + 2 * patch_half
+        self.positive = np.concatenate(positive)
+
+    def __len__(self):
+        return len(self.cases)
 
-        slices = get_slices(
-            self.labels, self.patch_size, self.overlap
+    def slice(self, i):
+        """
+        :param i: Index of the patch.
+        :return: The slice of the patch (on its case).
+        """
+        return tuple(
+            slice(ini, end) for ini, end in zip(self.starts[i], self.stops[i])
         )
+
+    def mask(self, cases, filtered=False):
+        """
+        Method to select the patches of some cases.
+        :param cases: Indices of the cases.
+        :param filtered: Whether to only select the patches with positive
+         labels.
+        :return: Boolean mask over the patches.
+        """
+        mask = np.isin(self.cases, list(cases))
         if filtered:
-            self.patch_slices = [
-                (s, i) for i, (label, slices_i) in enumerate(zip(self.labels, slices))
-                for s in slices_i if np.sum(label[s]) > 0
-            ]
+            mask &= self.positive
+        return mask
+
+    def split(self, cases, filtered=False):
+        """
+        Method to get the indices of the patches of some cases.
+        :param cases: Indices of the cases.
+        :param filtered: Whether to only select the patches with positive
+         labels.
+        :return: Array with the indices of the patches.
+        """
+        return np.flatnonzero(self.mask(cases, filtered))
+
+    def fold(self, test_case, val_split=0.1, filtered=True):
+        """
+        Method to get the splits of a leave-one-case-out fold. The last
+        training cases are used for validation (as in tree_detection).
+        :param test_case: Index of the test case.
+        :param val_split: Fraction of the training cases used for
+         validation. If 0, all the patches of the training cases are also
+         used for validation.
+        :param filtered: Whether to only select the patches with positive
+         labels for training and validation.
+        :return: Dictionary with the indices of the training, validation and
+         test patches.
+        """
+        train_cases = [i for i in range(self.n_cases) if i != test_case]
+        if val_split > 0:
+            n_t_cases = int(len(train_cases) * (1 - val_split))
+            val = self.split(train_cases[n_t_cases:], filtered)
+            train_cases = train_cases[:n_t_cases]
         else:
-            self.patch_slices = [
-                (s, i) for i, slices_i in enumerate(slices) for s in slices_i
-            ]
+            val = self.split(train_cases)
+        return {
+            'train': self.split(train_cases, filtered),
+            'val': val,
+            'test': self.split([test_case]),
+        }
+
+
+class IndexedPatchDataset(Dataset):
+    """
+    Dataset of the patches selected from a PatchIndex. The data is only
+    referenced, so any number of datasets (folds) can share the same index
+    and images.
+    """
+    def __init__(self, data, labels, index, indices=None):
+        """
+        :param data: List of images (channels first), indexed by case. Cases
+         without selected patches can be None.
+        :param labels: List of label images, indexed by case.
+        :param index: PatchIndex of the cases.
+        :param indices: Indices of the selected patches (all of them if
+         None).
+        """
+        self.data = data
+        self.labels = labels
+        self.index = index
+        if indices is None:
+            indices = np.arange(len(index))
+        self.indices = indices
 
     def __getitem__(self, index):
-        # We select the case
-        slice_i, case_idx = self.patch_slices[index]
+        # We select the case and the patch
+        patch_i = self.indices[index]
+        case_idx = self.index.cases[patch_i]
+        slice_i = self.index.slice(patch_i)
 
         # We get the slice indexes
         none_slice = (slice(None, None),)
@@ -107,13 +255,23 @@ class Cropping2DDataset(Dataset):
             self.labels[case_idx][slice_i].astype(np.uint8), axis=0
         )
 
-        # target_labs = bwlabeln(target.astype(np.bool))
-        # tops = len(np.unique(target_labs[target.astype(np.bool)]))
-
         return inputs, target
 
     def __len__(self):
-        return len(self.patch_slices)
+        return len(self.indices)
+
+
+class Cropping2DDataset(IndexedPatchDataset):
+    def __init__(
+            self,
+            data, labels, patch_size=32, overlap=16, filtered=False
+    ):
+        # Init
+        index = PatchIndex(labels, patch_size, overlap)
+        super().__init__(
+            data, labels, index,
+            index.split(range(len(labels)), filtered)
+        )
 
 
 class CroppingDown2DDataset(Cropping2DDataset):
@@ -135,7 +293,227 @@ class CroppingDown2DDataset(Cropping2DDataset):
         downlabels = [
             torch.max_pool2d(
                 torch.tensor(np.expand_dims(lab, 0)).type(torch.float32), ratio
-            ).squeeze(dim=0).numpy().astype(np.bool)
+            ).squeeze(dim=0).numpy().astype(bool)
             for lab in labels
         ]
         super().__init__(downdata, downlabels, patch_size, overlap, filtered)
+
+
+"""
+Patch banks
+"""
+
+
+def write_patch_bank(
+        path, data, labels, index, indices=None, dtype=np.float16
+):
+    """
+    Function to extract the patches of an index once into a patch bank: a
+    folder with contiguous (patches, channels, rows, columns) arrays for
+    the inputs (float16 by default) and the labels (uint8) that are read as
+    memory maps. Patches are written in index order, so the patches of each
+    case are contiguous. The header is written last, so a bank is either
+    finished or it can't be opened.
+    :param path: Folder for the bank.
+    :param data: List of images (channels first), indexed by case. Cases
+     without selected patches can be None.
+    :param labels: List of label images, indexed by case.
+    :param index: PatchIndex of the cases.
+    :param indices: Indices of the selected patches (all of them if None).
+    :param dtype: Data type of the stored inputs.
+    :return: The PatchBank.
+    """
+    if indices is None:
+        indices = np.arange(len(index))
+    indices = np.sort(indices)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    n_channels = next(x for x in data if x is not None).shape[0]
+    patch_shape = tuple(index.patch_size)
+    x_bank = np.lib.format.open_memmap(
+        os.path.join(path, 'inputs.npy'), mode='w+', dtype=dtype,
+        shape=(len(indices), n_channels) + patch_shape
+    )
+    y_bank = np.lib.format.open_memmap(
+        os.path.join(path, 'labels.npy'), mode='w+', dtype=np.uint8,
+        shape=(len(indices), 1) + patch_shape
+    )
+    none_slice = (slice(None, None),)
+    for row, patch_i in enumerate(indices):
+        case_idx = index.cases[patch_i]
+        slice_i = index.slice(patch_i)
+        x_bank[row] = data[case_idx][none_slice + slice_i]
+        y_bank[row, 0] = labels[case_idx][slice_i]
+    x_bank.flush()
+    y_bank.flush()
+    del x_bank, y_bank
+    np.save(os.path.join(path, 'indices.npy'), indices)
+    with open(os.path.join(path, 'bank.json'), 'w') as f:
+        json.dump({
+            'patches': len(indices),
+            'channels': n_channels,
+            'patch_size': list(patch_shape),
+            'overlap': list(index.overlap),
+            'dtype': np.dtype(dtype).name,
+        }, f)
+
+    return PatchBank(path)
+
+
+class PatchBank(object):
+    """
+    Reader for patch banks (see write_patch_bank). The arrays are opened as
+    read-only memory maps, so only the pages that are read are loaded and
+    they are shared (page cache) between processes. Banks can be pickled
+    (for DataLoader workers) and each process reopens the memory maps.
+    """
+    def __init__(self, path):
+        self.path = path
+        header_file = os.path.join(path, 'bank.json')
+        if not os.path.isfile(header_file):
+            raise IOError('No patch bank found in {:}'.format(path))
+        with open(header_file) as f:
+            self.header = json.load(f)
+        self._open()
+
+    def _open(self):
+        self.inputs = np.load(
+            os.path.join(self.path, 'inputs.npy'), mmap_mode='r'
+        )
+        self.labels = np.load(
+            os.path.join(self.path, 'labels.npy'), mmap_mode='r'
+        )
+        self.indices = np.load(os.path.join(self.path, 'indices.npy'))
+
+    def __getstate__(self):
+        return {'path': self.path, 'header': self.header}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def __len__(self):
+        return len(self.indices)
+
+    def rows(self, indices):
+        """
+        Method to find the rows of the bank of some patches of the index
+        (for example, the splits of PatchIndex.fold).
+        :param indices: Indices of the patches (on the PatchIndex).
+        :return: Sorted array with the rows of the patches.
+        """
+        indices = np.sort(indices)
+        rows = np.searchsorted(self.indices, indices)
+        found = rows < len(self.indices)
+        found[found] = self.indices[rows[found]] == indices[found]
+        if not np.all(found):
+            raise KeyError(
+                '{:d} patches are not stored in {:}'.format(
+                    np.sum(~found), self.path
+                )
+            )
+        return rows
+
+
+class PatchBankDataset(IterableDataset):
+    """
+    Dataset that reads batches from a patch bank. The selected rows are
+    grouped into contiguous blocks and each epoch reads the blocks (in a
+    random order when shuffling) with sequential reads. Blocks go through
+    a shuffle buffer, so batches mix patches from several blocks. Batches
+    are already built (use DataLoader with batch_size=None), and with
+    DataLoader workers each worker reads a different subset of the blocks.
+    """
+    def __init__(
+            self, bank, rows=None, batch_size=32, shuffle=True,
+            block_size=256, buffer_size=4096
+    ):
+        """
+        :param bank: PatchBank (or its folder).
+        :param rows: Rows of the bank for the dataset (all if None).
+        :param batch_size: Number of samples per batch.
+        :param shuffle: Whether to shuffle the blocks and the buffer.
+        :param block_size: Maximum number of patches per read.
+        :param buffer_size: Number of patches of the shuffle buffer.
+        """
+        if not isinstance(bank, PatchBank):
+            bank = PatchBank(bank)
+        self.bank = bank
+        if rows is None:
+            rows = np.arange(len(bank))
+        rows = np.sort(rows)
+        self.n_samples = len(rows)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.buffer_size = max(buffer_size, batch_size)
+        self.rng = np.random.default_rng()
+        # Blocks are contiguous runs of rows (split at the gaps of the
+        # selection and every block_size rows).
+        gaps = np.flatnonzero(np.diff(rows) != 1) + 1
+        self.blocks = [
+            (run[ini], run[min(ini + block_size, len(run)) - 1] + 1)
+            for run in np.split(rows, gaps) if len(run) > 0
+            for ini in range(0, len(run), block_size)
+        ]
+
+    def __len__(self):
+        # Number of batches (exact with a single process).
+        return -(-self.n_samples // self.batch_size)
+
+    def _batches(self, x, y, rng=None):
+        # The samples are shuffled (if a generator is given) and split into
+        # batches.
+        if rng is not None:
+            order = rng.permutation(len(x))
+            x, y = x[order], y[order]
+        for ini in range(0, len(x), self.batch_size):
+            yield (
+                torch.from_numpy(
+                    x[ini:ini + self.batch_size].astype(np.float32)
+                ),
+                torch.from_numpy(y[ini:ini + self.batch_size])
+            )
+
+    def __iter__(self):
+        worker = get_worker_info()
+        blocks = self.blocks
+        if worker is None:
+            rng = self.rng
+            block_rng = rng
+        else:
+            # All the workers need the same block order (the base seed is
+            # shared) to split the blocks, but different buffers.
+            rng = np.random.default_rng(worker.seed)
+            block_rng = np.random.default_rng(worker.seed - worker.id)
+        if self.shuffle:
+            blocks = [blocks[i] for i in block_rng.permutation(len(blocks))]
+        if worker is not None:
+            blocks = blocks[worker.id::worker.num_workers]
+
+        x_buffer = []
+        y_buffer = []
+        n_buffer = 0
+        for ini, end in blocks:
+            x_buffer.append(np.asarray(self.bank.inputs[ini:end]))
+            y_buffer.append(np.asarray(self.bank.labels[ini:end]))
+            n_buffer += end - ini
+            if n_buffer >= self.buffer_size:
+                # Full batches are released and the remaining samples stay
+                # in the buffer.
+                x = np.concatenate(x_buffer)
+                y = np.concatenate(y_buffer)
+                if self.shuffle:
+                    order = rng.permutation(len(x))
+                    x, y = x[order], y[order]
+                n_out = len(x) - len(x) % self.batch_size
+                x_buffer = [x[n_out:]]
+                y_buffer = [y[n_out:]]
+                n_buffer = len(x) - n_out
+                for batch in self._batches(x[:n_out], y[:n_out], None):
+                    yield batch
+        if n_buffer > 0:
+            for batch in self._batches(
+                np.concatenate(x_buffer), np.concatenate(y_buffer),
+                rng if self.shuffle else None
+            ):
+                yield batch
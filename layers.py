@@ -70,14 +70,14 @@ class DownsampledSelfAttention2D(nn.Module):
         self.conv_g = nn.Conv2d(
             in_features, att_features, downsampling, stride=downsampling
         )
-        self.conv_final = nn.Conv3d(att_features, in_features, 1)
+        self.conv_final = nn.Conv2d(att_features, in_features, 1)
         self.norm = norm
 
     def forward(self, x):
         theta = self.conv_theta(x).flatten(2).transpose(1, 2)
         phi = self.conv_phi(x).flatten(2)
         g = self.conv_g(x).flatten(2)
-        ds_x = F.max_pool3d(x, self.downsampling)
+        ds_x = F.max_pool2d(x, self.downsampling)
 
         att = torch.bmm(theta, phi)
         att_map = self.norm(
@@ -116,7 +116,7 @@ class AttentionGate2D(nn.Module):
         x_emb = self.conv_x(x)
         g_emb = self.conv_g(
             F.interpolate(
-                g, size=x_emb.size()[2:], mode='trilinear',
+                g, size=x_emb.size()[2:], mode='bilinear',
                 align_corners=False
             )
         )
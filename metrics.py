@@ -1,8 +1,15 @@
+import csv
+import json
+import os
 import sys
-from scipy.spatial.distance import directed_hausdorff
-from sklearn.neighbors import KDTree
+from functools import partial
+from multiprocessing import Pool
 import numpy as np
-from utils import list_from_binary
+
+# scipy and sklearn are imported by the functions that need them, so
+# the command line tool starts quickly.
+from utils import list_from_binary, centroids_from_thresholds
+from utils import border_points, rescale_points
 
 
 def hausdorf_distance(list1, list2):
@@ -13,6 +20,7 @@ def hausdorf_distance(list1, list2):
     :param list2: Second list of points.
     :return:
     """
+    from scipy.spatial.distance import directed_hausdorff
     if len(list1) == 0 or len(list2) == 0:
         distance = -1
     else:
@@ -23,6 +31,7 @@ def hausdorf_distance(list1, list2):
 
 
 def euclidean_distances(list1, list2):
+    from sklearn.neighbors import KDTree
     new_list1 = np.asarray([[x, y] for x, y in list1])
     new_list2 = np.asarray([[x, y] for x, y in list2])
 
@@ -59,12 +68,434 @@ def avg_euclidean_distance(list1, list2):
     return distance
 
 
+def _greedy_assignment(edges, distances):
+    """
+    Function to match the nodes of a bipartite graph greedily by distance
+    (closest pairs first).
+    :param edges: Array of edges (ground truth index, predicted index).
+    :param distances: Distance for each edge.
+    :return: Array of matched edges.
+    """
+    used1, used2, matches = set(), set(), []
+    for k in np.argsort(distances, kind='stable'):
+        i, j = edges[k]
+        if i not in used1 and j not in used2:
+            used1.add(i)
+            used2.add(j)
+            matches.append((i, j))
+    return np.reshape(np.array(matches, dtype=np.int64), (-1, 2))
+
+
+def _optimal_assignment(local_edges, distances, shape):
+    """
+    Function to match the nodes of a bipartite graph with the Hungarian
+    algorithm. Missing edges get a cost higher than the sum of all the
+    distances, that way the number of matches is maximised first and then
+    the total distance is minimised.
+    :param local_edges: Array of edges with the indices of the nodes inside
+     the graph (ground truth index, predicted index).
+    :param distances: Distance for each edge.
+    :param shape: Number of nodes on each side of the graph.
+    :return: Arrays of matched local indices (ground truth, predicted).
+    """
+    from scipy.optimize import linear_sum_assignment
+    no_edge = np.sum(distances) + 1
+    cost = np.full(shape, no_edge)
+    cost[local_edges[:, 0], local_edges[:, 1]] = distances
+    rows, cols = linear_sum_assignment(cost)
+    valid = cost[rows, cols] < no_edge
+    return rows[valid], cols[valid]
+
+
+def match_points(list1, list2, radius, max_hungarian=32):
+    """
+    Function to match two lists of points one to one (each point can only
+    be matched once). Possible matches are the pairs of points closer than
+    a radius, which define a sparse bipartite graph (computed with KD-tree
+    radius queries). Each connected component of that graph is solved
+    independently: isolated pairs are matched directly, small components
+    use the Hungarian algorithm and large ones a greedy matching by
+    distance.
+    :param list1: First list of points (the ground truth).
+    :param list2: Second list of points (the predictions).
+    :param radius: Maximum distance for a match.
+    :param max_hungarian: Maximum number of points on either side of a
+     component to use the Hungarian algorithm.
+    :return: Dictionary with the true positives, false positives, false
+     negatives, precision, recall, F1 score and the matched pairs of
+     indices. Precision, recall and F1 are -1 when undefined.
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    from scipy.spatial import cKDTree
+    points1 = np.reshape(np.asarray(list1, dtype=np.float64), (-1, 2))
+    points2 = np.reshape(np.asarray(list2, dtype=np.float64), (-1, 2))
+    n1, n2 = len(points1), len(points2)
+
+    if n1 > 0 and n2 > 0:
+        graph = cKDTree(points1).sparse_distance_matrix(
+            cKDTree(points2), radius, output_type='ndarray'
+        )
+        edges = np.stack([graph['i'], graph['j']], axis=1).astype(np.int64)
+        distances = graph['v']
+    else:
+        edges = np.zeros((0, 2), dtype=np.int64)
+        distances = np.zeros(0)
+
+    if len(edges) > 0:
+        # Components of the bipartite graph (predicted nodes are shifted
+        # after the ground truth ones).
+        adjacency = coo_matrix(
+            (np.ones(len(edges)), (edges[:, 0], edges[:, 1] + n1)),
+            shape=(n1 + n2, n1 + n2)
+        )
+        n_labels, labels = connected_components(adjacency, directed=False)
+
+        # Points on each side of every component, sorted by component. We
+        # also need the index of each point inside its component to build
+        # the cost matrices for the Hungarian algorithm.
+        nodes1 = np.unique(edges[:, 0])
+        nodes1 = nodes1[np.argsort(labels[nodes1], kind='stable')]
+        nodes2 = np.unique(edges[:, 1]) + n1
+        nodes2 = nodes2[np.argsort(labels[nodes2], kind='stable')]
+        local = np.zeros(n1 + n2, dtype=np.int64)
+        for nodes in [nodes1, nodes2]:
+            node_labels = labels[nodes]
+            local[nodes] = np.arange(len(nodes)) - np.searchsorted(
+                node_labels, node_labels
+            )
+        comp_n1 = np.bincount(labels[nodes1], minlength=n_labels)
+        comp_n2 = np.bincount(labels[nodes2], minlength=n_labels)
+        comp_start1 = np.searchsorted(labels[nodes1], np.arange(n_labels))
+        comp_start2 = np.searchsorted(labels[nodes2], np.arange(n_labels))
+
+        # Edges are sorted by component and distance.
+        edge_labels = labels[edges[:, 0]]
+        order = np.lexsort((distances, edge_labels))
+        edges, distances = edges[order], distances[order]
+        edge_labels = edge_labels[order]
+        local_edges = np.stack(
+            [local[edges[:, 0]], local[edges[:, 1] + n1]], axis=1
+        )
+        comps, starts, counts = np.unique(
+            edge_labels, return_index=True, return_counts=True
+        )
+
+        # Components with a single point on either side (most of them) are
+        # solved by taking their closest pair.
+        star = np.logical_or(comp_n1[comps] == 1, comp_n2[comps] == 1)
+        matches = [edges[starts[star]]]
+        for comp, start, count in zip(
+            comps[~star], starts[~star], counts[~star]
+        ):
+            c_slice = slice(start, start + count)
+            if max(comp_n1[comp], comp_n2[comp]) <= max_hungarian:
+                rows, cols = _optimal_assignment(
+                    local_edges[c_slice], distances[c_slice],
+                    (comp_n1[comp], comp_n2[comp])
+                )
+                matches.append(np.stack([
+                    nodes1[comp_start1[comp] + rows],
+                    nodes2[comp_start2[comp] + cols] - n1
+                ], axis=1))
+            else:
+                matches.append(
+                    _greedy_assignment(edges[c_slice], distances[c_slice])
+                )
+        matches = np.concatenate(matches)
+    else:
+        matches = np.zeros((0, 2), dtype=np.int64)
+
+    tp = len(matches)
+    result = {
+        'tp': tp,
+        'fp': n2 - tp,
+        'fn': n1 - tp,
+        'precision': tp / n2 if n2 > 0 else -1,
+        'recall': tp / n1 if n1 > 0 else -1,
+        'f1': 2 * tp / (n1 + n2) if (n1 + n2) > 0 else -1,
+        'matches': matches,
+    }
+    return result
+
+
+class PointSetMatcher(object):
+    """
+    Class to compare two sets of points with all the metrics in this module.
+    The lists are converted to arrays once and the nearest neighbour of each
+    point on the other set is computed once in each direction (one KDTree
+    per set). All the metrics are then derived from those two arrays of
+    distances.
+    """
+    def __init__(self, list1, list2, leaf_size=30):
+        """
+        :param list1: First list of points (usually the ground truth).
+        :param list2: Second list of points.
+        :param leaf_size: Leaf size for the KD-trees.
+        """
+        from sklearn.neighbors import KDTree
+        self.points1 = np.reshape(
+            np.asarray(list1, dtype=np.float64), (-1, 2)
+        )
+        self.points2 = np.reshape(
+            np.asarray(list2, dtype=np.float64), (-1, 2)
+        )
+        self.empty = len(self.points1) == 0 or len(self.points2) == 0
+        if self.empty:
+            self.distances1 = self.distances2 = None
+        else:
+            # Distances from each point of one list to the closest point of
+            # the other list.
+            kdt2 = KDTree(self.points2, leaf_size=leaf_size)
+            self.distances1 = kdt2.query(self.points1, k=1)[0][:, 0]
+            kdt1 = KDTree(self.points1, leaf_size=leaf_size)
+            self.distances2 = kdt1.query(self.points2, k=1)[0][:, 0]
+
+    def hausdorf_distance(self):
+        """
+        Hausdorf distance between both lists (the maximum of both directed
+        distances).
+        :return: The distance (-1 if any list is empty).
+        """
+        if self.empty:
+            distance = -1
+        else:
+            distance = max(np.max(self.distances1), np.max(self.distances2))
+        return distance
+
+    def matched_percentages(self, epsilons, inverse=False):
+        """
+        Percentage of points with a neighbour on the other list closer than
+        each epsilon.
+        :param epsilons: List of distance thresholds.
+        :param inverse: Whether to use the points of the second list as the
+         reference.
+        :return: List of percentages (-1 if any list is empty).
+        """
+        if self.empty:
+            percentages = [-1] * len(epsilons)
+        else:
+            distances = self.distances2 if inverse else self.distances1
+            counts = np.count_nonzero(
+                np.expand_dims(distances, 0) <
+                np.reshape(np.asarray(epsilons, dtype=np.float64), (-1, 1)),
+                axis=1
+            )
+            percentages = (100 * counts / len(distances)).tolist()
+        return percentages
+
+    def matched_percentage(self, epsilon, inverse=False):
+        """
+        Percentage of points with a neighbour on the other list closer than
+        epsilon.
+        :param epsilon: Distance threshold.
+        :param inverse: Whether to use the points of the second list as the
+         reference.
+        :return: The percentage (-1 if any list is empty).
+        """
+        return self.matched_percentages([epsilon], inverse)[0]
+
+    def avg_euclidean_distance(self, inverse=False):
+        """
+        Average distance to the closest point on the other list.
+        :param inverse: Whether to use the points of the second list as the
+         reference.
+        :return: The average distance (-1 if any list is empty).
+        """
+        if self.empty:
+            distance = -1
+        else:
+            distances = self.distances2 if inverse else self.distances1
+            distance = np.mean(distances)
+        return distance
+
+
+def threshold_curve(
+        prob, gt_list, thresholds, shape=None, epsilon=150, margin=100
+):
+    """
+    Function to evaluate the tree tops obtained from a probability map with
+    all the thresholds of a grid. The centroids for every threshold come
+    from a single component tree of the map (see centroids_from_thresholds)
+    and each list of points is compared to the ground truth with all the
+    point metrics.
+    :param prob: Probability map (it can be a low resolution map).
+    :param gt_list: List of ground truth points (on the mosaic resolution).
+    :param thresholds: List of thresholds.
+    :param shape: Shape of the original mosaic. If None, the points are
+     compared in the coordinates of the probability map.
+    :param epsilon: Distance threshold for the matched percentages and the
+     one to one matching.
+    :param margin: Margin of the border to discard points.
+    :return: List of dictionaries with the metrics for each threshold.
+    """
+    n_gt = len(gt_list)
+    curve = []
+    centroids = centroids_from_thresholds(prob, thresholds)
+    if shape is not None:
+        centroids = [rescale_points(c, prob.shape, shape) for c in centroids]
+    else:
+        shape = prob.shape
+    for threshold, points in zip(thresholds, centroids):
+        points = points[np.logical_not(border_points(shape, points, margin))]
+        n_pred = len(points)
+        matcher = PointSetMatcher(gt_list, points)
+        matching = match_points(gt_list, points, epsilon)
+        curve.append({
+            'threshold': float(threshold),
+            'n_gt': n_gt,
+            'n_pred': n_pred,
+            'diff': 100 * (n_gt - n_pred) / n_gt if n_gt > 0 else -1,
+            'hausdorff': float(matcher.hausdorf_distance()),
+            'matched': float(matcher.matched_percentage(epsilon)),
+            'inverse_matched': float(
+                matcher.matched_percentage(epsilon, inverse=True)
+            ),
+            'avg_euclidean': float(matcher.avg_euclidean_distance()),
+            'tp': matching['tp'],
+            'fp': matching['fp'],
+            'fn': matching['fn'],
+            'precision': matching['precision'],
+            'recall': matching['recall'],
+            'f1': matching['f1'],
+        })
+
+    return curve
+
+
+def pairs_from_manifest(filename):
+    """
+    Function to read the pairs of ground truth and predicted masks from a
+    manifest file. Each line should contain the name of both files separated
+    by a comma. Empty lines and lines starting with # are ignored.
+    :param filename: Name of the manifest file.
+    :return: List of (ground truth, prediction) file names.
+    """
+    pairs = []
+    with open(filename) as f:
+        reader = csv.reader(f)
+        for row in reader:
+            if not row or row[0].startswith('#'):
+                continue
+            if len(row) < 2:
+                raise ValueError(
+                    'Line {:d} of {:} should contain two file names '
+                    '(found {:})'.format(reader.line_num, filename, row)
+                )
+            pairs.append((row[0].strip(), row[1].strip()))
+    return pairs
+
+
+def pairs_from_dirs(gt_dir, pred_dir):
+    """
+    Function to pair the ground truth and predicted masks from two folders.
+    Files are paired by name and only names present in both folders are
+    used.
+    :param gt_dir: Folder with the ground truth masks.
+    :param pred_dir: Folder with the predicted masks.
+    :return: List of (ground truth, prediction) file names.
+    """
+    gt_names = {e.name for e in os.scandir(gt_dir) if e.is_file()}
+    pred_names = {e.name for e in os.scandir(pred_dir) if e.is_file()}
+    pairs = [
+        (os.path.join(gt_dir, name), os.path.join(pred_dir, name))
+        for name in sorted(gt_names & pred_names)
+    ]
+    return pairs
+
+
+def evaluate_pair(pair, epsilon=150):
+    """
+    Function to compute all the metrics (the five options of the command
+    line and the one to one matching) for a pair of masks.
+    :param pair: Tuple with the ground truth and predicted file names.
+    :param epsilon: Distance threshold for the matched percentage.
+    :return: Dictionary with the metrics.
+    """
+    gt_file, pred_file = pair
+    list1 = list_from_binary(gt_file)
+    list2 = list_from_binary(pred_file)
+    n_real_points = len(list1)
+    n_predicted_points = len(list2)
+    matcher = PointSetMatcher(list1, list2)
+    if n_real_points > 0:
+        diff = 100 * (n_real_points - n_predicted_points) / n_real_points
+    else:
+        diff = -1
+    result = {
+        'gt': gt_file,
+        'pred': pred_file,
+        'hausdorff': float(matcher.hausdorf_distance()),
+        'matched': float(matcher.matched_percentage(epsilon)),
+        'diff': float(diff),
+        'n_gt': n_real_points,
+        'n_pred': n_predicted_points,
+        'avg_euclidean': float(matcher.avg_euclidean_distance()),
+    }
+    matching = match_points(list1, list2, epsilon)
+    result.update({
+        k: matching[k]
+        for k in ['tp', 'fp', 'fn', 'precision', 'recall', 'f1']
+    })
+    return result
+
+
+def batch_evaluation(pairs, output, epsilon=150, processes=None):
+    """
+    Function to evaluate a list of pairs of masks with a pool of processes.
+    The point lists are extracted and all the metrics computed on the
+    workers, while the results are written as they arrive (in the same order
+    as the pairs). The format (CSV or JSON lines) is defined by the
+    extension of the output file.
+    :param pairs: List of (ground truth, prediction) file names.
+    :param output: Name of the output file (.csv or .jsonl).
+    :param epsilon: Distance threshold for the matched percentage.
+    :param processes: Number of processes (None uses all the CPUs).
+    :return: None.
+    """
+    fields = [
+        'gt', 'pred', 'hausdorff', 'matched', 'diff', 'n_gt', 'n_pred',
+        'avg_euclidean', 'tp', 'fp', 'fn', 'precision', 'recall', 'f1'
+    ]
+    jsonl = output.endswith('.jsonl') or output.endswith('.json')
+    with open(output, 'w', newline='') as f, Pool(processes) as pool:
+        if not jsonl:
+            writer = csv.DictWriter(f, fields)
+            writer.writeheader()
+        results = pool.imap(
+            partial(evaluate_pair, epsilon=epsilon), pairs, chunksize=4
+        )
+        for result in results:
+            if jsonl:
+                f.write(json.dumps(result) + '\n')
+            else:
+                writer.writerow(result)
+            f.flush()
+
+
 def main(argv):
     # argv[1] contains the distance method
     #  (0 hausdorff, 1, matched point percentage).
     # argv[2], argv[3] contains the names of the files with the first  and
     #  second mask.
     # Further parameters may contain specific information for some methods.
+    # If argv[1] is "batch" all the metrics are computed for a list of pairs
+    #  of masks. The pairs are defined either by a manifest file (argv[2])
+    #  or by a folder of ground truth masks (argv[2]) and a folder of
+    #  predicted masks (argv[3]). The next parameter is the output file
+    #  (.csv or .jsonl), optionally followed by the epsilon for the matched
+    #  percentage.
+
+    if argv[1] == 'batch':
+        if os.path.isdir(argv[2]):
+            pairs = pairs_from_dirs(argv[2], argv[3])
+            extra = argv[4:]
+        else:
+            pairs = pairs_from_manifest(argv[2])
+            extra = argv[3:]
+        epsilon = float(extra[1]) if len(extra) > 1 else 150
+        batch_evaluation(pairs, extra[0], epsilon)
+        return
 
     option = int(argv[1])
     file1 = argv[2]
@@ -6,7 +6,7 @@ from functools import partial
 from torch import nn
 import torch.nn.functional as F
 from base import BaseModel
-from utils import to_torch_var, time_to_string
+from utils import to_torch_var, time_to_string, default_device
 from criteria import flip_loss, focal_loss, dsc_loss
 
 
@@ -14,15 +14,15 @@ class Autoencoder2D(BaseModel):
     def __init__(
             self,
             conv_filters,
-            device=torch.device(
-                "cuda:0" if torch.cuda.is_available() else "cpu"
-            ),
+            device=None,
             n_inputs=1,
             kernel_size=3,
             pooling=False,
             dropout=0,
     ):
         super().__init__()
+        if device is None:
+            device = default_device()
         # Init
         self.pooling = pooling
         self.device = device
@@ -108,10 +108,12 @@ class Unet2D(BaseModel):
     def __init__(
             self,
             conv_filters=None,
-            device=torch.device("cuda:0" if torch.cuda.is_available() else "cpu"),
+            device=None,
             n_inputs=4, n_outputs=1
     ):
         super(Unet2D, self).__init__()
+        if device is None:
+            device = default_device()
         # Init values
         if conv_filters is None:
             conv_filters = [32, 64, 128, 256]
@@ -333,9 +335,12 @@ class Unet2D(BaseModel):
                 seg_i = np.zeros(im.shape[1:])
                 unc_i = np.zeros(im.shape[1:])
 
+                # Patches are clipped to the image (a dimension smaller than
+                # the patch size is tested as a whole).
+                patch_shape = [min(patch_size, lim) for lim in im.shape[1:]]
                 limits = tuple(
-                    list(range(0, lim, patch_size))[:-1] + [lim - patch_size]
-                    for lim in data.shape[1:]
+                    list(range(0, lim, p_len))[:-1] + [lim - p_len]
+                    for lim, p_len in zip(im.shape[1:], patch_shape)
                 )
                 limits_product = list(itertools.product(*limits))
 
@@ -347,17 +352,18 @@ class Unet2D(BaseModel):
                     # Here we just take the current patch defined by its slice
                     # in the x and y axes. Then we convert it into a torch
                     # tensor for testing.
-                    xslice = slice(xi, xi + patch_size)
-                    yslice = slice(xj, xj + patch_size)
+                    xslice = slice(xi, xi + patch_shape[0])
+                    yslice = slice(xj, xj + patch_shape[1])
                     data_tensor = to_torch_var(
-                        np.expand_dims(im[slice(None), xslice, yslice], axis=0)
+                        np.expand_dims(im[slice(None), xslice, yslice], axis=0),
+                        self.device
                     )
 
                     # Testing itself.
                     with torch.no_grad():
-                        torch.cuda.synchronize()
                         seg_pi, unc_pi, _ = self(data_tensor)
-                        torch.cuda.synchronize()
+                    if self.device.type == 'cuda':
+                        torch.cuda.synchronize(self.device)
                         torch.cuda.empty_cache()
 
                     # Then we just fill the results image.
@@ -389,12 +395,14 @@ class Unet2D(BaseModel):
                 # If we use the whole image the process is way simpler.
                 # We only need to convert the data into a torch tensor,
                 # test it and return the results.
-                data_tensor = to_torch_var(np.expand_dims(im, axis=0))
+                data_tensor = to_torch_var(
+                    np.expand_dims(im, axis=0), self.device
+                )
 
                 # Testing
                 with torch.no_grad():
-                    torch.cuda.synchronize(self.device)
                     seg_pi, unc_pi, _ = self(data_tensor)
+                if self.device.type == 'cuda':
                     torch.cuda.synchronize(self.device)
                     torch.cuda.empty_cache()
 
@@ -0,0 +1,398 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import sys
+import time
+from profiling import StageTimer
+from utils import color_codes
+
+
+def file_digest(filename, block_size=2 ** 20):
+    """
+    Function to compute a hash of the contents of a file (read by blocks).
+    :param filename: Name of the file.
+    :param block_size: Number of bytes per read.
+    :return: Hexadecimal string with the SHA1 hash.
+    """
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _func_name(func):
+    """
+    Function to get the qualified name of a stage function. Functions
+    defined on a script have the same name whether it is run directly or
+    imported.
+    :param func: Stage function.
+    :return: The name of the function (module.name).
+    """
+    module = func.__module__
+    if module == '__main__':
+        main_file = getattr(sys.modules['__main__'], '__file__', None)
+        if main_file is not None:
+            module = os.path.splitext(os.path.basename(main_file))[0]
+    return '{:}.{:}'.format(module, func.__qualname__)
+
+
+def _run_stage(func, out_dir, args, kwargs, kind, info):
+    """
+    Function to run a stage on a worker process. Workers can't use the
+    timer of the run, so the records are returned with the result.
+    :return: The result of the stage and the list of timer records.
+    """
+    timer = StageTimer()
+    with timer.stage(kind, **info):
+        result = func(out_dir, *args, **kwargs)
+    timer.close()
+    return result, timer.records
+
+
+class Stage(object):
+    """
+    Node of a pipeline. See Pipeline.add for the meaning of each field.
+    """
+    def __init__(
+            self, name, func, deps=(), params=None, options=None, files=(),
+            outputs=(), info=None, parallel=False, version=1
+    ):
+        self.name = name
+        self.kind = name.split('.')[0]
+        self.func = func
+        self.deps = list(deps)
+        self.params = {} if params is None else params
+        self.options = {} if options is None else options
+        self.files = [f for f in files if f is not None]
+        self.outputs = list(outputs)
+        self.info = {} if info is None else info
+        self.parallel = parallel
+        self.version = version
+
+
+class Pipeline(object):
+    """
+    Small DAG runner with a content-addressed cache. Each stage is a
+    function whose result depends on the results of other stages, on some
+    JSON serialisable parameters and on the contents of some files. The key
+    of a stage is a hash of its function, its parameters, the digests of
+    its files and the keys of its dependencies, so keys can be computed
+    before running anything. The result of a stage is stored (pickled) on a
+    folder named after its key, and the result file is written last, so a
+    stage is either finished or it will be run again. When running a target
+    only the stages without a stored result (and the stages that depend on
+    a forced one) are run, and only the stored results needed by them are
+    loaded. Interrupted runs resume from the last finished stages.
+    """
+    def __init__(self, cache_dir, timer=None, force=(), verbose=1):
+        """
+        :param cache_dir: Folder for the stage results.
+        :param timer: StageTimer for the stages (each stage is recorded with
+         its kind, the part of the name before the first dot).
+        :param force: Names or kinds of the stages that are run again
+         (together with the stages that depend on them), once per session.
+        :param verbose: Verbosity level (1 prints the stages that are run,
+         2 also prints the cached ones).
+        """
+        self.cache_dir = cache_dir
+        self.timer = StageTimer() if timer is None else timer
+        self.force = set(force)
+        self.verbose = verbose
+        self.stages = {}
+        self._keys = {}
+        self._dirty = {}
+        # Keys of the stages run during this session (and of the ones that
+        # were run because they were forced), so forced stages are only run
+        # once (even if other stages share their key).
+        self._ran = set()
+        self._rerun = set()
+        self._results = {}
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self._digest_file = os.path.join(cache_dir, 'digests.json')
+        try:
+            with open(self._digest_file) as f:
+                self._digests = json.load(f)
+        except (IOError, ValueError):
+            self._digests = {}
+
+    def add(
+            self, name, func, deps=(), params=None, options=None, files=(),
+            outputs=(), info=None, parallel=False, version=1
+    ):
+        """
+        Method to add a stage. The function is called as
+        func(out_dir, *dep_results, **params, **options), where out_dir is
+        the folder of the stage (for any extra files it needs to store).
+        :param name: Unique name of the stage (kind.detail).
+        :param func: Function of the stage. Its result must be picklable.
+        :param deps: Names of the stages it depends on (they must be added
+         before).
+        :param params: Dictionary of parameters (part of the key).
+        :param options: Dictionary of extra keyword arguments that do not
+         change the result (file names, verbosity...). They are not part of
+         the key, and the contents of input files should be given through
+         files.
+        :param files: Input files. The digest of their contents is part of
+         the key (None values are ignored).
+        :param outputs: Files written outside of the cache. If any of them is
+         missing, the stage is run again.
+        :param info: Extra information for the timer records (case, etc.).
+        :param parallel: Whether the stage can be run on a process pool.
+        :param version: Version of the function (it should be increased when
+         the function changes, to invalidate the stored results).
+        :return: The name of the stage.
+        """
+        if name in self.stages:
+            raise ValueError('Stage {:} already exists'.format(name))
+        for dep in deps:
+            if dep not in self.stages:
+                raise KeyError('Unknown dependency {:}'.format(dep))
+        self.stages[name] = Stage(
+            name, func, deps, params, options, files, outputs, info,
+            parallel, version
+        )
+        return name
+
+    def _file_digest(self, filename):
+        # Digests are reused while the size and modification time of the
+        # file do not change.
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        cached = self._digests.get(path)
+        signature = [stat.st_size, stat.st_mtime_ns]
+        if cached is not None and cached[:2] == signature:
+            return cached[2]
+        digest = file_digest(path)
+        self._digests[path] = signature + [digest]
+        with open(self._digest_file, 'w') as f:
+            json.dump(self._digests, f)
+        return digest
+
+    def key(self, name):
+        """
+        Method to get the key of a stage.
+        :param name: Name of the stage.
+        :return: Hexadecimal string with the SHA1 key.
+        """
+        key = self._keys.get(name)
+        if key is None:
+            stage = self.stages[name]
+            description = {
+                'func': _func_name(stage.func),
+                'version': stage.version,
+                'params': stage.params,
+                'files': [self._file_digest(f) for f in stage.files],
+                'deps': [self.key(dep) for dep in stage.deps],
+            }
+            key = hashlib.sha1(
+                json.dumps(description, sort_keys=True).encode()
+            ).hexdigest()
+            self._keys[name] = key
+        return key
+
+    def path(self, name):
+        """
+        :param name: Name of the stage.
+        :return: The folder of the stage for its current key. Folders are
+         grouped by kind (not by name), so stages with the same key share
+         their results (even if they belong to different pipelines).
+        """
+        return os.path.join(
+            self.cache_dir, self.stages[name].kind, self.key(name)
+        )
+
+    def done(self, name):
+        """
+        :param name: Name of the stage.
+        :return: Whether the stage has a stored result for its current key
+         (and all its outputs exist).
+        """
+        return os.path.isfile(
+            os.path.join(self.path(name), 'result.pkl')
+        ) and all(os.path.isfile(f) for f in self.stages[name].outputs)
+
+    def dirty(self, name):
+        """
+        :param name: Name of the stage.
+        :return: Whether the stage is forced (or depends on a forced stage)
+         and it has not been run yet during this session.
+        """
+        dirty = self._dirty.get(name)
+        if dirty is None:
+            stage = self.stages[name]
+            dirty = self.key(name) not in self._ran and (
+                name in self.force or stage.kind in self.force or any(
+                    self.key(dep) in self._rerun or self.dirty(dep)
+                    for dep in stage.deps
+                )
+            )
+            self._dirty[name] = dirty
+        return dirty
+
+    def plan(self, targets):
+        """
+        Method to decide which stages need to be run to get the targets.
+        :param targets: Names of the target stages.
+        :return: Dictionary with the stages to run or load (name: 'run' or
+         'load').
+        """
+        plan = {}
+
+        def visit(name):
+            if name in plan:
+                return
+            if self.done(name) and not self.dirty(name):
+                plan[name] = 'load'
+            else:
+                plan[name] = 'run'
+                for dep in self.stages[name].deps:
+                    visit(dep)
+
+        for target in targets:
+            visit(target)
+        return plan
+
+    def _load(self, name):
+        stage = self.stages[name]
+        with self.timer.stage('loading', source=stage.kind, **stage.info):
+            with open(os.path.join(self.path(name), 'result.pkl'), 'rb') as f:
+                return pickle.load(f)
+
+    def _result(self, name):
+        if name not in self._results:
+            self._results[name] = self._load(name)
+        return self._results[name]
+
+    def _prepare(self, name):
+        # Any leftovers from an interrupted run are removed.
+        out_dir = self.path(name)
+        if os.path.isdir(out_dir):
+            shutil.rmtree(out_dir)
+        os.makedirs(out_dir)
+        return out_dir
+
+    def _store(self, name, result, wall):
+        stage = self.stages[name]
+        out_dir = self.path(name)
+        with open(os.path.join(out_dir, 'stage.json'), 'w') as f:
+            json.dump({
+                'name': name,
+                'key': self.key(name),
+                'func': _func_name(stage.func),
+                'params': stage.params,
+                'files': stage.files,
+                'deps': {dep: self.key(dep) for dep in stage.deps},
+                'wall_s': wall,
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            }, f, indent=1)
+        # The result is written last (and atomically), it marks the stage
+        # as finished.
+        tmp_file = os.path.join(out_dir, 'result.pkl.tmp')
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, os.path.join(out_dir, 'result.pkl'))
+        self._results[name] = result
+        if self.dirty(name):
+            self._rerun.add(self.key(name))
+        self._ran.add(self.key(name))
+        self._dirty = {}
+
+    def _print(self, status, name):
+        c = color_codes()
+        print(
+            '{:}[{:}]{:} {:} {:}{:}'.format(
+                c['c'], time.strftime("%H:%M:%S"), c['g'], status, name,
+                c['nc']
+            )
+        )
+
+    def run(self, targets, pool=None):
+        """
+        Method to get the results of a list of target stages. Stages are
+        run by waves (all the stages with finished dependencies), and the
+        parallel stages of a wave are sent to the process pool (if given).
+        Intermediate results are released as soon as all the stages that
+        need them have finished.
+        :param targets: Names of the target stages.
+        :param pool: multiprocessing Pool for the parallel stages.
+        :return: Dictionary with the results of the targets.
+        """
+        plan = self.plan(targets)
+        pending = [name for name in self.stages if plan.get(name) == 'run']
+        users = {name: 0 for name in plan}
+        for name in pending:
+            for dep in self.stages[name].deps:
+                users[dep] += 1
+        if self.verbose > 1:
+            for name in self.stages:
+                if plan.get(name) == 'load':
+                    self._print('Cached', name)
+
+        while pending:
+            wave = [
+                name for name in pending
+                if not any(
+                    dep in pending for dep in self.stages[name].deps
+                )
+            ]
+            pending = [name for name in pending if name not in wave]
+            tasks = []
+            for name in wave:
+                stage = self.stages[name]
+                args = [self._result(dep) for dep in stage.deps]
+                kwargs = dict(stage.params, **stage.options)
+                out_dir = self._prepare(name)
+                if self.verbose > 0:
+                    self._print('Running', name)
+                t_in = time.time()
+                if pool is not None and stage.parallel:
+                    tasks.append((name, t_in, pool.apply_async(
+                        _run_stage,
+                        (stage.func, out_dir, args, kwargs, stage.kind,
+                         stage.info)
+                    )))
+                else:
+                    with self.timer.stage(stage.kind, **stage.info):
+                        result = stage.func(out_dir, *args, **kwargs)
+                    self._store(name, result, time.time() - t_in)
+            for name, t_in, task in tasks:
+                result, records = task.get()
+                self.timer.extend(records)
+                self._store(name, result, time.time() - t_in)
+
+            for name in wave:
+                for dep in self.stages[name].deps:
+                    users[dep] -= 1
+                    if users[dep] == 0 and dep not in targets:
+                        self._results.pop(dep, None)
+
+        results = {target: self._result(target) for target in targets}
+        for name in list(self._results):
+            if name not in targets:
+                self._results.pop(name)
+        return results
+
+    def prune(self):
+        """
+        Method to remove the stored results (of the kinds of stages of this
+        pipeline) that do not match any of the current keys. Results of
+        other pipelines sharing the cache are also removed.
+        :return: List of removed folders.
+        """
+        keys = {}
+        for name, stage in self.stages.items():
+            keys.setdefault(stage.kind, set()).add(self.key(name))
+        removed = []
+        for kind, kind_keys in keys.items():
+            kind_dir = os.path.join(self.cache_dir, kind)
+            if not os.path.isdir(kind_dir):
+                continue
+            for key in os.listdir(kind_dir):
+                if key not in kind_keys:
+                    shutil.rmtree(os.path.join(kind_dir, key))
+                    removed.append(os.path.join(kind_dir, key))
+        return removed
@@ -0,0 +1,178 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+
+
+def _strip_moments(strip):
+    """
+    Function to compute the count, mean and sum of squared differences (M2)
+    per channel of a strip (channels, rows, columns).
+    :param strip: Strip of the image.
+    :return: The count, the mean and the M2 per channel.
+    """
+    flat = strip.reshape((len(strip), -1)).astype(np.float64)
+    count = flat.shape[-1]
+    mean = np.mean(flat, axis=-1)
+    m2 = np.sum((flat - mean[:, None]) ** 2, axis=-1)
+    return count, mean, m2
+
+
+def merge_moments(moments_a, moments_b):
+    """
+    Function to merge the moments of two disjoint sets of samples (parallel
+    version of Welford's algorithm by Chan et al.). It's numerically stable
+    and the order of the merges does not matter, so it also works for
+    chunks processed in parallel.
+    :param moments_a: Count, mean and M2 of the first set.
+    :param moments_b: Count, mean and M2 of the second set.
+    :return: The count, mean and M2 of the union.
+    """
+    count_a, mean_a, m2_a = moments_a
+    count_b, mean_b, m2_b = moments_b
+    count = count_a + count_b
+    if count == 0:
+        return moments_a
+    delta = mean_b - mean_a
+    mean = mean_a + delta * count_b / count
+    m2 = m2_a + m2_b + delta ** 2 * count_a * count_b / count
+    return count, mean, m2
+
+
+def strip_stats(image, strip_rows=512):
+    """
+    Function to compute the mean and the standard deviation of each channel
+    of an image with a single pass over row strips. Only one strip is
+    converted to float64 at a time.
+    :param image: Image (channels, rows, columns).
+    :param strip_rows: Number of rows per strip.
+    :return: The mean and the standard deviation per channel.
+    """
+    moments = (0, np.zeros(len(image)), np.zeros(len(image)))
+    for ini in range(0, image.shape[1], strip_rows):
+        moments = merge_moments(
+            moments, _strip_moments(image[:, ini:ini + strip_rows])
+        )
+    count, mean, m2 = moments
+    return mean, np.sqrt(m2 / max(count, 1))
+
+
+def normalise_strips(image, mean, std, strip_rows=512, dtype=np.float32):
+    """
+    Function to normalise each channel of an image by row strips, writing
+    directly on the output array (no full size float64 copies).
+    :param image: Image (channels, rows, columns).
+    :param mean: Mean per channel.
+    :param std: Standard deviation per channel.
+    :param strip_rows: Number of rows per strip.
+    :param dtype: Type of the normalised image.
+    :return: The normalised image.
+    """
+    mean = np.reshape(mean, (-1, 1, 1))
+    std = np.reshape(std, (-1, 1, 1))
+    norm = np.empty(image.shape, dtype=dtype)
+    for ini in range(0, image.shape[1], strip_rows):
+        strip = image[:, ini:ini + strip_rows]
+        norm[:, ini:ini + strip_rows] = (strip - mean) / std
+    return norm
+
+
+def threshold_labels(filename, threshold=50, ratio=1, strip_rows=512):
+    """
+    Function to read the ground truth mask (dark pixels) of an annotation
+    image by row strips. The mean intensity test is done with integers
+    (sum < channels * threshold) and each strip is downsampled with a
+    block maximum, so only the decoded uint8 image and a small strip are
+    in memory.
+    :param filename: Annotation image.
+    :param threshold: Intensity threshold for the labels.
+    :param ratio: Downsampling ratio.
+    :param strip_rows: Approximate number of rows per strip (rounded to a
+     multiple of the ratio).
+    :return: The binary mask (uint8).
+    """
+    im = cv2.imread(filename)
+    if im.ndim == 2:
+        im = im[..., None]
+    channels = im.shape[-1]
+    rows = im.shape[0] // ratio
+    cols = im.shape[1] // ratio
+    strip_rows = max(strip_rows // ratio, 1) * ratio
+    mask = np.empty((rows, cols), dtype=np.uint8)
+    for ini in range(0, rows * ratio, strip_rows):
+        strip = im[ini:min(ini + strip_rows, rows * ratio), :cols * ratio]
+        dark = np.sum(strip, axis=-1, dtype=np.uint16) < channels * threshold
+        blocks = dark.reshape((-1, ratio, cols, ratio))
+        mask[ini // ratio:ini // ratio + len(blocks)] = blocks.any(
+            axis=(1, 3)
+        )
+    return mask
+
+
+def _hsv_strip(mosaic, dem, output, ini, end):
+    # The conversion is written in place (the value channel is then
+    # replaced by the DEM), which avoids any temporary strip.
+    strip = output[ini:end]
+    cv2.cvtColor(mosaic[ini:end], cv2.COLOR_BGR2HSV, dst=strip)
+    cv2.mixChannels([dem[ini:end]], [strip], [0, 2])
+
+
+def hsv_stack(mosaic, dem, strip_rows=512, pool=None):
+    """
+    Function to stack the hue and saturation of a mosaic with its DEM. The
+    colour conversion is done by row strips (on a thread pool if given,
+    OpenCV releases the GIL) and each strip is written directly on a
+    preallocated output image.
+    :param mosaic: BGR mosaic.
+    :param dem: DEM image (only the first channel is used).
+    :param strip_rows: Number of rows per strip.
+    :param pool: Thread pool for the strips. If None, they are processed
+     sequentially.
+    :return: The stacked image (hue, saturation, DEM) as uint8.
+    """
+    output = np.empty(mosaic.shape[:2] + (3,), dtype=np.uint8)
+    limits = [
+        (ini, min(ini + strip_rows, len(mosaic)))
+        for ini in range(0, len(mosaic), strip_rows)
+    ]
+    if pool is None:
+        for ini, end in limits:
+            _hsv_strip(mosaic, dem, output, ini, end)
+    else:
+        futures = [
+            pool.submit(_hsv_strip, mosaic, dem, output, ini, end)
+            for ini, end in limits
+        ]
+        for f in futures:
+            f.result()
+    return output
+
+
+def hsv_mosaics(
+        mosaics, dems, cases, output_dir, strip_rows=512, n_jobs=None,
+        case_jobs=2
+):
+    """
+    Function to create and export the HSV + DEM version of a list of
+    mosaics (hsv_mosaic{case}.jpg). Cases are processed concurrently and
+    the strips of all the cases share the same thread pool.
+    :param mosaics: List of BGR mosaics.
+    :param dems: List of DEMs.
+    :param cases: List of case identifiers.
+    :param output_dir: Folder for the new images.
+    :param strip_rows: Number of rows per strip.
+    :param n_jobs: Number of threads for the strips (None uses the default
+     of ThreadPoolExecutor).
+    :param case_jobs: Number of cases processed at the same time.
+    :return: List with the names of the new images.
+    """
+    def process_case(mosaic, dem, case):
+        filename = os.path.join(output_dir, 'hsv_mosaic{:}.jpg'.format(case))
+        cv2.imwrite(filename, hsv_stack(mosaic, dem, strip_rows, strip_pool))
+        return filename
+
+    with ThreadPoolExecutor(n_jobs) as strip_pool, \
+            ThreadPoolExecutor(case_jobs) as case_pool:
+        filenames = list(case_pool.map(process_case, mosaics, dems, cases))
+
+    return filenames
@@ -0,0 +1,627 @@
+import argparse
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
+# torch (and the network layers) are only imported by the functions that
+# need them. That way, the stage timers can be used by the command line
+# scripts without paying for the torch import.
+
+
+class StepProfiler(object):
+    """
+    Low overhead profiler for the training and validation loops. The loop
+    calls mark after each phase of a batch (data loading, host to device
+    copies, forward, losses, backward and optimiser step) and the time since
+    the previous mark is assigned to that phase. At the end of each loop,
+    the percentiles per phase are written as a JSON line. Optionally, a
+    window of training steps can also be recorded with torch.profiler and
+    exported as a Chrome trace.
+    """
+    phases = ('data', 'h2d', 'forward', 'loss', 'backward', 'step', 'other')
+
+    def __init__(
+            self, jsonl_file=None, percentiles=(50, 90, 99), sync=None,
+            trace_file=None, trace_window=(10, 5)
+    ):
+        """
+        :param jsonl_file: File to append the summaries (one JSON per loop).
+        :param percentiles: Percentiles to compute per phase.
+        :param sync: Whether to synchronise the cuda device at each mark
+         (needed to attribute asynchronous kernels to the right phase). By
+         default, it's enabled if cuda is available.
+        :param trace_file: Chrome trace file for torch.profiler. If None, no
+         trace is recorded.
+        :param trace_window: First training step and number of steps of the
+         trace.
+        """
+        self.jsonl_file = jsonl_file
+        self.percentiles = percentiles
+        if sync is None:
+            import torch
+            sync = torch.cuda.is_available()
+        self.sync = sync
+        self.trace_file = trace_file
+        self.trace_window = trace_window
+        self.summaries = []
+        self.times = {}
+        self.info = {}
+        self.train_steps = 0
+        self._last = None
+        self._trace = None
+        self._training = False
+
+    def start_loop(self, **info):
+        """
+        Method to start timing a loop over a dataloader.
+        :param info: Extra information for the summary (epoch, loader...).
+        :return: None.
+        """
+        self.info = info
+        self._training = info.get('training', False)
+        self.times = {phase: [] for phase in self.phases}
+        self._last = time.perf_counter()
+
+    def mark(self, phase):
+        """
+        Method to close a phase. The elapsed time since the last mark is
+        assigned to it.
+        :param phase: Name of the phase.
+        :return: None.
+        """
+        if self.sync:
+            import torch
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        self.times[phase].append(now - self._last)
+        self._last = now
+
+    def step(self):
+        """
+        Method to close a batch (the remaining time goes to 'other'). It also
+        starts and stops the torch.profiler trace.
+        :return: None.
+        """
+        self.mark('other')
+        if self._training and self.trace_file is not None:
+            first, n_steps = self.trace_window
+            if self.train_steps == first:
+                import torch
+                activities = [torch.profiler.ProfilerActivity.CPU]
+                if torch.cuda.is_available():
+                    activities.append(torch.profiler.ProfilerActivity.CUDA)
+                self._trace = torch.profiler.profile(activities=activities)
+                self._trace.start()
+            elif self._trace is not None and \
+                    self.train_steps == first + n_steps:
+                self._stop_trace()
+            self.train_steps += 1
+        # We do not want to count the profiler itself.
+        self._last = time.perf_counter()
+
+    def _stop_trace(self):
+        self._trace.stop()
+        self._trace.export_chrome_trace(self.trace_file)
+        self._trace = None
+
+    def end_loop(self):
+        """
+        Method to finish a loop. The summary is stored and written as a new
+        line on the JSONL file.
+        :return: The summary of the loop.
+        """
+        if self._trace is not None and self._training:
+            self._stop_trace()
+        summary = dict(self.info)
+        summary['steps'] = len(self.times['other'])
+        summary['phases'] = {}
+        for phase, times in self.times.items():
+            if not times:
+                continue
+            times = np.array(times)
+            stats = {
+                'total': float(np.sum(times)),
+                'mean': float(np.mean(times)),
+            }
+            for p, v in zip(
+                self.percentiles, np.percentile(times, self.percentiles)
+            ):
+                stats['p{:d}'.format(p)] = float(v)
+            summary['phases'][phase] = stats
+        self.summaries.append(summary)
+        if self.jsonl_file is not None:
+            with open(self.jsonl_file, 'a') as f:
+                f.write(json.dumps(summary) + '\n')
+        return summary
+
+
+def current_rss():
+    """
+    Function to get the current resident memory of the process.
+    :return: The resident memory in bytes.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        # Not linux. The maximum is the best we can get.
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class StageTimer(object):
+    """
+    Lightweight telemetry for the stages of a run. Each stage (a context
+    manager) records its wall time, the CPU time of the process (all
+    threads) and of its finished child processes, and the peak resident
+    memory while it was running. Memory is sampled by a single background
+    thread shared by all the active stages. The records can be written as
+    a JSON report.
+    """
+    def __init__(self, interval=0.05):
+        """
+        :param interval: Time between memory samples (seconds).
+        """
+        self.interval = interval
+        self.records = []
+        self.t_start = time.time()
+        self._active = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            rss = current_rss()
+            with self._lock:
+                for record in self._active:
+                    record['peak_rss'] = max(record['peak_rss'], rss)
+
+    @contextmanager
+    def stage(self, name, case=None, **info):
+        """
+        Context manager to time a stage.
+        :param name: Name of the stage.
+        :param case: Case identifier (if the stage is specific to a case).
+        :param info: Extra information for the record.
+        """
+        if self._sampler is None:
+            self._sampler = threading.Thread(target=self._sample, daemon=True)
+            self._sampler.start()
+        rss = current_rss()
+        record = {
+            'case': case, 'stage': name, 'rss_start': rss, 'peak_rss': rss
+        }
+        record.update(info)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu_in = time.process_time()
+        t_in = time.perf_counter()
+        with self._lock:
+            self._active.append(record)
+        try:
+            yield record
+        finally:
+            wall = time.perf_counter() - t_in
+            cpu = time.process_time() - cpu_in
+            children_out = resource.getrusage(resource.RUSAGE_CHILDREN)
+            rss = current_rss()
+            with self._lock:
+                self._active.remove(record)
+            record['peak_rss'] = max(record['peak_rss'], rss)
+            record.update({
+                'wall_s': wall,
+                'cpu_s': cpu,
+                'children_cpu_s': (
+                    children_out.ru_utime + children_out.ru_stime -
+                    children.ru_utime - children.ru_stime
+                ),
+                'rss_end': rss,
+            })
+            self.records.append(record)
+
+    def extend(self, records):
+        """
+        Method to add records from other timers (for example, from a worker
+        process).
+        :param records: List of records.
+        :return: None.
+        """
+        self.records.extend(records)
+
+    def summary(self):
+        """
+        Method to aggregate the records by stage.
+        :return: Dictionary with the total wall and CPU times, the number of
+         calls and the maximum peak memory per stage.
+        """
+        stages = {}
+        for record in self.records:
+            s = stages.setdefault(record['stage'], {
+                'calls': 0, 'wall_s': 0., 'cpu_s': 0.,
+                'children_cpu_s': 0., 'peak_rss': 0
+            })
+            s['calls'] += 1
+            s['wall_s'] += record['wall_s']
+            s['cpu_s'] += record['cpu_s']
+            s['children_cpu_s'] += record['children_cpu_s']
+            s['peak_rss'] = max(s['peak_rss'], record['peak_rss'])
+        return stages
+
+    def report(self, **info):
+        """
+        Method to build the run report.
+        :param info: Extra information about the run (options, etc.).
+        :return: The report dictionary.
+        """
+        return {
+            'start': time.strftime(
+                '%Y-%m-%dT%H:%M:%S', time.localtime(self.t_start)
+            ),
+            'wall_s': time.time() - self.t_start,
+            'argv': sys.argv,
+            'info': info,
+            'stages': self.summary(),
+            'records': self.records,
+        }
+
+    def write(self, filename, **info):
+        """
+        Method to write the run report as a JSON file.
+        :param filename: Name of the report file.
+        :param info: Extra information about the run.
+        :return: The report dictionary.
+        """
+        report = self.report(**info)
+        with open(filename, 'w') as f:
+            json.dump(report, f, indent=1)
+        return report
+
+    def close(self):
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+            self._sampler = None
+        self._stop.clear()
+
+
+"""
+Layer costs
+"""
+
+
+def _tensors(output):
+    """
+    Function to get all the tensors from the output of a module (which can
+    be a tensor or nested tuples, lists or dictionaries).
+    :param output: Output of the module.
+    :return: List of tensors.
+    """
+    import torch
+    if isinstance(output, torch.Tensor):
+        return [output]
+    elif isinstance(output, (list, tuple)):
+        return [t for o in output for t in _tensors(o)]
+    elif isinstance(output, dict):
+        return [t for o in output.values() for t in _tensors(o)]
+    else:
+        return []
+
+
+def _conv_flops(module, inputs, output):
+    from torch import nn
+    kernel = int(np.prod(module.kernel_size))
+    if isinstance(module, nn.modules.conv._ConvTransposeNd):
+        # Each input pixel is scattered through the whole kernel.
+        return 2 * inputs[0].numel() * kernel * \
+            module.out_channels // module.groups
+    return 2 * output.numel() * kernel * module.in_channels // module.groups
+
+
+def _linear_flops(module, inputs, output):
+    return 2 * output.numel() * module.in_features
+
+
+def _norm_flops(module, inputs, output):
+    # Normalisation (subtraction and division) plus the affine transform.
+    return 4 * output.numel()
+
+
+def _pool_flops(module, inputs, output):
+    kernel = module.kernel_size
+    if not isinstance(kernel, tuple):
+        kernel = (kernel,) * (output.dim() - 2)
+    return output.numel() * int(np.prod(kernel))
+
+
+def _elementwise_flops(module, inputs, output):
+    return output.numel()
+
+
+def _self_attention_flops(module, inputs, output):
+    # Only the batched matrix products and the softmax (the convolutions
+    # are counted on their own modules).
+    x = inputs[0]
+    positions = int(np.prod(
+        [length // module.downsampling for length in x.shape[2:]]
+    ))
+    products = 2 * 2 * len(x) * positions * positions * module.features
+    return products + 3 * len(x) * positions * positions
+
+
+# Analytic FLOP counters per module type. They are registered on the first
+# call to layer_report (to avoid importing torch with this module), and
+# new module types can be added to the dictionary.
+flop_counters = {}
+
+
+def _register_flop_counters():
+    from torch import nn
+    from layers import DownsampledSelfAttention2D
+    defaults = {
+        nn.Conv1d: _conv_flops,
+        nn.Conv2d: _conv_flops,
+        nn.Conv3d: _conv_flops,
+        nn.ConvTranspose1d: _conv_flops,
+        nn.ConvTranspose2d: _conv_flops,
+        nn.ConvTranspose3d: _conv_flops,
+        nn.Linear: _linear_flops,
+        nn.BatchNorm1d: _norm_flops,
+        nn.BatchNorm2d: _norm_flops,
+        nn.BatchNorm3d: _norm_flops,
+        nn.InstanceNorm1d: _norm_flops,
+        nn.InstanceNorm2d: _norm_flops,
+        nn.InstanceNorm3d: _norm_flops,
+        nn.GroupNorm: _norm_flops,
+        nn.MaxPool1d: _pool_flops,
+        nn.MaxPool2d: _pool_flops,
+        nn.MaxPool3d: _pool_flops,
+        nn.AvgPool1d: _pool_flops,
+        nn.AvgPool2d: _pool_flops,
+        nn.AvgPool3d: _pool_flops,
+        nn.ReLU: _elementwise_flops,
+        nn.LeakyReLU: _elementwise_flops,
+        nn.ELU: _elementwise_flops,
+        nn.Sigmoid: _elementwise_flops,
+        nn.Tanh: _elementwise_flops,
+        DownsampledSelfAttention2D: _self_attention_flops,
+    }
+    for module_type, counter in defaults.items():
+        flop_counters.setdefault(module_type, counter)
+
+
+def layer_report(model, input_shape, batch_size=1, repeats=5, sync=None):
+    """
+    Function to compute the cost of each module of a network for a given
+    input size. Forward hooks are registered on all the modules and the
+    network is run (without gradients) a few times. FLOPs are analytic
+    (only for the modules in flop_counters, functional operations on other
+    modules are not counted) and they include the submodules. Latencies
+    are measured (also including the submodules) and averaged over the
+    repetitions.
+    :param model: Network (a BaseModel or any other nn.Module).
+    :param input_shape: Shape of one input sample (channels, rows, columns).
+    :param batch_size: Number of samples per forward pass.
+    :param repeats: Number of timed forward passes (after one warmup).
+    :param sync: Whether to synchronise the cuda device on each hook (for
+     asynchronous kernels). By default, it's enabled if cuda is available.
+    :return: List of dictionaries (one per module) with the name, type,
+     depth, number of parameters, FLOPs, latency (ms) and output bytes.
+    """
+    import torch
+    _register_flop_counters()
+    if sync is None:
+        sync = torch.cuda.is_available()
+    device = getattr(model, 'device', torch.device('cpu'))
+    modules = list(model.named_modules())
+    costs = {
+        name: {
+            'name': name if name else type(model).__name__,
+            'type': type(module).__name__,
+            'depth': 0 if not name else name.count('.') + 1,
+            'params': sum(p.numel() for p in module.parameters()),
+            'self_flops': 0,
+            'flops': 0,
+            'time': 0.,
+            'calls': 0,
+            'output_bytes': 0,
+        }
+        for name, module in modules
+    }
+    starts = {}
+    recording = {'on': False}
+
+    def pre_hook(name, module, inputs):
+        if sync:
+            torch.cuda.synchronize()
+        starts.setdefault(name, []).append(time.perf_counter())
+
+    def hook(name, module, inputs, output):
+        if sync:
+            torch.cuda.synchronize()
+        elapsed = time.perf_counter() - starts[name].pop()
+        if recording['on']:
+            cost = costs[name]
+            cost['time'] += elapsed
+            cost['calls'] += 1
+            outputs = _tensors(output)
+            cost['output_bytes'] += sum(
+                o.numel() * o.element_size() for o in outputs
+            )
+            counter = flop_counters.get(type(module))
+            if counter is not None and outputs:
+                cost['self_flops'] += int(counter(module, inputs, outputs[0]))
+
+    handles = []
+    for name, module in modules:
+        handles.append(module.register_forward_pre_hook(
+            lambda m, i, name=name: pre_hook(name, m, i)
+        ))
+        handles.append(module.register_forward_hook(
+            lambda m, i, o, name=name: hook(name, m, i, o)
+        ))
+
+    was_training = model.training
+    model.eval()
+    x = torch.rand((batch_size,) + tuple(input_shape), device=device)
+    try:
+        with torch.no_grad():
+            model(x)
+            recording['on'] = True
+            for _ in range(repeats):
+                model(x)
+    finally:
+        for handle in handles:
+            handle.remove()
+        model.train(was_training)
+
+    # FLOPs are accumulated bottom-up (the deepest modules first).
+    for name, _ in sorted(modules, key=lambda m: -m[0].count('.')):
+        cost = costs[name]
+        cost['flops'] += cost['self_flops']
+        if name:
+            parent = name.rsplit('.', 1)[0] if '.' in name else ''
+            costs[parent]['flops'] += cost['flops']
+
+    report = []
+    for name, _ in modules:
+        cost = costs[name]
+        report.append({
+            'name': cost['name'],
+            'type': cost['type'],
+            'depth': cost['depth'],
+            'params': cost['params'],
+            'flops': cost['flops'] // repeats,
+            'latency_ms': 1e3 * cost['time'] / repeats,
+            'output_bytes': cost['output_bytes'] // repeats,
+            'calls': cost['calls'] // repeats,
+        })
+
+    return report
+
+
+def layer_table(report, max_depth=None):
+    """
+    Function to format a layer report as a text table.
+    :param report: Report from layer_report.
+    :param max_depth: Maximum module depth to show (None shows all).
+    :return: The table as a string.
+    """
+    hdr = '{:<48s} {:<24s} {:>10s} {:>10s} {:>10s} {:>10s}'
+    row = '{:<48s} {:<24s} {:>10d} {:>10.3f} {:>10.3f} {:>10.2f}'
+    lines = [
+        hdr.format(
+            'Module', 'Type', 'Params', 'GFLOPs', 'ms', 'Out MB'
+        ),
+        '-' * 117
+    ]
+    for r in report:
+        if max_depth is not None and r['depth'] > max_depth:
+            continue
+        name = '  ' * r['depth'] + r['name'].split('.')[-1]
+        lines.append(row.format(
+            name[:48], r['type'][:24], r['params'], r['flops'] / 1e9,
+            r['latency_ms'], r['output_bytes'] / 2 ** 20
+        ))
+    return '\n'.join(lines)
+
+
+def parse_inputs():
+    parser = argparse.ArgumentParser(
+        description='Per-layer cost report for the networks.'
+    )
+    parser.add_argument(
+        '-n', '--network',
+        dest='network', default='unet',
+        choices=['unet', 'autoencoder', 'attention', 'trans'],
+        help='Network to profile'
+    )
+    parser.add_argument(
+        '-b', '--block',
+        dest='block', default='conv',
+        choices=['conv', 'double', 'res'],
+        help='Main block of the autoencoders'
+    )
+    parser.add_argument(
+        '-f', '--filters',
+        dest='filters', type=int, nargs='+', default=[32, 64, 128, 256],
+        help='Convolutional filters'
+    )
+    parser.add_argument(
+        '-i', '--input-shape',
+        dest='input_shape', type=int, nargs='+', default=[4, 256, 256],
+        help='Shape of one input sample (channels, rows, columns)'
+    )
+    parser.add_argument(
+        '-B', '--batch-size',
+        dest='batch_size', type=int, default=1,
+        help='Number of samples per forward pass'
+    )
+    parser.add_argument(
+        '--heads',
+        dest='heads', type=int, default=8,
+        help='Number of heads (TransAutoencoder)'
+    )
+    parser.add_argument(
+        '--regions',
+        dest='regions', type=int, default=4,
+        help='Number of attention gate regions (attention autoencoders)'
+    )
+    parser.add_argument(
+        '-d', '--max-depth',
+        dest='max_depth', type=int, default=None,
+        help='Maximum module depth on the table'
+    )
+    parser.add_argument(
+        '-o', '--output',
+        dest='output', default=None,
+        help='JSON file to store the report'
+    )
+
+    options = vars(parser.parse_args())
+    if options['regions'] < 1:
+        parser.error('--regions must be at least 1')
+
+    return options
+
+
+def main():
+    options = parse_inputs()
+    from base import Conv2dBlock, DoubleConv2dBlock, ResConv2dBlock
+    from base import Autoencoder, AttentionAutoencoder, TransAutoencoder
+    from models import Unet2D
+    n_inputs = options['input_shape'][0]
+    filters = options['filters']
+    block = {
+        'conv': Conv2dBlock,
+        'double': DoubleConv2dBlock,
+        'res': ResConv2dBlock,
+    }[options['block']]
+    networks = {
+        'unet': lambda: Unet2D(filters, n_inputs=n_inputs),
+        'autoencoder': lambda: Autoencoder(
+            filters, n_inputs, block=block
+        ),
+        'attention': lambda: AttentionAutoencoder(
+            filters, n_inputs, block=block, att_regions=options['regions']
+        ),
+        'trans': lambda: TransAutoencoder(
+            filters, n_inputs, block=block, heads=options['heads'],
+            att_regions=options['regions']
+        ),
+    }
+    net = networks[options['network']]()
+    report = layer_report(
+        net, options['input_shape'], options['batch_size']
+    )
+    print(layer_table(report, options['max_depth']))
+    if options['output'] is not None:
+        with open(options['output'], 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,360 @@
+import json
+import os
+import threading
+import zlib
+from collections import OrderedDict
+import cv2
+import numpy as np
+from utils import downsample_mask
+
+
+def _level_name(ratio):
+    return 'level{:d}.bin'.format(ratio)
+
+
+def _reduce(array, ratio, reduction='mean'):
+    """
+    Function to downsample an image (rows, columns, channels) by an integer
+    ratio.
+    :param array: Image to downsample.
+    :param ratio: Downsampling ratio.
+    :param reduction: Either 'mean' (area interpolation, for images) or
+     'max' (block maximum, for binary labels).
+    :return: The downsampled image.
+    """
+    if ratio == 1:
+        return array
+    if reduction == 'max':
+        return np.stack(
+            [
+                downsample_mask(array[..., ch], ratio)
+                for ch in range(array.shape[-1])
+            ], -1
+        ).astype(array.dtype)
+    else:
+        shape = (array.shape[1] // ratio, array.shape[0] // ratio)
+        reduced = cv2.resize(array, shape, interpolation=cv2.INTER_AREA)
+        return reduced.reshape(shape[::-1] + (array.shape[-1],))
+
+
+def write_pyramid(
+        array, path, ratios=(1, 2, 4, 8, 16), tile_size=256,
+        reduction='mean', compression=1, **metadata
+):
+    """
+    Function to store an image as a tiled multi-resolution pyramid. Each
+    level is a single file with all its tiles (row major order) and the
+    offsets of each tile are stored in a JSON header. That way reading a
+    tile is just a seek and a read (and a decompression if needed).
+    Border tiles are padded with zeros to the full tile size.
+    :param array: Image to store (rows, columns[, channels]).
+    :param path: Folder for the pyramid.
+    :param ratios: Downsampling ratios for the levels.
+    :param tile_size: Side of the square tiles.
+    :param reduction: Either 'mean' (images) or 'max' (binary labels).
+    :param compression: zlib compression level (0 for raw tiles).
+    :param metadata: Extra metadata for the header (source file, etc.).
+    :return: The header of the pyramid.
+    """
+    if array.ndim == 2:
+        array = np.expand_dims(array, -1)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    levels = {}
+    for ratio in ratios:
+        level = _reduce(array, ratio, reduction)
+        rows, cols = level.shape[:2]
+        t_rows = -(-rows // tile_size)
+        t_cols = -(-cols // tile_size)
+        padded = np.zeros(
+            (t_rows * tile_size, t_cols * tile_size, level.shape[-1]),
+            dtype=array.dtype
+        )
+        padded[:rows, :cols] = level
+        offsets = []
+        offset = 0
+        with open(os.path.join(path, _level_name(ratio)), 'wb') as f:
+            for ti in range(t_rows):
+                for tj in range(t_cols):
+                    tile = np.ascontiguousarray(padded[
+                        ti * tile_size:(ti + 1) * tile_size,
+                        tj * tile_size:(tj + 1) * tile_size
+                    ]).tobytes()
+                    if compression > 0:
+                        tile = zlib.compress(tile, compression)
+                    f.write(tile)
+                    offsets.append([offset, len(tile)])
+                    offset += len(tile)
+        levels[str(ratio)] = {
+            'shape': [rows, cols],
+            'tiles': [t_rows, t_cols],
+            'offsets': offsets,
+        }
+
+    header = {
+        'shape': list(array.shape),
+        'dtype': array.dtype.str,
+        'tile_size': tile_size,
+        'compression': compression,
+        'reduction': reduction,
+        'levels': levels,
+        'metadata': metadata,
+    }
+    with open(os.path.join(path, 'pyramid.json'), 'w') as f:
+        json.dump(header, f)
+
+    return header
+
+
+def read_header(path):
+    """
+    Function to read the header of a pyramid.
+    :param path: Folder of the pyramid.
+    :return: The header dictionary or None if there is no (valid) pyramid.
+    """
+    try:
+        with open(os.path.join(path, 'pyramid.json')) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def convert_image(
+        filename, path, ratios=(1, 2, 4, 8, 16), tile_size=256,
+        label_threshold=None, compression=1
+):
+    """
+    Function to convert an image file into a tiled pyramid. The conversion
+    is skipped if the pyramid already exists and its source (size and
+    modification time) has not changed.
+    :param filename: Image to convert.
+    :param path: Folder for the pyramid.
+    :param ratios: Downsampling ratios for the levels.
+    :param tile_size: Side of the square tiles.
+    :param label_threshold: If not None, the image is converted into a
+     binary label (mean intensity below the threshold) and the levels are
+     computed with a block maximum.
+    :param compression: zlib compression level (0 for raw tiles).
+    :return: The header of the pyramid.
+    """
+    stat = os.stat(filename)
+    source = {
+        'source': os.path.basename(filename),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'label_threshold': label_threshold,
+    }
+    header = read_header(path)
+    if header is not None and header['metadata'] == source and all(
+        str(r) in header['levels'] for r in ratios
+    ):
+        return header
+    im = cv2.imread(filename)
+    if label_threshold is None:
+        reduction = 'mean'
+    else:
+        im = (np.mean(im, axis=-1) < label_threshold).astype(np.uint8)
+        reduction = 'max'
+    return write_pyramid(
+        im, path, ratios, tile_size, reduction, compression, **source
+    )
+
+
+class TiledPyramid(object):
+    """
+    Reader for tiled pyramids. Tiles are read on demand and kept on a
+    least recently used cache, so arbitrary windows can be read at any
+    level without decoding the whole image. Readers can be pickled
+    (for DataLoader workers) and each process reopens its own files.
+    """
+    def __init__(self, path, cache_tiles=256):
+        self.path = path
+        self.cache_tiles = cache_tiles
+        self.header = read_header(path)
+        if self.header is None:
+            raise IOError('No tiled pyramid found in {:}'.format(path))
+        self.tile_size = self.header['tile_size']
+        self.dtype = np.dtype(self.header['dtype'])
+        self.channels = self.header['shape'][-1]
+        self.ratios = sorted(int(r) for r in self.header['levels'])
+        self._files = {}
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_files'] = {}
+        state['_cache'] = OrderedDict()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def level_shape(self, ratio=1):
+        """
+        :param ratio: Downsampling ratio of the level.
+        :return: The shape of the level (rows, columns, channels).
+        """
+        level = self.header['levels'][str(ratio)]
+        return tuple(level['shape']) + (self.channels,)
+
+    def _read_tile(self, ratio, ti, tj):
+        level = self.header['levels'][str(ratio)]
+        offset, length = level['offsets'][ti * level['tiles'][1] + tj]
+        f = self._files.get(ratio)
+        if f is None:
+            f = open(os.path.join(self.path, _level_name(ratio)), 'rb')
+            self._files[ratio] = f
+        # pread does not share the file offset, so forked workers can
+        # safely use inherited file objects.
+        buffer = os.pread(f.fileno(), length, offset)
+        if self.header['compression'] > 0:
+            buffer = zlib.decompress(buffer)
+        return np.frombuffer(buffer, dtype=self.dtype).reshape(
+            (self.tile_size, self.tile_size, self.channels)
+        )
+
+    def tile(self, ratio, ti, tj):
+        """
+        Function to get a tile through the LRU cache.
+        :param ratio: Downsampling ratio of the level.
+        :param ti: Tile row.
+        :param tj: Tile column.
+        :return: The (padded) tile.
+        """
+        key = (ratio, ti, tj)
+        with self._lock:
+            tile = self._cache.get(key)
+            if tile is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return tile
+            self.misses += 1
+            tile = self._read_tile(ratio, ti, tj)
+            self._cache[key] = tile
+            if len(self._cache) > self.cache_tiles:
+                self._cache.popitem(last=False)
+        return tile
+
+    def read_window(self, rows, cols, ratio=1):
+        """
+        Function to read a window from a given level. Only the tiles that
+        overlap the window are read.
+        :param rows: Slice of rows (on the level coordinates).
+        :param cols: Slice of columns (on the level coordinates).
+        :param ratio: Downsampling ratio of the level.
+        :return: The window (rows, columns, channels).
+        """
+        shape = self.level_shape(ratio)
+        r_ini, r_end, _ = rows.indices(shape[0])
+        c_ini, c_end, _ = cols.indices(shape[1])
+        window = np.zeros(
+            (max(r_end - r_ini, 0), max(c_end - c_ini, 0), self.channels),
+            dtype=self.dtype
+        )
+        ts = self.tile_size
+        for ti in range(r_ini // ts, -(-r_end // ts)):
+            for tj in range(c_ini // ts, -(-c_end // ts)):
+                tile = self.tile(ratio, ti, tj)
+                t_r_ini = max(r_ini, ti * ts)
+                t_r_end = min(r_end, (ti + 1) * ts)
+                t_c_ini = max(c_ini, tj * ts)
+                t_c_end = min(c_end, (tj + 1) * ts)
+                window[
+                    t_r_ini - r_ini:t_r_end - r_ini,
+                    t_c_ini - c_ini:t_c_end - c_ini
+                ] = tile[
+                    t_r_ini - ti * ts:t_r_end - ti * ts,
+                    t_c_ini - tj * ts:t_c_end - tj * ts
+                ]
+        return window
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+
+class PyramidView(object):
+    """
+    Array-like view of one level of one or more pyramids (their channels are
+    concatenated). It has a shape and supports basic slicing with a
+    channels-first layout (channels, rows, columns), so it can replace the
+    numpy arrays used by Cropping2DDataset and Unet2D.test. Only the tiles
+    needed for each window are read. Optionally, each channel can be
+    normalised with a mean and a standard deviation. With a single channel
+    and squeeze=True, the view is 2D (like the label masks).
+    """
+    def __init__(
+            self, pyramids, ratio=1, channels=None, mean=None, std=None,
+            squeeze=False
+    ):
+        if isinstance(pyramids, TiledPyramid):
+            pyramids = [pyramids]
+        if channels is None:
+            channels = [list(range(p.channels)) for p in pyramids]
+        self.pyramids = pyramids
+        self.ratio = ratio
+        self.channels = [list(ch) for ch in channels]
+        self.n_channels = sum(len(ch) for ch in self.channels)
+        self.mean = None if mean is None else np.reshape(mean, (-1, 1, 1))
+        self.std = None if std is None else np.reshape(std, (-1, 1, 1))
+        self.squeeze = squeeze and self.n_channels == 1
+        rows, cols = self.pyramids[0].level_shape(ratio)[:2]
+        if self.squeeze:
+            self.shape = (rows, cols)
+        else:
+            self.shape = (self.n_channels, rows, cols)
+        self.ndim = len(self.shape)
+        self.dtype = np.float32 if mean is not None else \
+            self.pyramids[0].dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (self.ndim - len(key))
+        if self.squeeze:
+            ch_key, rows, cols = slice(None), key[0], key[1]
+        else:
+            ch_key, rows, cols = key
+        for s in (rows, cols):
+            if not isinstance(s, slice) or s.step not in (None, 1):
+                raise IndexError('Only contiguous slices are supported')
+        window = np.concatenate(
+            [
+                p.read_window(rows, cols, self.ratio)[..., ch]
+                for p, ch in zip(self.pyramids, self.channels)
+            ], -1
+        )
+        window = np.moveaxis(window, -1, 0)
+        if self.mean is not None:
+            window = (window - self.mean) / self.std
+            window = window.astype(np.float32)
+        window = window[ch_key]
+        if self.squeeze:
+            window = window[0]
+        return window
+
+    def __array__(self, dtype=None, copy=None):
+        array = self[(slice(None),) * self.ndim]
+        return array if dtype is None else array.astype(dtype)
+
+    def stats(self):
+        """
+        Function to compute the mean and standard deviation per channel.
+        To avoid reading the whole level, they are computed on the coarsest
+        level of the pyramids.
+        :return: The mean and standard deviation per channel.
+        """
+        coarse = PyramidView(
+            self.pyramids, self.pyramids[0].ratios[-1], self.channels
+        )
+        data = np.asarray(coarse).reshape((coarse.n_channels, -1))
+        return np.mean(data, axis=-1), np.std(data, axis=-1)
@@ -0,0 +1,517 @@
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context, shared_memory
+import numpy as np
+from utils import color_codes, time_to_string, build_manifest
+from utils import peaks_from_probability
+from metrics import PointSetMatcher
+from pipeline import Pipeline
+from profiling import StageTimer
+from tree_detection import add_data_stages, gt_points
+
+
+def parse_inputs():
+    parser = argparse.ArgumentParser(
+        description='Hyperparameter sweep for the tree detection network.'
+    )
+    parser.add_argument(
+        '-d', '--mosaics-directory',
+        dest='val_dir', required=True,
+        help='Directory containing the mosaics'
+    )
+    parser.add_argument(
+        '-l', '--labels-tag',
+        dest='lab_tag', default='top',
+        help='Tag to be found on all the ground truth filenames'
+    )
+    parser.add_argument(
+        '--dem',
+        dest='dem', default='nDEM',
+        help='Name of the DEM'
+    )
+    parser.add_argument(
+        '-r', '--ratios',
+        dest='ratios', type=int, nargs='+', default=[10],
+        help='Downsampling ratios'
+    )
+    parser.add_argument(
+        '-t', '--patch-sizes',
+        dest='patch_sizes', type=int, nargs='+', default=[64],
+        help='Patch sizes'
+    )
+    parser.add_argument(
+        '-o', '--overlaps',
+        dest='overlaps', type=int, nargs='+', default=[32],
+        help='Overlaps between patches'
+    )
+    parser.add_argument(
+        '-f', '--filters',
+        dest='filters', nargs='+', default=['32,64,128,256'],
+        help='Filters of the Unet (comma separated list per configuration)'
+    )
+    parser.add_argument(
+        '-B', '--batch-sizes',
+        dest='batch_sizes', type=int, nargs='+', default=[32],
+        help='Number of samples per batch'
+    )
+    parser.add_argument(
+        '-e', '--epochs',
+        dest='epochs', type=int, default=20,
+        help='Number of epochs'
+    )
+    parser.add_argument(
+        '-p', '--patience',
+        dest='patience', type=int, default=5,
+        help='Patience for early stopping'
+    )
+    parser.add_argument(
+        '-F', '--folds',
+        dest='folds', type=int, default=None,
+        help='Number of cross-validation folds per configuration (the first '
+             'cases are used as test cases). By default, all the cases'
+    )
+    parser.add_argument(
+        '-j', '--workers',
+        dest='workers', type=int, default=2,
+        help='Number of configurations trained at the same time'
+    )
+    parser.add_argument(
+        '--threads',
+        dest='threads', type=int, default=None,
+        help='Number of threads per worker. By default, the CPUs are '
+             'split between the workers'
+    )
+    parser.add_argument(
+        '--cache',
+        dest='cache', default=None,
+        help='Folder for the results of the data stages. By default, it '
+             'is the .pipeline folder inside the mosaics directory (shared '
+             'with tree_detection)'
+    )
+    parser.add_argument(
+        '--results',
+        dest='results', default=None,
+        help='JSON file for the results table. By default, it is written '
+             'to the mosaics directory'
+    )
+    parser.add_argument(
+        '-v', '--verbose',
+        dest='verbose', action='store_true', default=False,
+        help='Whether to show the output of the workers'
+    )
+
+    options = vars(parser.parse_args())
+
+    return options
+
+
+"""
+Shared data
+"""
+
+
+def share_arrays(arrays):
+    """
+    Function to copy a list of arrays into shared memory blocks.
+    :param arrays: List of numpy arrays.
+    :return: The list of shared memory blocks (they must be kept alive and
+     unlinked by the caller) and the list of specifications (name, shape,
+     dtype) to attach them.
+    """
+    blocks = []
+    specs = []
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        block = shared_memory.SharedMemory(
+            create=True, size=max(array.nbytes, 1)
+        )
+        shared = np.ndarray(array.shape, array.dtype, buffer=block.buf)
+        shared[...] = array
+        blocks.append(block)
+        specs.append((block.name, array.shape, array.dtype.str))
+    return blocks, specs
+
+
+def attach_arrays(specs):
+    """
+    Function to attach to the shared memory blocks created by share_arrays
+    (read only, without copies).
+    :param specs: List of specifications (name, shape, dtype).
+    :return: The list of shared memory blocks and the list of arrays.
+    """
+    blocks = []
+    arrays = []
+    for name, shape, dtype in specs:
+        # Spawned workers share the resource tracker of the parent, so the
+        # blocks are only unlinked by their creator.
+        block = shared_memory.SharedMemory(name=name)
+        array = np.ndarray(shape, np.dtype(dtype), buffer=block.buf)
+        array.flags.writeable = False
+        blocks.append(block)
+        arrays.append(array)
+    return blocks, arrays
+
+
+# Data of each worker process (set by _init_worker).
+_worker_data = {}
+
+
+def _init_worker(data_specs, threads, verbose):
+    """
+    Function to initialise a worker: thread limits for all the numerical
+    libraries (they must be set before importing them) and views of the
+    shared data.
+    :param data_specs: Dictionary with the specifications of the shared
+     arrays (inputs and labels) and the ground truth of each ratio.
+    :param threads: Number of threads for the worker.
+    :param verbose: Whether to keep the output of the worker.
+    :return: None.
+    """
+    for var in [
+        'OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'
+    ]:
+        os.environ[var] = str(threads)
+    import cv2
+    import torch
+    cv2.setNumThreads(threads)
+    torch.set_num_threads(threads)
+    if not verbose:
+        sys.stdout = open(os.devnull, 'w')
+    for ratio, spec in data_specs.items():
+        blocks, arrays = attach_arrays(spec['x'] + spec['y'])
+        n_cases = len(spec['x'])
+        _worker_data[ratio] = {
+            'blocks': blocks,
+            'x': arrays[:n_cases],
+            'y': arrays[n_cases:],
+            'gt': spec['gt'],
+            'shapes': spec['shapes'],
+            'indices': {},
+        }
+
+
+def run_config(config, folds, epochs, patience, val_split=0.1):
+    """
+    Function to train and test one configuration with a leave-one-mosaic-out
+    cross-validation on the shared data of a worker.
+    :param config: Dictionary with the configuration (ratio, patch_size,
+     overlap, filters and batch_size).
+    :param folds: Indices of the test cases.
+    :param epochs: Number of epochs.
+    :param patience: Patience for early stopping.
+    :param val_split: Fraction of the training cases used for validation.
+    :return: Dictionary with the configuration, the metrics (averaged over
+     the folds) and the wall time.
+    """
+    from torch.utils.data import DataLoader
+    from datasets import PatchIndex, IndexedPatchDataset
+    from models import Unet2D
+    t_start = time.time()
+    data = _worker_data[config['ratio']]
+    patch_size = (config['patch_size'],) * 2
+    overlap = (config['overlap'],) * 2
+    # The patch index is built once per worker for each patch size and
+    # overlap (other parameters share it), folds are just index arrays.
+    index_key = (patch_size, overlap)
+    index = data['indices'].get(index_key)
+    if index is None:
+        index = PatchIndex(data['y'], patch_size, overlap)
+        data['indices'][index_key] = index
+    metrics = []
+    for i in folds:
+        # Same splits as tree_detection (PatchIndex.fold).
+        fold = index.fold(i, val_split, filtered=True)
+        train_dataset = IndexedPatchDataset(
+            data['x'], data['y'], index, fold['train']
+        )
+        val_dataset = IndexedPatchDataset(
+            data['x'], data['y'], index, fold['val']
+        )
+        # Workers are already running in parallel (and the data is in
+        # memory), so the batches are loaded on the main thread.
+        train_dataloader = DataLoader(
+            train_dataset, config['batch_size'], True, num_workers=0
+        )
+        val_dataloader = DataLoader(
+            val_dataset, config['batch_size'], num_workers=0
+        )
+
+        net = Unet2D(
+            conv_filters=config['filters'], n_inputs=len(data['x'][i])
+        )
+        net.fit(
+            train_dataloader, val_dataloader, epochs=epochs,
+            patience=patience, verbose=False
+        )
+        _, val_losses = net.validate(val_dataloader)
+        dsc_index = [l_f['name'] for l_f in net.val_functions].index('dsc')
+
+        pred, _ = net.test([data['x'][i]], patch_size=None, verbose=False)
+        pred = pred[0]
+        label = data['y'][i] > 0
+        seg = pred > 0.5
+        test_dsc = 2 * np.sum(seg & label) / max(
+            np.sum(seg) + np.sum(label), 1
+        )
+
+        gt_list = data['gt'][i]
+        unet_list = peaks_from_probability(pred, data['shapes'][i])
+        matcher = PointSetMatcher(gt_list, unet_list)
+        metrics.append({
+            'val_dsc': 1 - float(val_losses[dsc_index]),
+            'test_dsc': float(test_dsc),
+            'epochs': net.epoch + 1,
+            'n_pred': len(unet_list),
+            'n_gt': len(gt_list),
+            'match': matcher.matched_percentage(150),
+            'inverse_match': matcher.matched_percentage(150, inverse=True),
+            'diff': 100 * (len(gt_list) - len(unet_list)) / max(
+                len(gt_list), 1
+            ),
+            'hausdorf': matcher.hausdorf_distance(),
+            'euclidean': matcher.avg_euclidean_distance(),
+        })
+
+    row = dict(config)
+    for k in metrics[0]:
+        row[k] = float(np.mean([m[k] for m in metrics]))
+    row['folds'] = len(metrics)
+    row['wall_s'] = time.time() - t_start
+    return row
+
+
+"""
+Sweep
+"""
+
+
+def config_grid(ratios, patch_sizes, overlaps, filters, batch_sizes):
+    """
+    Function to build all the valid configurations of a sweep (overlaps
+    must be smaller than the patch size).
+    :param ratios: Downsampling ratios.
+    :param patch_sizes: Patch sizes.
+    :param overlaps: Overlaps between patches.
+    :param filters: Lists of filters.
+    :param batch_sizes: Batch sizes.
+    :return: List of configurations (dictionaries).
+    """
+    return [
+        {
+            'ratio': ratio,
+            'patch_size': patch_size,
+            'overlap': overlap,
+            'filters': list(filters_i),
+            'batch_size': batch_size,
+        }
+        for ratio, patch_size, overlap, filters_i, batch_size in
+        itertools.product(
+            ratios, patch_sizes, overlaps, filters, batch_sizes
+        )
+        if overlap < patch_size
+    ]
+
+
+def load_data(
+        pipeline, d_path, manifest, cases, gt_names, dem_name, ratios
+):
+    """
+    Function to load (or compute) the normalised inputs and labels of all
+    the cases for each ratio with the data stages of tree_detection, and to
+    copy them into shared memory.
+    :param pipeline: Pipeline for the data stages.
+    :param d_path: Folder with the mosaics.
+    :param manifest: Manifest of the mosaics folder.
+    :param cases: Case identifiers.
+    :param gt_names: Names of the ground truth files.
+    :param dem_name: Name of the DEM.
+    :param ratios: Downsampling ratios.
+    :return: The list of shared memory blocks and the dictionary with the
+     specifications of the shared data per ratio.
+    """
+    gt = [
+        gt_points(os.path.join(d_path, gt_name)) for gt_name in gt_names
+    ]
+    blocks = []
+    data_specs = {}
+    for ratio in ratios:
+        x_stages, y_stages = add_data_stages(
+            pipeline, d_path, manifest, cases, gt_names, dem_name, ratio
+        )
+        results = pipeline.run(x_stages + y_stages)
+        ratio_blocks, specs = share_arrays(
+            [results[name] for name in x_stages + y_stages]
+        )
+        del results
+        blocks += ratio_blocks
+        data_specs[ratio] = {
+            'x': specs[:len(x_stages)],
+            'y': specs[len(x_stages):],
+            'gt': [points for points, _ in gt],
+            'shapes': [shape for _, shape in gt],
+        }
+    return blocks, data_specs
+
+
+def sweep(
+        configs, data_specs, folds, epochs, patience, workers=2,
+        threads=None, verbose=False
+):
+    """
+    Function to run a list of configurations concurrently. All the workers
+    share the same data (no copies) and each one has a limited number of
+    threads to avoid oversubscription.
+    :param configs: List of configurations.
+    :param data_specs: Specifications of the shared data per ratio.
+    :param folds: Indices of the test cases.
+    :param epochs: Number of epochs.
+    :param patience: Patience for early stopping.
+    :param workers: Number of worker processes.
+    :param threads: Number of threads per worker. By default, the CPUs are
+     split between the workers.
+    :param verbose: Whether to show the output of the workers.
+    :return: List of results (one row per configuration, in the same
+     order).
+    """
+    c = color_codes()
+    if threads is None:
+        threads = max(os.cpu_count() // workers, 1)
+    rows = [None] * len(configs)
+    # Workers are spawned (not forked), so they get fresh thread pools with
+    # the right limits.
+    with ProcessPoolExecutor(
+        workers, mp_context=get_context('spawn'),
+        initializer=_init_worker,
+        initargs=(data_specs, threads, verbose)
+    ) as pool:
+        futures = {
+            pool.submit(run_config, config, folds, epochs, patience): i
+            for i, config in enumerate(configs)
+        }
+        for n, future in enumerate(as_completed(futures)):
+            i = futures[future]
+            rows[i] = future.result()
+            print(
+                '{:}[{:}]{:} Configuration {:d}/{:d} finished ({:}){:}'
+                .format(
+                    c['c'], time.strftime("%H:%M:%S"), c['g'], n + 1,
+                    len(configs), time_to_string(rows[i]['wall_s']), c['nc']
+                )
+            )
+    return rows
+
+
+def results_table(rows):
+    """
+    Function to format the results of a sweep as a text table.
+    :param rows: List of results.
+    :return: The table as a string.
+    """
+    columns = [
+        ('ratio', '{:d}'), ('patch_size', '{:d}'), ('overlap', '{:d}'),
+        ('filters', '{:}'), ('batch_size', '{:d}'),
+        ('val_dsc', '{:.4f}'), ('test_dsc', '{:.4f}'),
+        ('match', '{:.2f}'), ('inverse_match', '{:.2f}'),
+        ('diff', '{:.2f}'), ('epochs', '{:.1f}'), ('wall_s', '{:.1f}'),
+    ]
+    cells = [
+        [
+            fmt.format(
+                ','.join(str(f) for f in row[name]) if name == 'filters'
+                else row[name]
+            ) for name, fmt in columns
+        ] for row in rows
+    ]
+    widths = [
+        max([len(name)] + [len(r[i]) for r in cells])
+        for i, (name, _) in enumerate(columns)
+    ]
+    lines = [
+        ' | '.join(
+            name.rjust(w) for (name, _), w in zip(columns, widths)
+        )
+    ]
+    lines.append('-' * len(lines[0]))
+    for r in cells:
+        lines.append(' | '.join(v.rjust(w) for v, w in zip(r, widths)))
+    return '\n'.join(lines)
+
+
+def main():
+    # Init
+    options = parse_inputs()
+    c = color_codes()
+    timer = StageTimer()
+    d_path = options['val_dir']
+    dem_name = options['dem']
+    manifest = build_manifest(d_path, options['lab_tag'])
+    cases = [c_i for c_i in manifest if dem_name in manifest[c_i]['dems']]
+    gt_names = [manifest[c_i]['gt']['name'] for c_i in cases]
+    folds = list(range(len(cases)))
+    if options['folds'] is not None:
+        folds = folds[:options['folds']]
+    configs = config_grid(
+        options['ratios'], options['patch_sizes'], options['overlaps'],
+        [[int(f) for f in fs.split(',')] for fs in options['filters']],
+        options['batch_sizes']
+    )
+
+    print(
+        '{:}[{:}]{:} Loading {:d} cases ({:} ratios: {:}){:}'.format(
+            c['c'], time.strftime("%H:%M:%S"), c['g'], len(cases), dem_name,
+            options['ratios'], c['nc']
+        )
+    )
+    cache_dir = options['cache']
+    if cache_dir is None:
+        cache_dir = os.path.join(d_path, '.pipeline')
+    pipeline = Pipeline(cache_dir, timer)
+    with timer.stage('loading'):
+        blocks, data_specs = load_data(
+            pipeline, d_path, manifest, cases, gt_names, dem_name,
+            options['ratios']
+        )
+
+    print(
+        '{:}[{:}]{:} Running {:d} configurations ({:d} folds each, {:d} '
+        'workers){:}'.format(
+            c['c'], time.strftime("%H:%M:%S"), c['g'], len(configs),
+            len(folds), options['workers'], c['nc']
+        )
+    )
+    try:
+        with timer.stage('sweep'):
+            rows = sweep(
+                configs, data_specs, folds, options['epochs'],
+                options['patience'], options['workers'], options['threads'],
+                options['verbose']
+            )
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    timer.close()
+
+    print(results_table(rows))
+    results_file = options['results']
+    if results_file is None:
+        results_file = os.path.join(
+            d_path, 'sweep.{:}.json'.format(
+                time.strftime('%Y%m%d-%H%M%S', time.localtime(timer.t_start))
+            )
+        )
+    with open(results_file, 'w') as f:
+        json.dump(
+            {'options': options, 'results': rows, 'timer': timer.summary()},
+            f, indent=1
+        )
+    print('{:}Results{:} ({:})'.format(c['b'], c['nc'], results_file))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+import argparse
+import os
+import cv2
+import numpy as np
+from scipy import ndimage as nd
+from utils import color_codes, build_manifest
+
+
+def parse_inputs():
+    parser = argparse.ArgumentParser(
+        description='Synthetic mosaics, DEMs and tree top annotations.'
+    )
+    parser.add_argument(
+        '-d', '--output-directory',
+        dest='output_dir', required=True,
+        help='Directory for the synthetic cases'
+    )
+    parser.add_argument(
+        '-n', '--cases',
+        dest='cases', type=int, default=3,
+        help='Number of cases'
+    )
+    parser.add_argument(
+        '-s', '--shape',
+        dest='shape', type=int, nargs=2, default=[4000, 4000],
+        help='Shape of the mosaics (rows, columns)'
+    )
+    parser.add_argument(
+        '-t', '--density',
+        dest='density', type=float, default=2e-4,
+        help='Number of trees per pixel'
+    )
+    parser.add_argument(
+        '-r', '--seed',
+        dest='seed', type=int, default=42,
+        help='Random seed'
+    )
+
+    options = vars(parser.parse_args())
+
+    return options
+
+
+def synthetic_case(
+        d_path, case, shape=(4000, 4000), density=2e-4, radii=(8, 30),
+        top_radius=3, seed=42
+):
+    """
+    Function to create a synthetic case with the same files as the real
+    ones: the mosaic (Z{case}.jpg), the DEM (Z{case}DEM.jpg), the normalised
+    DEM (Z{case}nDEM.jpg) and the tree top annotations (top{case}.jpg,
+    black dots on a white background). Trees are paraboloid crowns of
+    random radius and height on a smooth terrain, and their colour depends
+    on the crown height (with some texture noise).
+    :param d_path: Folder for the new files.
+    :param case: Case identifier.
+    :param shape: Shape of the mosaic (rows, columns).
+    :param density: Number of trees per pixel.
+    :param radii: Minimum and maximum crown radius (in pixels).
+    :param top_radius: Radius of the annotated tree tops.
+    :param seed: Random seed.
+    :return: The tree tops (rows, columns).
+    """
+    rng = np.random.default_rng(seed)
+    n_trees = int(density * shape[0] * shape[1])
+    rows = rng.integers(0, shape[0], n_trees)
+    cols = rng.integers(0, shape[1], n_trees)
+    radius = rng.uniform(*radii, n_trees).astype(np.float32)
+    height = radius * rng.uniform(0.8, 1.2, n_trees).astype(np.float32)
+
+    if n_trees > 0:
+        # Each pixel belongs to the crown of its closest tree top (a Voronoi
+        # partition computed with a distance transform).
+        seeds = np.ones(shape, dtype=np.uint8)
+        seeds[rows, cols] = 0
+        dist, (r_idx, c_idx) = nd.distance_transform_edt(
+            seeds, return_indices=True
+        )
+        dist = dist.astype(np.float32)
+        tree_idx = np.full(shape, -1, dtype=np.int32)
+        tree_idx[rows, cols] = np.arange(n_trees)
+        closest = tree_idx[r_idx, c_idx]
+        del r_idx, c_idx, tree_idx
+        crown = np.clip(1 - (dist / radius[closest]) ** 2, 0, None)
+        ndem = crown * height[closest]
+        del dist, closest
+    else:
+        # Without trees (low densities or small mosaics) there are no
+        # crowns, just the terrain and an empty annotation.
+        crown = np.zeros(shape, dtype=np.float32)
+        ndem = np.zeros(shape, dtype=np.float32)
+
+    # Terrain: smooth random field (upsampled noise).
+    terrain = cv2.resize(
+        rng.normal(0, 1, (8, 8)).astype(np.float32), shape[::-1],
+        interpolation=cv2.INTER_CUBIC
+    ) * 20
+    dem = terrain + ndem
+
+    def to_uint8(im):
+        im = (im - im.min()) / max(im.max() - im.min(), 1e-6)
+        return (255 * im).astype(np.uint8)
+
+    ndem_u8 = to_uint8(ndem)
+    cv2.imwrite(
+        os.path.join(d_path, 'Z{:}nDEM.jpg'.format(case)),
+        cv2.merge([ndem_u8] * 3)
+    )
+    dem_u8 = to_uint8(dem)
+    cv2.imwrite(
+        os.path.join(d_path, 'Z{:}DEM.jpg'.format(case)),
+        cv2.merge([dem_u8] * 3)
+    )
+    del dem, dem_u8, terrain
+
+    # Mosaic: brown ground and green crowns (brighter near the top).
+    texture = cv2.GaussianBlur(
+        rng.normal(0, 12, shape).astype(np.float32), (0, 0), 1.5
+    )
+    ground = np.array([60, 100, 130], dtype=np.float32)
+    canopy = np.array([40, 120, 50], dtype=np.float32)
+    tree_mask = (crown > 0)[..., None]
+    colour = np.where(tree_mask, canopy, ground)
+    mosaic = colour * (0.6 + 0.6 * crown[..., None]) + texture[..., None]
+    del colour, texture, crown
+    cv2.imwrite(
+        os.path.join(d_path, 'Z{:}.jpg'.format(case)),
+        np.clip(mosaic, 0, 255).astype(np.uint8)
+    )
+    del mosaic
+
+    top = np.full(shape, 255, dtype=np.uint8)
+    for r, c in zip(rows, cols):
+        cv2.circle(top, (int(c), int(r)), top_radius, 0, -1)
+    cv2.imwrite(
+        os.path.join(d_path, 'top{:}.jpg'.format(case)),
+        cv2.merge([top] * 3)
+    )
+
+    return np.stack([rows, cols], axis=-1)
+
+
+def synthetic_dataset(
+        d_path, n_cases=3, shape=(4000, 4000), density=2e-4, seed=42
+):
+    """
+    Function to create a folder of synthetic cases (1, 2, ..., n_cases).
+    :param d_path: Folder for the new files.
+    :param n_cases: Number of cases.
+    :param shape: Shape of the mosaics (rows, columns).
+    :param density: Number of trees per pixel.
+    :param seed: Random seed (each case uses seed + case).
+    :return: The manifest of the new folder.
+    """
+    if not os.path.isdir(d_path):
+        os.makedirs(d_path)
+    for case in range(1, n_cases + 1):
+        synthetic_case(
+            d_path, case, shape, density, seed=seed + case
+        )
+    return build_manifest(d_path)
+
+
+def main():
+    options = parse_inputs()
+    c = color_codes()
+    manifest = synthetic_dataset(
+        options['output_dir'], options['cases'], tuple(options['shape']),
+        options['density'], options['seed']
+    )
+    print(
+        '{:}Created {:d} synthetic cases in {:}{:}'.format(
+            c['g'], len(manifest), options['output_dir'], c['nc']
+        )
+    )
+
+
+if __name__ == '__main__':
+    main()
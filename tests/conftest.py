@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The modules of the repository are flat scripts on the root folder.
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+)
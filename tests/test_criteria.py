@@ -0,0 +1,135 @@
+import pytest
+import torch
+from torch.nn import functional as F
+from criteria import normalise_var, normalised_xcor, normalised_xcor_loss
+from criteria import gradient
+
+
+"""
+Previous (per-sample) implementations
+"""
+
+
+def loop_normalise_var(var):
+    red_dim = tuple(range(2, len(var.shape)))
+    mean = torch.mean(var.detach(), dim=red_dim, keepdim=True)
+    std = torch.std(var.detach(), dim=red_dim, keepdim=True)
+    if (std < 1e-5).any():
+        norm = (var[std > 1e-5] - mean[std > 1e-5]) / std[std > 1e-5]
+    else:
+        norm = (var - mean) / std
+
+    return norm
+
+
+def loop_normalised_xcor(var_x, var_y):
+    var_y = var_y.to(var_x.device)
+    var_x_norm = loop_normalise_var(var_x)
+    var_y_norm = loop_normalise_var(var_y)
+
+    xcor = [
+        F.conv1d(
+            torch.unsqueeze(x_i, dim=0).view(1, len(x_i), -1),
+            torch.unsqueeze(y_i, dim=0).view(1, len(y_i), -1)
+        )
+        for x_i, y_i in zip(var_x_norm, var_y_norm)
+    ]
+
+    n_elem = var_x.numel() / len(var_x)
+    xcor = torch.mean(torch.abs(torch.cat(xcor))) / n_elem
+
+    if torch.isnan(xcor):
+        xcor = torch.tensor(1., device=xcor.device)
+
+    return xcor
+
+
+def loop_gradient(tensor):
+    tensor_dims = len(tensor.shape)
+    data_dims = tensor_dims - 2
+    all_slices = (slice(0, None),) * (tensor_dims - 1)
+    first = slice(0, -2)
+    last = slice(2, None)
+    slices = [
+        (
+            all_slices[:i + 2] + (first,) + all_slices[i + 2:],
+            all_slices[:i + 2] + (last,) + all_slices[i + 2:],
+        )
+        for i in range(data_dims)
+    ]
+    no_pad = (0, 0)
+    pad = (1, 1)
+    paddings = [
+        no_pad * i + pad + no_pad * (data_dims - i - 1)
+        for i in range(data_dims)[::-1]
+    ]
+    gradients = [
+        0.5 * F.pad(tensor[si] - tensor[sf], p)
+        for p, (si, sf) in zip(paddings, slices)
+    ]
+
+    return torch.cat(gradients, dim=1)
+
+
+"""
+Tests
+"""
+
+shapes = [(1, 1, 16, 16), (4, 3, 32, 24), (8, 2, 5, 6, 7)]
+
+
+def test_normalise_var():
+    torch.manual_seed(0)
+    for shape in shapes:
+        var = torch.rand(shape, dtype=torch.float64)
+        assert torch.allclose(normalise_var(var), loop_normalise_var(var))
+
+
+def test_normalise_var_constant_channel():
+    var = torch.rand((2, 3, 8, 8), dtype=torch.float64)
+    var[1, 2] = 0.5
+    norm = normalise_var(var)
+    assert norm.shape == var.shape
+    assert torch.all(norm[1, 2] == 0)
+    assert torch.allclose(norm[0], loop_normalise_var(var[:1])[0])
+
+
+def test_normalised_xcor():
+    torch.manual_seed(0)
+    for shape in shapes:
+        var_x = torch.rand(shape, dtype=torch.float64)
+        var_y = var_x + 0.5 * torch.rand(shape, dtype=torch.float64)
+        for var_y_i in [var_x, var_y, -var_y]:
+            assert torch.allclose(
+                normalised_xcor(var_x, var_y_i),
+                loop_normalised_xcor(var_x, var_y_i)
+            )
+
+
+# The previous implementation relies on the NaN of torch.std.
+@pytest.mark.filterwarnings('ignore:std')
+def test_normalised_xcor_single_element():
+    var_x = torch.rand((4, 3, 1, 1))
+    var_y = torch.rand((4, 3, 1, 1))
+    assert float(loop_normalised_xcor(var_x, var_y)) == 1.
+    assert float(normalised_xcor(var_x, var_y)) == 1.
+    assert float(normalised_xcor_loss(var_x, var_y)) == 0.
+
+
+def test_normalised_xcor_gradients():
+    torch.manual_seed(0)
+    var_x = torch.rand((4, 2, 16, 16), dtype=torch.float64)
+    var_y = torch.rand((4, 2, 16, 16), dtype=torch.float64)
+    var_x.requires_grad_(True)
+    normalised_xcor_loss(var_x, var_y).backward()
+    grad = var_x.grad.clone()
+    var_x.grad = None
+    (1. - loop_normalised_xcor(var_x, var_y)).backward()
+    assert torch.allclose(grad, var_x.grad)
+
+
+def test_gradient():
+    torch.manual_seed(0)
+    for shape in shapes:
+        tensor = torch.rand(shape, dtype=torch.float64)
+        assert torch.equal(gradient(tensor), loop_gradient(tensor))
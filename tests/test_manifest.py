@@ -0,0 +1,45 @@
+import os
+import cv2
+import numpy as np
+from utils import build_manifest
+
+
+def write_image(path, shape=(20, 30, 3)):
+    cv2.imwrite(str(path), np.zeros(shape, dtype=np.uint8))
+
+
+def make_folder(path):
+    for case in ['1', '2']:
+        write_image(path / 'top{:}.jpg'.format(case))
+        write_image(path / 'Z{:}.jpg'.format(case))
+        write_image(path / 'Z{:}nDEM.jpg'.format(case), (20, 30, 1))
+
+
+def test_outputs_keep_the_cache(tmp_path):
+    make_folder(tmp_path)
+    cases = build_manifest(str(tmp_path))
+    assert sorted(cases) == ['1', '2']
+    assert cases['1']['dems']['nDEM']['shape'] == [20, 30, 1]
+    cache_file = tmp_path / '.manifest.json'
+    mtime = os.stat(cache_file).st_mtime_ns
+
+    # Files written by the pipeline do not match any case.
+    np.savez(str(tmp_path / 'pred.d10.nDEM_trees1.npz'), a=0)
+    np.savez(str(tmp_path / 'top1.jpg.points.npz'), a=0)
+    write_image(tmp_path / 'pred.d10.nDEM_trees1.jpg')
+    os.makedirs(str(tmp_path / '.pipeline'))
+    assert build_manifest(str(tmp_path)) == cases
+    assert os.stat(cache_file).st_mtime_ns == mtime
+
+
+def test_new_and_modified_files(tmp_path):
+    make_folder(tmp_path)
+    build_manifest(str(tmp_path))
+    write_image(tmp_path / 'Z2DEM.jpg')
+    write_image(tmp_path / 'Z1.jpg', (40, 30, 3))
+    os.utime(str(tmp_path / 'Z1.jpg'), (1, 1))
+    cases = build_manifest(str(tmp_path))
+    assert sorted(cases['2']['dems']) == ['DEM', 'nDEM']
+    assert cases['1']['mosaic']['shape'] == [40, 30, 3]
+    os.remove(str(tmp_path / 'Z2.jpg'))
+    assert sorted(build_manifest(str(tmp_path))) == ['1']
@@ -0,0 +1,19 @@
+import pytest
+from metrics import pairs_from_manifest
+
+
+def test_pairs_from_manifest(tmp_path):
+    manifest = tmp_path / 'pairs.csv'
+    manifest.write_text(
+        '# gt, pred\n\ngt1.png, pred1.png\ngt2.png,pred2.png\n'
+    )
+    assert pairs_from_manifest(str(manifest)) == [
+        ('gt1.png', 'pred1.png'), ('gt2.png', 'pred2.png')
+    ]
+
+
+def test_pairs_from_manifest_single_column(tmp_path):
+    manifest = tmp_path / 'pairs.csv'
+    manifest.write_text('gt1.png, pred1.png\n\ngt2.png\n')
+    with pytest.raises(ValueError, match='Line 3'):
+        pairs_from_manifest(str(manifest))
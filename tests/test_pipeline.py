@@ -0,0 +1,58 @@
+from pipeline import Pipeline
+
+
+calls = []
+
+
+def source_stage(out_dir, value):
+    calls.append('source')
+    return value
+
+
+def double_stage(out_dir, value):
+    calls.append('double')
+    return 2 * value
+
+
+def build(cache_dir, force=()):
+    pipeline = Pipeline(str(cache_dir), force=force, verbose=0)
+    pipeline.add('source.a', source_stage, params={'value': 3})
+    pipeline.add('double.a', double_stage, deps=['source.a'])
+    return pipeline
+
+
+def test_cached_run(tmp_path):
+    del calls[:]
+    assert build(tmp_path).run(['double.a']) == {'double.a': 6}
+    assert build(tmp_path).run(['double.a']) == {'double.a': 6}
+    assert calls == ['source', 'double']
+
+
+def test_forced_stages_run_once(tmp_path):
+    build(tmp_path).run(['double.a'])
+    del calls[:]
+    pipeline = build(tmp_path, force=['source'])
+    assert pipeline.run(['double.a']) == {'double.a': 6}
+    assert pipeline.run(['double.a']) == {'double.a': 6}
+    assert calls == ['source', 'double']
+
+
+def test_forced_dependency_of_later_target(tmp_path):
+    build(tmp_path).run(['double.a'])
+    del calls[:]
+    pipeline = build(tmp_path, force=['source'])
+    pipeline.run(['source.a'])
+    # The cached result of double.a was computed before the forced run.
+    pipeline.run(['double.a'])
+    pipeline.run(['double.a'])
+    assert calls == ['source', 'double']
+
+
+def test_forced_shared_key_runs_once(tmp_path):
+    build(tmp_path).run(['double.a'])
+    del calls[:]
+    pipeline = build(tmp_path, force=['source'])
+    pipeline.add('source.b', source_stage, params={'value': 3})
+    pipeline.run(['source.a'])
+    pipeline.run(['source.b'])
+    assert calls == ['source']
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+from utils import list_from_mask, list_from_mask_tiled
+
+
+def random_mask(shape, seed, density=0.002, radius=3):
+    rng = np.random.RandomState(seed)
+    mask = np.zeros(shape, dtype=np.uint8)
+    centers = np.argwhere(rng.rand(*shape) < density)
+    for y, x in centers:
+        mask[
+            max(y - radius, 0):y + radius, max(x - radius, 0):x + radius
+        ] = 1
+    return mask
+
+
+def sorted_points(points):
+    points = np.reshape(np.array(points), (-1, 2))
+    return points[np.lexsort(points.T[::-1])]
+
+
+@pytest.mark.parametrize('shape', [(543, 303), (303, 543), (700, 700)])
+@pytest.mark.parametrize('tile_rows', [64, 100, 2048])
+def test_tiled_equivalence(shape, tile_rows):
+    for seed in range(3):
+        mask = random_mask(shape, seed)
+        points = sorted_points(list_from_mask(mask))
+        tiled = sorted_points(list_from_mask_tiled(mask, tile_rows=tile_rows))
+        assert len(points) > 0
+        assert points.shape == tiled.shape
+        assert np.allclose(points, tiled)
+
+
+def test_background_on_border():
+    # The background centroid of a 543x303 mask falls on the margin (points
+    # are compared against the shape as they are), so it must not be
+    # confused with a real tree.
+    mask = np.zeros((543, 303), dtype=np.uint8)
+    mask[140:146, 150:156] = 1
+    mask[150:156, 200:206] = 1
+    expected = sorted_points([[152.5, 142.5], [202.5, 152.5]])
+    assert np.allclose(sorted_points(list_from_mask(mask)), expected)
+    assert np.allclose(sorted_points(list_from_mask_tiled(mask)), expected)
@@ -1,17 +1,25 @@
 import argparse
 import os
-import re
+import shutil
 import cv2
 import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
 import numpy as np
-from skimage.transform import resize as imresize
-from torch.utils.data import DataLoader
-from utils import color_codes, find_file
-from datasets import Cropping2DDataset, CroppingDown2DDataset
-from models import Unet2D
-from metrics import hausdorf_distance, avg_euclidean_distance
-from metrics import matched_percentage
-from utils import list_from_mask
+from utils import color_codes, time_to_string, build_manifest
+from utils import imread_reduced
+from preprocessing import strip_stats, normalise_strips, threshold_labels
+from metrics import PointSetMatcher, threshold_curve
+from utils import list_from_mask_tiled
+from utils import peaks_from_probability, points_in_mask
+from utils import save_prediction, load_prediction
+from pyramid import convert_image, TiledPyramid, PyramidView
+from profiling import StageTimer
+from pipeline import Pipeline
+from autotune import load_tuning, tuning_key
+# torch (and the datasets and models that depend on it) and skimage are
+# imported only when training or exporting the previews, so the command
+# line (and the evaluation) starts quickly.
 
 
 def parse_inputs():
@@ -54,30 +62,98 @@ def parse_inputs():
         dest='lab_tag', default='top',
         help='Tag to be found on all the ground truth filenames'
     )
+    parser.add_argument(
+        '--pyramids',
+        dest='pyramids', default=None,
+        help='Folder for the tiled pyramids of the mosaics, DEMs and labels. '
+             'If given, the data is read by windows from the pyramids '
+             '(which are created if necessary)'
+    )
+    parser.add_argument(
+        '--profile',
+        dest='profile', action='store_true', default=False,
+        help='Whether to time each phase of the training batches '
+             '(written to a JSONL file next to the model)'
+    )
+    parser.add_argument(
+        '--trace',
+        dest='trace', action='store_true', default=False,
+        help='Whether to also export a Chrome trace of some training steps '
+             '(only with --profile)'
+    )
+    parser.add_argument(
+        '--report',
+        dest='report', default=None,
+        help='JSON file for the run report (time and memory per case and '
+             'stage). By default, it is written to the mosaics directory'
+    )
+    parser.add_argument(
+        '--cache',
+        dest='cache', default=None,
+        help='Folder for the results of the pipeline stages. By default, '
+             'it is the .pipeline folder inside the mosaics directory'
+    )
+    parser.add_argument(
+        '--rerun',
+        dest='rerun', nargs='+', default=[],
+        choices=[
+            'inputs', 'labels', 'patches', 'bank', 'training', 'testing',
+            'saving', 'evaluation'
+        ],
+        help='Stages to run again even if their results are cached (the '
+             'stages that depend on them are also run)'
+    )
+    parser.add_argument(
+        '--tuning',
+        dest='tuning', default=None,
+        help='JSON file with the autotuned batch size, DataLoader workers, '
+             'threads and test tile size (see autotune.py)'
+    )
+    parser.add_argument(
+        '--patch-bank',
+        dest='patch_bank', action='store_true', default=False,
+        help='Whether to extract the training patches once into a patch '
+             'bank (float16 memory maps on the cache) and to train all the '
+             'folds with sequential reads from it'
+    )
+    parser.add_argument(
+        '--previews',
+        dest='previews', action='store_true', default=False,
+        help='Whether to export JPEG previews of the predictions'
+    )
 
     options = vars(parser.parse_args())
 
     return options
 
 
-def find_number(string):
-    return int(''.join(filter(str.isdigit, string)))
-
-
-def hsv_mosaics(mosaics, dems, cases):
-    # Data loading (or preparation)
-    options = parse_inputs()
-    d_path = options['val_dir']
-
-    hsv_mosaics = [
-        cv2.cvtColor(mosaic, cv2.COLOR_BGR2HSV) for mosaic in mosaics
-    ]
-    hsv_mosaics = [
-        np.stack([mosaic[..., 0], mosaic[..., 1], dem[..., 0]], -1)
-        for mosaic, dem in zip(hsv_mosaics, dems)
-    ]
-    for mi, c_i in zip(hsv_mosaics, cases):
-        cv2.imwrite(os.path.join(d_path, 'hsv_mosaic{:}.jpg'.format(c_i)), mi)
+def export_previews(d_path, case, dem_name, ratio, pred, unc, shape):
+    """
+    Function to export the predictions and uncertainty maps as JPEG
+    previews (both on the low and the original resolution).
+    :param d_path: Folder for the previews.
+    :param case: Case identifier.
+    :param dem_name: Name of the DEM used for the predictions.
+    :param ratio: Downsampling ratio of the predictions.
+    :param pred: Low resolution prediction map.
+    :param unc: Low resolution uncertainty map.
+    :param shape: Shape of the original mosaic.
+    :return: None.
+    """
+    from skimage.transform import resize as imresize
+    for name, im in [('pred', pred), ('unc', unc)]:
+        cv2.imwrite(
+            os.path.join(d_path, '{:}.ds{:}.{:}_trees{:}.jpg'.format(
+                name, ratio, dem_name, case
+            )),
+            (im * 255).astype(np.uint8)
+        )
+        cv2.imwrite(
+            os.path.join(d_path, '{:}.d{:}.{:}_trees{:}.jpg'.format(
+                name, ratio, dem_name, case
+            )),
+            (imresize(im, shape) * 255).astype(np.uint8)
+        )
 
 
 """
@@ -85,83 +161,190 @@ Networks
 """
 
 
-def train(cases, gt_names, net_name, dem_name, ratio=10, verbose=1):
+def train(
+        cases, gt_names, net_name, dem_name, ratio=10, verbose=1,
+        previews=False, manifest=None, pyramids=None, timer=None,
+        pipeline=None
+):
+    """
+    Function to run the leave-one-mosaic-out cross-validation with a given
+    DEM. Loading, training each fold, testing and saving the predictions
+    are stages of a pipeline, so only the stages whose inputs or parameters
+    changed are run (and interrupted runs resume after the last finished
+    stage).
+    :param cases: Case identifiers.
+    :param gt_names: Names of the ground truth files.
+    :param net_name: Name of the network (prefix of the model files).
+    :param dem_name: Name of the DEM.
+    :param ratio: Downsampling ratio.
+    :param verbose: Verbosity level.
+    :param previews: Whether to export JPEG previews of the predictions.
+    :param manifest: Manifest of the mosaics folder.
+    :param pyramids: Folder for the tiled pyramids (or None to decode the
+     images).
+    :param timer: StageTimer for the run.
+    :param pipeline: Pipeline for the stages. If None, the default cache of
+     the mosaics folder is used.
+    :return: Dictionary with the name of the saving stage of each case.
+    """
     # Init
     options = parse_inputs()
     d_path = options['val_dir']
     c = color_codes()
-    n_folds = len(gt_names)
-    cases = [
-        c_i for c_i in cases
-        if find_file('Z{:}.jpg'.format(c_i + dem_name), d_path)
+    if pipeline is None:
+        pipeline = open_pipeline(options, timer, verbose)
+    if manifest is None:
+        manifest = build_manifest(d_path, options['lab_tag'])
+    gt_names = [
+        gt for c_i, gt in zip(cases, gt_names)
+        if dem_name in manifest[c_i]['dems']
     ]
+    cases = [c_i for c_i in cases if dem_name in manifest[c_i]['dems']]
+    n_folds = len(gt_names)
 
     print(
             '{:}[{:}]{:} Loading all mosaics and DEMs{:}'.format(
                 c['c'], time.strftime("%H:%M:%S"), c['g'], c['nc']
             )
     )
+    # The shapes come from the manifest (image headers), there is no need
+    # to decode the images.
     for c_i in cases:
-        dem_file = os.path.join(d_path, 'Z{:}.jpg'.format(c_i + dem_name))
-        dem = cv2.imread(dem_file)
-        mosaic_file = os.path.join(d_path, 'Z{:}.jpg'.format(c_i))
-        mosaic = cv2.imread(mosaic_file)
-        print(dem_file, dem.shape, mosaic_file, mosaic.shape)
-
-    print(
-        '{:}[{:}]{:} Ground truth'.format(
-                c['c'], time.strftime("%H:%M:%S"), c['nc']
-            )
-    )
-    y = [
-        (
-                np.mean(
-                    cv2.imread(os.path.join(d_path, im)),
-                    axis=-1
-                ) < 50
-        ).astype(np.uint8)
-        for im in gt_names
-    ]
+        dem = manifest[c_i]['dems'][dem_name]
+        mosaic = manifest[c_i]['mosaic']
+        print(
+            os.path.join(d_path, dem['name']), tuple(dem['shape']),
+            os.path.join(d_path, mosaic['name']), tuple(mosaic['shape'])
+        )
 
-    print(
-        '{:}[{:}]{:} DEM'.format(
-                c['c'], time.strftime("%H:%M:%S"), c['nc']
-            )
-    )
-    dems = [
-        cv2.imread(os.path.join(d_path, 'Z{:}.jpg'.format(c_i + dem_name)))
-        for c_i in cases
-    ]
-    print(
-        '{:}[{:}]{:} Mosaics'.format(
-                c['c'], time.strftime("%H:%M:%S"), c['nc']
-            )
+    x_stages, y_stages = add_data_stages(
+        pipeline, d_path, manifest, cases, gt_names, dem_name, ratio,
+        pyramids
     )
-    mosaics = [
-        cv2.imread(os.path.join(d_path, 'Z{:}.jpg'.format(c_i)))
-        for c_i in cases
-    ]
 
-    print(
-        '{:}[{:}]{:} Normalising data'.format(
-                c['c'], time.strftime("%H:%M:%S"), c['nc']
+    # Network and patches. The inputs are the mosaic channels and the DEM.
+    conv_filters = [32, 64, 128, 256]
+    n_inputs = manifest[cases[0]]['mosaic']['shape'][-1] + 1
+    # patch_size = [256, 256]
+    patch_size = [64, 64]
+    # overlap = [64, 64]
+    overlap = [32, 32]
+
+    # Fold stages. The batch size, DataLoader workers, threads and test
+    # tile size come from the autotuner (if there is a tuning for this
+    # machine, network and patch size).
+    epochs = options['epochs']
+    patience = options['patience']
+    train_tuning = {'batch_size': 32, 'num_workers': 1, 'threads': None}
+    test_tuning = {'tile': None, 'threads': None}
+    if options['tuning'] is not None:
+        tuning = load_tuning(
+            options['tuning'],
+            tuning_key(conv_filters, n_inputs, patch_size[0])
+        )
+        if tuning is None:
+            print(
+                '{:}No tuning for this machine in {:}{:}'.format(
+                    c['y'], options['tuning'], c['nc']
+                )
             )
+        else:
+            train_tuning.update(tuning['train'] or {})
+            test_tuning.update(tuning['test'] or {})
+    # The patch index of all the cases is shared by all the folds (a fold
+    # is just a split of the index).
+    patches = pipeline.add(
+        'patches.{:}.d{:}'.format(dem_name, ratio), patches_stage,
+        deps=y_stages, params={
+            'patch_size': patch_size,
+            'overlap': overlap,
+        }, info={'dem': dem_name}
     )
-    x = [
-        np.moveaxis(
-            np.concatenate([mosaic, np.expand_dims(dem[..., 0], -1)], -1),
-            -1, 0
+    val_split = 0.1
+    if options['patch_bank']:
+        # Training only needs the patch bank, so the images of the cases are
+        # not loaded for each fold.
+        bank = pipeline.add(
+            'bank.{:}.d{:}'.format(dem_name, ratio), bank_stage,
+            deps=[patches] + x_stages + y_stages, params={
+                'filtered': val_split > 0,
+                'dtype': 'float16',
+            }, info={'dem': dem_name}
         )
-        for mosaic, dem in zip(mosaics, dems)
-    ]
+    # Full resolution previews are exported on a background thread, so the
+    # JPEG encoding does not block the next folds.
+    export_pool = ThreadPoolExecutor(max_workers=1)
+    exports = []
 
-    mean_x = [np.mean(xi.reshape((len(xi), -1)), axis=-1) for xi in x]
-    std_x = [np.std(xi.reshape((len(xi), -1)), axis=-1) for xi in x]
+    def export(*args):
+        exports.append(export_pool.submit(export_previews, *args))
 
-    norm_x = [
-        (xi - meani.reshape((-1, 1, 1))) / stdi.reshape((-1, 1, 1))
-        for xi, meani, stdi in zip(x, mean_x, std_x)
-    ]
+    savings = {}
+    for i, case in enumerate(cases):
+        model_name = '{:}.d{:}.unc.mosaic{:}.mdl'.format(
+            net_name, ratio, case
+        )
+        info = {'case': case, 'dem': dem_name}
+        if options['patch_bank']:
+            func = bank_training_stage
+            deps = [patches, bank]
+        else:
+            func = training_stage
+            deps = [patches] + x_stages[:i] + x_stages[i + 1:] + \
+                y_stages[:i] + y_stages[i + 1:]
+        training = pipeline.add(
+            'training.{:}.{:}'.format(dem_name, case), func, deps=deps,
+            params={
+                'test_case': i,
+                'conv_filters': conv_filters,
+                'model_name': model_name,
+                'epochs': epochs,
+                'patience': patience,
+                'batch_size': train_tuning['batch_size'],
+                'val_split': val_split,
+            }, options={
+                'num_workers': train_tuning['num_workers'],
+                'threads': train_tuning['threads'],
+                'profile': options['profile'],
+                'trace': options['trace'],
+                'verbose': verbose,
+            }, info=info
+        )
+        testing = pipeline.add(
+            'testing.{:}.{:}'.format(dem_name, case), testing_stage,
+            deps=[training, x_stages[i]], params={
+                'conv_filters': conv_filters,
+                'tile': test_tuning['tile'],
+            }, options={
+                'threads': test_tuning['threads'],
+            }, info=info
+        )
+        pred_file = os.path.join(
+            d_path, 'pred.d{:}.{:}_trees{:}.npz'.format(ratio, dem_name, case)
+        )
+        model_copy = os.path.join(d_path, model_name)
+        outputs = [pred_file, model_copy]
+        if previews:
+            outputs += [
+                os.path.join(d_path, '{:}.d{:}.{:}_trees{:}.jpg'.format(
+                    name, ratio, dem_name, case
+                ))
+                for name in ['pred', 'unc']
+            ]
+        savings[case] = pipeline.add(
+            'saving.{:}.{:}'.format(dem_name, case), saving_stage,
+            deps=[training, testing], params={
+                'ratio': ratio,
+                'model_name': model_name,
+                'shape': manifest[case]['mosaic']['shape'][:2],
+                'input_hash': pipeline.key(x_stages[i]),
+                'previews': previews,
+            }, options={
+                'pred_file': pred_file, 'model_copy': model_copy,
+                'd_path': d_path, 'case': case, 'dem_name': dem_name,
+                'export': export,
+            }, outputs=outputs, info=info
+        )
 
     print(
         '%s[%s] %sStarting cross-validation (leave-one-mosaic-out)'
@@ -170,252 +353,705 @@ def train(cases, gt_names, net_name, dem_name, ratio=10, verbose=1):
         )
     )
     training_start = time.time()
-    for i, case in enumerate(cases):
-        if verbose > 0:
-            print(
-                '%s[%s]%s Starting training for mosaic %s %s(%d/%d)%s' %
-                (
-                    c['c'], time.strftime("%H:%M:%S"),
-                    c['g'], case,
-                    c['c'], i + 1, len(cases), c['nc']
-                )
-            )
-        test_x = norm_x[i]
+    pipeline.run(list(savings.values()))
+    # We need to wait for the previews (and raise any possible error).
+    for future in exports:
+        future.result()
+    export_pool.shutdown()
 
-        train_y = y[:i] + y[i + 1:]
-        train_x = norm_x[:i] + norm_x[i + 1:]
+    if verbose > 0:
+        time_str = time.strftime(
+            '%H hours %M minutes %S seconds',
+            time.gmtime(time.time() - training_start)
+        )
+        print(
+            '%sTraining finished%s (total time %s)\n' %
+            (c['r'], c['nc'], time_str)
+        )
 
-        val_split = 0.1
-        batch_size = 32
-        # patch_size = (256, 256)
-        patch_size = (64, 64)
-        # overlap = (64, 64)
-        overlap = (32, 32)
-        num_workers = 1
+    return savings
 
-        model_name = '{:}.d{:}.unc.mosaic{:}.mdl'.format(
-            net_name, ratio, case
+
+def gt_points(gt_file, threshold=10):
+    """
+    Function to get the list of ground truth tree tops of a case. The list
+    (and the shape of the mask) is cached on disk next to the ground truth
+    file together with the threshold used. It is only recomputed if the
+    ground truth is newer than the cache or the threshold changed.
+    :param gt_file: Name of the ground truth file.
+    :param threshold: Intensity threshold for the tree tops.
+    :return: Array of (x, y) points and the shape of the mask.
+    """
+    cache_file = '{:}.points.npz'.format(gt_file)
+    cache = None
+    if os.path.isfile(cache_file) and \
+            os.path.getmtime(cache_file) >= os.path.getmtime(gt_file):
+        cache = np.load(cache_file)
+        if 'threshold' not in cache or cache['threshold'] != threshold:
+            cache = None
+    if cache is not None:
+        points, shape = cache['points'], tuple(cache['shape'])
+    else:
+        test_y = np.mean(cv2.imread(gt_file), axis=-1) < threshold
+        points = np.reshape(
+            np.array(list_from_mask_tiled(test_y.astype(np.uint8))), (-1, 2)
+        )
+        shape = test_y.shape
+        np.savez(
+            cache_file, points=points, shape=shape, threshold=threshold
         )
-        net = Unet2D(n_inputs=len(norm_x[0]))
 
-        try:
-            net.load_model(os.path.join(d_path, model_name))
-        except IOError:
+    return points, shape
+
 
-            # Dataloader creation
-            if verbose > 0:
-                n_params = sum(
-                    p.numel() for p in net.parameters() if p.requires_grad
+def eval_case(d_path, case, gt_file, trees, dem_name, ratio, thresholds):
+    """
+    Function to evaluate the predictions of a case (and DEM). It is
+    independent of the other cases, so it can be run on a process pool.
+    :param d_path: Folder with the mosaics and the predictions.
+    :param case: Case identifier.
+    :param gt_file: Name of the ground truth file.
+    :param trees: Name of the tree mask file (or None).
+    :param dem_name: Name of the DEM used for the predictions.
+    :param ratio: Downsampling ratio of the predictions.
+    :param thresholds: List of thresholds for the threshold sweep (or
+     None).
+    :return: List of lines to print.
+    """
+    lines = []
+    gt_list, shape = gt_points(gt_file)
+    n_gt = len(gt_list)
+
+    # Tree tops are extracted from the low resolution map. That way
+    # we skip upsampling and connected components on the full
+    # resolution mosaic.
+    downyi, _, _ = load_prediction(
+        os.path.join(
+            d_path, 'pred.d{:}.{:}_trees{:}.npz'.format(
+                ratio, dem_name, case
+            )
+        )
+    )
+    unet_list = peaks_from_probability(downyi, shape)
+    n_unet = len(unet_list)
+
+    matcher = PointSetMatcher(gt_list, unet_list)
+    hd = matcher.hausdorf_distance()
+    match = matcher.matched_percentage(150)
+    inv_match = matcher.matched_percentage(150, inverse=True)
+    diff = 100 * (n_gt - n_unet) / max(n_gt, 1)
+    avg_ed = matcher.avg_euclidean_distance()
+
+    # Threshold sweep. All the thresholds are evaluated from the
+    # same component tree of the low resolution map.
+    if thresholds is not None:
+        curve = threshold_curve(downyi, gt_list, thresholds, shape)
+        for point in curve:
+            lines.append(
+                'Z{:} ({:}) threshold = {:4.2f} tops (seg: {:3d}, '
+                'gt: {:3d}, diff: {:5.3f}, F1: {:5.3f})'.format(
+                    case, dem_name, point['threshold'],
+                    point['n_pred'], point['n_gt'], point['diff'],
+                    point['f1']
                 )
-                print(
-                    '%sStarting training with a Unet 2D%s (%d parameters)' %
-                    (c['c'], c['nc'], n_params)
+            )
+
+    if trees is None:
+        lines.append(
+            'Z{:} ({:}) Hausdorf = {:5.3f} / Euclidean = {:5.3f} '
+            'tops (seg: {:3d}, gt: {:3d}, match: {:5.3f}, '
+            'inverse match: {:5.3f}, diff: {:5.3f})'.format(
+                case, dem_name, hd, avg_ed, n_unet, n_gt, match,
+                inv_match, diff
+            )
+        )
+    else:
+        # Both lists of points are filtered with a lookup on the
+        # background mask (no need for new connected components).
+        bck = np.mean(cv2.imread(trees), axis=-1) < 2
+        funet_list = unet_list[points_in_mask(unet_list, bck)]
+        fgt_list = gt_list[points_in_mask(gt_list, bck)]
+        n_funet = len(funet_list)
+        n_fgt = len(fgt_list)
+
+        fmatcher = PointSetMatcher(fgt_list, funet_list)
+        fhd = fmatcher.hausdorf_distance()
+        fmatch = fmatcher.matched_percentage(150)
+        finv_match = fmatcher.matched_percentage(150, inverse=True)
+        fdiff = 100 * (n_fgt - n_funet) / max(n_fgt, 1)
+        favg_ed = fmatcher.avg_euclidean_distance()
+
+        lines.append(
+            'Mosaic {:} Hausdorf = {:5.3f} vs {:5.3f} / '
+            'Euclidean = {:5.3f} vs {:5.3f} '
+            'tops (seg: {:3d} vs {:3d}, gt: {:3d} vs {:3d}, '
+            'match: {:5.3f} vs {:5.3f}, '
+            'inverse match: {:5.3f} vs {:5.3f}, '
+            'diff: {:5.3f} vs {:5.3f})'.format(
+                case, hd, fhd, avg_ed, favg_ed,
+                n_unet, n_funet, n_gt, n_fgt, match, fmatch,
+                inv_match, finv_match, diff, fdiff
+            )
+        )
+        preview = os.path.join(
+            d_path, 'pred.d{:}.{:}_trees{:}.jpg'.format(
+                ratio, dem_name, case
+            )
+        )
+        if os.path.isfile(preview):
+            shutil.copyfile(
+                preview,
+                os.path.join(
+                    d_path, 'pred.fd{:}.{:}_trees{:}.jpg'.format(
+                        ratio, dem_name, case
+                    )
                 )
+            )
 
-            if val_split > 0:
-                n_samples = len(train_x)
+    return lines
 
-                n_t_samples = int(n_samples * (1 - val_split))
 
-                d_train = train_x[:n_t_samples]
-                d_val = train_x[n_t_samples:]
+def eval(
+        cases, gt_names, ratio=10, thresholds=None, processes=None,
+        manifest=None, timer=None, pipeline=None, savings=None
+):
+    """
+    Function to evaluate the predictions of all the cases and DEMs. Each
+    evaluation is a pipeline stage (run on a process pool), so only the
+    evaluations with new predictions or parameters are run.
+    :param cases: Case identifiers.
+    :param gt_names: Names of the ground truth files.
+    :param ratio: Downsampling ratio of the predictions.
+    :param thresholds: List of thresholds for the threshold sweep (or
+     None).
+    :param processes: Number of processes for the evaluation.
+    :param manifest: Manifest of the mosaics folder.
+    :param timer: StageTimer for the run.
+    :param pipeline: Pipeline for the stages. If None, the default cache of
+     the mosaics folder is used.
+    :param savings: Dictionary with the saving stages of each DEM and case
+     (from train). If None, the prediction files of the mosaics folder are
+     evaluated (and their contents are part of the key).
+    :return: None.
+    """
+    # Init
+    if timer is None:
+        timer = StageTimer()
+    options = parse_inputs()
+    d_path = options['val_dir']
+    names = ['nDEM', 'DEM']
+    if pipeline is None:
+        pipeline = open_pipeline(options, timer)
+    if manifest is None:
+        manifest = build_manifest(d_path, options['lab_tag'])
+    gt_files = [os.path.join(d_path, gt) for gt in gt_names]
+    trees = [
+        os.path.join(d_path, manifest[case]['trees']['name'])
+        if manifest[case]['trees'] is not None else None
+        for case in cases
+    ]
 
-                l_train = train_y[:n_t_samples]
-                l_val = train_y[n_t_samples:]
+    targets = []
+    for case, gt_file, trees_i in zip(cases, gt_files, trees):
+        for dem_name in names:
+            files = [gt_file, trees_i]
+            if savings is None:
+                deps = []
+                files.append(os.path.join(
+                    d_path, 'pred.d{:}.{:}_trees{:}.npz'.format(
+                        ratio, dem_name, case
+                    )
+                ))
+            elif case in savings[dem_name]:
+                deps = [savings[dem_name][case]]
+            else:
+                continue
+            targets.append(pipeline.add(
+                'evaluation.{:}.{:}'.format(dem_name, case),
+                evaluation_stage, deps=deps, params={
+                    'case': case, 'dem_name': dem_name, 'ratio': ratio,
+                    'thresholds': thresholds,
+                }, options={
+                    'd_path': d_path, 'gt_file': gt_file, 'trees': trees_i
+                }, files=files, info={'case': case, 'dem': dem_name},
+                parallel=True
+            ))
+
+    with Pool(processes) as pool:
+        # Ground truth points are computed (or loaded from their cache)
+        # once per case before evaluating each DEM.
+        with timer.stage('gt_points'):
+            pool.map(gt_points, gt_files)
+        results = pipeline.run(targets, pool)
+    for target in targets:
+        for line in results[target]:
+            print(line)
 
-                print('Training dataset (with validation)')
-                # train_dataset = Cropping2DDataset(
-                #     d_train, l_train, patch_size=patch_size, overlap=overlap,
-                #     filtered=True
-                # )
-                train_dataset = CroppingDown2DDataset(
-                    d_train, l_train, patch_size=patch_size, overlap=overlap,
-                    filtered=True
-                )
 
-                print('Validation dataset (with validation)')
-                # val_dataset = Cropping2DDataset(
-                #     d_val, l_val, patch_size=patch_size, overlap=overlap,
-                #     filtered=True
-                # )
-                val_dataset = CroppingDown2DDataset(
-                    d_val, l_val, patch_size=patch_size, overlap=overlap,
-                    filtered=True
-                )
-            else:
-                print('Training dataset')
-                train_dataset = Cropping2DDataset(
-                    train_x, train_y, patch_size=patch_size, overlap=overlap,
-                    filtered=True
-                )
+"""
+Pipeline stages
+"""
 
-                print('Validation dataset')
-                val_dataset = Cropping2DDataset(
-                    train_x, train_y, patch_size=patch_size, overlap=overlap
-                )
 
-            train_dataloader = DataLoader(
-                train_dataset, batch_size, True, num_workers=num_workers
+def open_pipeline(options, timer=None, verbose=1):
+    """
+    Function to open the stage cache of a run.
+    :param options: Command line options.
+    :param timer: StageTimer for the run.
+    :param verbose: Verbosity level.
+    :return: The pipeline (without stages).
+    """
+    cache_dir = options['cache']
+    if cache_dir is None:
+        cache_dir = os.path.join(options['val_dir'], '.pipeline')
+    return Pipeline(cache_dir, timer, options['rerun'], verbose)
+
+
+def add_data_stages(
+        pipeline, d_path, manifest, cases, gt_names, dem_name, ratio=10,
+        pyramids=None
+):
+    """
+    Function to add the data stages (inputs and labels) of a list of cases
+    to a pipeline. Labels do not depend on the DEM, so they are shared by
+    the stages of all the DEMs.
+    :param pipeline: Pipeline for the stages.
+    :param d_path: Folder with the mosaics.
+    :param manifest: Manifest of the mosaics folder.
+    :param cases: Case identifiers.
+    :param gt_names: Names of the ground truth files.
+    :param dem_name: Name of the DEM.
+    :param ratio: Downsampling ratio.
+    :param pyramids: Folder for the tiled pyramids (or None to decode the
+     images).
+    :return: The names of the input stages and the label stages.
+    """
+    x_stages = []
+    y_stages = []
+    for c_i, gt in zip(cases, gt_names):
+        gt_file = os.path.join(d_path, gt)
+        mosaic_file = os.path.join(d_path, manifest[c_i]['mosaic']['name'])
+        dem_file = os.path.join(
+            d_path, manifest[c_i]['dems'][dem_name]['name']
+        )
+        x_name = 'inputs.{:}.d{:}.{:}'.format(dem_name, ratio, c_i)
+        y_name = 'labels.d{:}.{:}'.format(ratio, c_i)
+        if pyramids is None:
+            pipeline.add(
+                x_name, inputs_stage, params={
+                    'mosaic_shape': manifest[c_i]['mosaic']['shape'],
+                    'dem_shape': manifest[c_i]['dems'][dem_name]['shape'],
+                    'ratio': ratio,
+                }, options={
+                    'mosaic_file': mosaic_file, 'dem_file': dem_file
+                }, files=[mosaic_file, dem_file],
+                info={'case': c_i, 'dem': dem_name}
             )
-            val_dataloader = DataLoader(
-                val_dataset, batch_size, num_workers=num_workers
+            if y_name not in pipeline.stages:
+                pipeline.add(
+                    y_name, labels_stage, params={'ratio': ratio},
+                    options={'gt_file': gt_file}, files=[gt_file],
+                    info={'case': c_i}
+                )
+        else:
+            # The views read the pyramids, so they are outputs of the
+            # stages.
+            pyr_files = {
+                name: os.path.join(pyramids, '{:}{:}.pyr'.format(name, c_i))
+                for name in ['mosaic', dem_name, 'labels']
+            }
+            pipeline.add(
+                x_name, pyramid_inputs_stage, params={'ratio': ratio},
+                options={
+                    'mosaic_file': mosaic_file,
+                    'mosaic_pyr': pyr_files['mosaic'],
+                    'dem_file': dem_file, 'dem_pyr': pyr_files[dem_name],
+                }, files=[mosaic_file, dem_file], outputs=[
+                    os.path.join(pyr_files[name], 'pyramid.json')
+                    for name in ['mosaic', dem_name]
+                ], info={'case': c_i, 'dem': dem_name}
             )
+            if y_name not in pipeline.stages:
+                pipeline.add(
+                    y_name, pyramid_labels_stage, params={'ratio': ratio},
+                    options={
+                        'gt_file': gt_file, 'pyr_file': pyr_files['labels']
+                    }, files=[gt_file], outputs=[
+                        os.path.join(pyr_files['labels'], 'pyramid.json')
+                    ], info={'case': c_i}
+                )
+        x_stages.append(x_name)
+        y_stages.append(y_name)
 
-            epochs = parse_inputs()['epochs']
-            patience = parse_inputs()['patience']
+    return x_stages, y_stages
 
-            net.fit(
-                train_dataloader,
-                val_dataloader,
-                epochs=epochs,
-                patience=patience,
-            )
 
-            net.save_model(os.path.join(d_path, model_name))
+def labels_stage(out_dir, gt_file, ratio, threshold=50):
+    """
+    Stage to read the ground truth mask of a case. Labels are decoded at
+    full resolution (tree tops are tiny) and then thresholded and
+    downsampled (block maximum) by row strips.
+    :param out_dir: Folder of the stage (unused).
+    :param gt_file: Name of the ground truth file.
+    :param ratio: Downsampling ratio.
+    :param threshold: Intensity threshold for the labels.
+    :return: The binary mask.
+    """
+    return threshold_labels(gt_file, threshold, ratio)
 
-        if verbose > 0:
-            print(
-                '%s[%s]%s Starting testing with mosaic %s %s(%d/%d)%s' %
-                (
-                    c['c'], time.strftime("%H:%M:%S"),
-                    c['g'], case,
-                    c['c'], i + 1, len(cases), c['nc']
-                )
-            )
 
-        downtest_x = imresize(
-            test_x,
-            (test_x.shape[0],) + tuple(
-                [length // ratio for length in test_x.shape[1:]]
-            )
-        )
-        yi, unci = net.test([downtest_x], patch_size=None)
+def inputs_stage(
+        out_dir, mosaic_file, mosaic_shape, dem_file, dem_shape, ratio
+):
+    """
+    Stage to read and normalise the inputs (mosaic + DEM) of a case. Both
+    images are directly decoded at (roughly) the downsampled resolution and
+    the statistics and normalisation are computed by row strips, so the
+    only full size copy is the float32 normalised image.
+    :param out_dir: Folder of the stage (unused).
+    :param mosaic_file: Name of the mosaic file.
+    :param mosaic_shape: Shape of the mosaic (from the manifest).
+    :param dem_file: Name of the DEM file.
+    :param dem_shape: Shape of the DEM (from the manifest).
+    :param ratio: Downsampling ratio.
+    :return: The normalised inputs (channels, rows, columns).
+    """
+    mosaic = imread_reduced(mosaic_file, ratio, mosaic_shape)
+    dem = imread_reduced(dem_file, ratio, dem_shape)
+    xi = np.moveaxis(
+        np.concatenate([mosaic, np.expand_dims(dem[..., 0], -1)], -1), -1, 0
+    )
+    return normalise_strips(xi, *strip_stats(xi))
 
-        upyi = imresize(yi[0], test_x.shape[1:])
 
-        upunci = imresize(unci[0], test_x.shape[1:])
+def pyramid_labels_stage(
+        out_dir, gt_file, pyr_file, ratio, ratios=(1, 2, 4, 8, 16),
+        threshold=50
+):
+    """
+    Stage to convert the ground truth of a case into a tiled pyramid (only
+    when needed) and to open it as a view at the requested ratio.
+    :param out_dir: Folder of the stage (unused).
+    :param gt_file: Name of the ground truth file.
+    :param pyr_file: Folder for the pyramid.
+    :param ratio: Downsampling ratio for the view.
+    :param ratios: Downsampling ratios stored on the pyramid (the requested
+     ratio is always added).
+    :param threshold: Intensity threshold for the labels.
+    :return: The label view.
+    """
+    ratios = tuple(sorted(set(ratios) | {ratio}))
+    convert_image(gt_file, pyr_file, ratios, label_threshold=threshold)
+    return PyramidView(TiledPyramid(pyr_file), ratio, squeeze=True)
 
-        cv2.imwrite(
-            os.path.join(d_path, 'pred.ds{:}.{:}_trees{:}.jpg'.format(
-                ratio, dem_name, case
-            )),
-            (yi[0] * 255).astype(np.uint8)
-        )
-        cv2.imwrite(
-            os.path.join(d_path, 'pred.d{:}.{:}_trees{:}.jpg'.format(
-                ratio, dem_name, case
-            )),
-            (upyi * 255).astype(np.uint8)
-        )
-        cv2.imwrite(
-            os.path.join(d_path, 'unc.ds{:}.{:}_trees{:}.jpg'.format(
-                ratio,  dem_name, case
-            )),
-            (unci[0] * 255).astype(np.uint8)
-        )
-        cv2.imwrite(
-            os.path.join(d_path, 'unc.d{:}.{:}_trees{:}.jpg'.format(
-                ratio,  dem_name, case
-            )),
-            (upunci * 255).astype(np.uint8)
-        )
 
+def pyramid_inputs_stage(
+        out_dir, mosaic_file, mosaic_pyr, dem_file, dem_pyr, ratio,
+        ratios=(1, 2, 4, 8, 16)
+):
+    """
+    Stage to convert the mosaic and DEM of a case into tiled pyramids (only
+    when needed) and to open them as a normalised view at the requested
+    ratio. Windows are read on demand from the pyramids and the
+    normalisation statistics come from the coarsest level.
+    :param out_dir: Folder of the stage (unused).
+    :param mosaic_file: Name of the mosaic file.
+    :param mosaic_pyr: Folder for the mosaic pyramid.
+    :param dem_file: Name of the DEM file.
+    :param dem_pyr: Folder for the DEM pyramid.
+    :param ratio: Downsampling ratio for the view.
+    :param ratios: Downsampling ratios stored on the pyramids (the
+     requested ratio is always added).
+    :return: The input view (mosaic + DEM).
+    """
+    ratios = tuple(sorted(set(ratios) | {ratio}))
+    convert_image(mosaic_file, mosaic_pyr, ratios)
+    convert_image(dem_file, dem_pyr, ratios)
+    pyramids = [TiledPyramid(mosaic_pyr), TiledPyramid(dem_pyr)]
+    mean, std = PyramidView(pyramids, ratio, [(0, 1, 2), (0,)]).stats()
+    return PyramidView(pyramids, ratio, [(0, 1, 2), (0,)], mean, std)
+
+
+def patches_stage(out_dir, *labels, patch_size, overlap):
+    """
+    Stage to build the patch index of all the cases (patch corners and
+    whether they contain trees).
+    :param out_dir: Folder of the stage (unused).
+    :param labels: Labels of all the cases.
+    :param patch_size: Training patch size.
+    :param overlap: Overlap between training patches.
+    :return: The patch index.
+    """
+    from datasets import PatchIndex
+    return PatchIndex(list(labels), tuple(patch_size), tuple(overlap))
+
+
+def bank_stage(out_dir, index, *data, filtered, dtype):
+    """
+    Stage to extract the training patches of all the cases into a patch
+    bank (on the folder of the stage).
+    :param out_dir: Folder for the bank.
+    :param index: Patch index of all the cases.
+    :param data: Inputs of all the cases followed by their labels.
+    :param filtered: Whether to only store the patches with trees.
+    :param dtype: Data type of the stored inputs.
+    :return: The folder of the bank.
+    """
+    from datasets import write_patch_bank
+    bank_path = os.path.join(out_dir, 'bank')
+    indices = np.flatnonzero(index.positive) if filtered else None
+    write_patch_bank(
+        bank_path, data[:len(data) // 2], data[len(data) // 2:], index,
+        indices, np.dtype(dtype)
+    )
+    return bank_path
+
+
+def fit_fold(
+        out_dir, conv_filters, n_inputs, train_dataset, val_dataset,
+        model_name, epochs, patience, batch_size=None, num_workers=1,
+        threads=None, profile=False, trace=False, verbose=1
+):
+    """
+    Function to train the network of a cross-validation fold.
+    :param out_dir: Folder for the model (and the profiling files).
+    :param conv_filters: Filters of the Unet.
+    :param n_inputs: Number of input channels.
+    :param train_dataset: Training dataset.
+    :param val_dataset: Validation dataset.
+    :param model_name: Name of the model file.
+    :param epochs: Number of epochs.
+    :param patience: Patience for early stopping.
+    :param batch_size: Number of samples per batch (None if the datasets
+     return batches).
+    :param num_workers: Number of DataLoader workers.
+    :param threads: Number of torch threads (None to keep the default).
+    :param profile: Whether to time each phase of the training batches.
+    :param trace: Whether to also export a Chrome trace of some steps.
+    :param verbose: Verbosity level.
+    :return: The name of the model file.
+    """
+    from torch.utils.data import DataLoader
+    from models import Unet2D
+    from profiling import StepProfiler
+    import torch
+    if threads is not None:
+        torch.set_num_threads(threads)
+    c = color_codes()
+
+    net = Unet2D(conv_filters, n_inputs=n_inputs)
     if verbose > 0:
-        time_str = time.strftime(
-            '%H hours %M minutes %S seconds',
-            time.gmtime(time.time() - training_start)
+        n_params = sum(
+            p.numel() for p in net.parameters() if p.requires_grad
         )
         print(
-            '%sTraining finished%s (total time %s)\n' %
-            (c['r'], c['nc'], time_str)
+            '%sStarting training with a Unet 2D%s (%d parameters)' %
+            (c['c'], c['nc'], n_params)
         )
 
+    train_dataloader = DataLoader(
+        train_dataset, batch_size, batch_size is not None,
+        num_workers=num_workers
+    )
+    val_dataloader = DataLoader(
+        val_dataset, batch_size, num_workers=num_workers
+    )
 
-def eval(cases, gt_names, ratio=10):
-    # Init
-    options = parse_inputs()
-    d_path = options['val_dir']
-    names = ['nDEM', 'DEM']
+    model_file = os.path.join(out_dir, model_name)
+    if profile:
+        profiler = StepProfiler(
+            model_file + '.profile.jsonl',
+            trace_file=model_file + '.trace.json' if trace else None
+        )
+    else:
+        profiler = None
+
+    net.fit(
+        train_dataloader,
+        val_dataloader,
+        epochs=epochs,
+        patience=patience,
+        profiler=profiler
+    )
+    net.save_model(model_file)
 
-    for i, case in enumerate(cases):
+    return model_file
 
-        test_y = np.mean(
-            cv2.imread(os.path.join(d_path, gt_names[i])), axis=-1
-        ) < 10
 
-        gt_list = list_from_mask(test_y.astype(np.uint8))
-        n_gt = len(gt_list)
+def training_stage(
+        out_dir, index, *data, test_case, conv_filters, model_name, epochs,
+        patience, batch_size, val_split, num_workers=1, threads=None,
+        profile=False, trace=False, verbose=1
+):
+    """
+    Stage to train the network of a cross-validation fold.
+    :param out_dir: Folder for the model (and the profiling files).
+    :param index: Patch index of all the cases.
+    :param data: Inputs of the training cases followed by their labels.
+    :param test_case: Index of the test case of the fold.
+    :param conv_filters: Filters of the Unet.
+    :param model_name: Name of the model file.
+    :param epochs: Number of epochs.
+    :param patience: Patience for early stopping.
+    :param batch_size: Number of samples per batch.
+    :param val_split: Fraction of the training cases used for validation.
+    :param num_workers: Number of DataLoader workers.
+    :param threads: Number of torch threads (None to keep the default).
+    :param profile: Whether to time each phase of the training batches.
+    :param trace: Whether to also export a Chrome trace of some steps.
+    :param verbose: Verbosity level.
+    :return: The name of the model file.
+    """
+    from datasets import IndexedPatchDataset
+    # The test case is not needed (nor loaded), so its place is empty.
+    x = list(data[:len(data) // 2])
+    y = list(data[len(data) // 2:])
+    x.insert(test_case, None)
+    y.insert(test_case, None)
+
+    # Dataloader creation
+    # Data was already loaded at the downsampled resolution, so there is no
+    # need for CroppingDown2DDataset. The patches of each split come from
+    # the shared index.
+    fold = index.fold(test_case, val_split, filtered=True)
+    if val_split > 0:
+        print('Training dataset (with validation)')
+    else:
+        print('Training dataset')
+    train_dataset = IndexedPatchDataset(x, y, index, fold['train'])
+    val_dataset = IndexedPatchDataset(x, y, index, fold['val'])
+
+    return fit_fold(
+        out_dir, conv_filters, len(data[0]), train_dataset, val_dataset,
+        model_name, epochs, patience, batch_size, num_workers, threads,
+        profile, trace, verbose
+    )
 
-        for dem_name in names:
-            upyi = np.mean(
-                cv2.imread(
-                    os.path.join(
-                        d_path, 'pred.d{:}.{:}_trees{:}.jpg'.format(
-                            ratio, dem_name, case
-                        )
-                    )
-                ), axis=-1
-            ) / 255
-            unet_bool = upyi > 0.5
-            unet_list = list_from_mask(unet_bool.astype(np.uint8))
-            n_unet = len(unet_list)
-
-            hd = hausdorf_distance(gt_list, unet_list)
-            match = matched_percentage(gt_list, unet_list, 150)
-            inv_match = matched_percentage(unet_list, gt_list, 150)
-            diff = 100 * (n_gt - n_unet) / n_gt
-            avg_ed = avg_euclidean_distance(gt_list, unet_list)
-
-            trees = find_file('mosaic{:}tree'.format(case), d_path)
-
-            if trees is None:
-                print(
-                    'Z{:} ({:}) Hausdorf = {:5.3f} / Euclidean = {:5.3f} '
-                    'tops (seg: {:3d}, gt: {:3d}, match: {:5.3f}, '
-                    'inverse match: {:5.3f}, diff: {:5.3f})'.format(
-                        case, dem_name, hd, avg_ed, n_unet, n_gt, match,
-                        inv_match, diff
-                    )
-                )
-            else:
-                bck = (np.mean(cv2.imread(trees), axis=-1) < 2).astype(
-                    np.uint8
-                )
-                fupyi = upyi * bck
-
-                funet_bool = fupyi > 0.5
-
-                funet_list = list_from_mask(funet_bool.astype(np.uint8))
-                fgt_list = list_from_mask(test_y.astype(np.uint8) * bck)
-                n_funet = len(funet_list)
-                n_fgt = len(fgt_list)
-
-                fhd = hausdorf_distance(fgt_list, funet_list)
-                fmatch = matched_percentage(fgt_list, funet_list, 150)
-                finv_match = matched_percentage(funet_list, fgt_list, 150)
-                fdiff = 100 * (n_fgt - n_funet) / n_fgt
-                favg_ed = avg_euclidean_distance(fgt_list, funet_list)
-
-                print(
-                    'Mosaic {:} Hausdorf = {:5.3f} vs {:5.3f} / '
-                    'Euclidean = {:5.3f} vs {:5.3f} '
-                    'tops (seg: {:3d} vs {:3d}, gt: {:3d} vs {:3d}, '
-                    'match: {:5.3f} vs {:5.3f}, '
-                    'inverse match: {:5.3f} vs {:5.3f}, '
-                    'diff: {:5.3f} vs {:5.3f})'.format(
-                        case, hd, fhd, avg_ed, favg_ed,
-                        n_unet, n_funet, n_gt, n_fgt, match, fmatch,
-                        inv_match, finv_match, diff, fdiff
-                    )
-                )
-                cv2.imwrite(
-                    os.path.join(
-                        d_path, 'pred.fd{:}.{:}_trees{:}.jpg'.format(
-                            ratio, dem_name, case
-                        )
-                    ),
-                    (upyi * 255).astype(np.uint8)
-                )
+
+def bank_training_stage(
+        out_dir, index, bank_path, test_case, conv_filters, model_name,
+        epochs, patience, batch_size, val_split, num_workers=1, threads=None,
+        profile=False, trace=False, verbose=1
+):
+    """
+    Stage to train the network of a cross-validation fold with the patches
+    of a patch bank. Batches are read by contiguous blocks through a
+    shuffle buffer (see PatchBankDataset).
+    :param out_dir: Folder for the model (and the profiling files).
+    :param index: Patch index of all the cases.
+    :param bank_path: Folder of the patch bank.
+    :param test_case: Index of the test case of the fold.
+    :param conv_filters: Filters of the Unet.
+    :param model_name: Name of the model file.
+    :param epochs: Number of epochs.
+    :param patience: Patience for early stopping.
+    :param batch_size: Number of samples per batch.
+    :param val_split: Fraction of the training cases used for validation.
+    :param num_workers: Number of DataLoader workers.
+    :param threads: Number of torch threads (None to keep the default).
+    :param profile: Whether to time each phase of the training batches.
+    :param trace: Whether to also export a Chrome trace of some steps.
+    :param verbose: Verbosity level.
+    :return: The name of the model file.
+    """
+    from datasets import PatchBank, PatchBankDataset
+    bank = PatchBank(bank_path)
+    fold = index.fold(test_case, val_split, filtered=True)
+    if val_split > 0:
+        print('Training dataset (with validation, patch bank)')
+    else:
+        print('Training dataset (patch bank)')
+    train_dataset = PatchBankDataset(
+        bank, bank.rows(fold['train']), batch_size
+    )
+    val_dataset = PatchBankDataset(
+        bank, bank.rows(fold['val']), batch_size, shuffle=False
+    )
+
+    return fit_fold(
+        out_dir, conv_filters, bank.header['channels'], train_dataset,
+        val_dataset, model_name, epochs, patience, None, num_workers,
+        threads, profile, trace, verbose
+    )
+
+
+def testing_stage(
+        out_dir, model_file, x, conv_filters, tile=None, threads=None
+):
+    """
+    Stage to test the network of a fold on its test case.
+    :param out_dir: Folder of the stage (unused).
+    :param model_file: Name of the model file.
+    :param x: Inputs of the test case.
+    :param conv_filters: Filters of the Unet.
+    :param tile: Tile size for the test (None for the whole image).
+    :param threads: Number of torch threads (None to keep the default).
+    :return: The low resolution prediction and uncertainty maps.
+    """
+    from models import Unet2D
+    import torch
+    if threads is not None:
+        torch.set_num_threads(threads)
+    net = Unet2D(conv_filters, n_inputs=len(x))
+    net.load_model(model_file)
+    yi, unci = net.test([x], patch_size=tile)
+    return yi[0], unci[0]
+
+
+def saving_stage(
+        out_dir, model_file, prediction, pred_file, model_copy, ratio,
+        model_name, shape, input_hash, previews=False, d_path=None,
+        case=None, dem_name=None, export=None
+):
+    """
+    Stage to export the results of a fold to the mosaics folder. The raw
+    (low resolution) maps are the actual results. Full resolution JPEGs
+    are only previews.
+    :param out_dir: Folder of the stage (unused).
+    :param model_file: Name of the model file.
+    :param prediction: Prediction and uncertainty maps.
+    :param pred_file: Name of the prediction file.
+    :param model_copy: Name for the copy of the model.
+    :param ratio: Downsampling ratio of the predictions.
+    :param model_name: Name of the model (for the metadata).
+    :param shape: Shape of the original mosaic.
+    :param input_hash: Hash of the test inputs (for the metadata).
+    :param previews: Whether to export JPEG previews.
+    :param d_path: Folder for the previews.
+    :param case: Case identifier.
+    :param dem_name: Name of the DEM used for the predictions.
+    :param export: Function to export the previews asynchronously (with
+     the arguments of export_previews). If None, they are exported by the
+     stage.
+    :return: The name of the prediction file.
+    """
+    pred, unc = prediction
+    save_prediction(
+        pred_file, pred, unc, ratio=ratio, model=model_name,
+        shape=shape, input_hash=input_hash
+    )
+    shutil.copyfile(model_file, model_copy)
+    if previews:
+        if export is None:
+            export_previews(d_path, case, dem_name, ratio, pred, unc, shape)
+        else:
+            export(d_path, case, dem_name, ratio, pred, unc, shape)
+    return pred_file
+
+
+def evaluation_stage(
+        out_dir, *exported, d_path, case, gt_file, trees, dem_name, ratio,
+        thresholds
+):
+    """
+    Stage to evaluate the predictions of a case (see eval_case).
+    :param out_dir: Folder of the stage (unused).
+    :param exported: Results of the saving stage (if any).
+    :return: List of lines to print.
+    """
+    return eval_case(
+        d_path, case, gt_file, trees, dem_name, ratio, thresholds
+    )
 
 
 def train_test_net(net_name, dem_name='nDEM', ratio=10, verbose=1):
@@ -429,47 +1065,28 @@ def train_test_net(net_name, dem_name='nDEM', ratio=10, verbose=1):
 
     # Data loading (or preparation)
     d_path = options['val_dir']
-    gt_names = sorted(
-        filter(
-            lambda xi: not os.path.isdir(xi)
-                       and re.search(options['lab_tag'], xi),
-            os.listdir(d_path)
-        ),
-        key=find_number
-    )
-    cases_pre = [str(find_number(r)) for r in gt_names]
-    gt_names = [
-        gt for c, gt in zip(cases_pre, gt_names)
-        if find_file('Z{:}.jpg'.format(c), d_path)
-    ]
-    cases = [c for c in cases_pre if find_file('Z{:}.jpg'.format(c), d_path)]
+    manifest = build_manifest(d_path, options['lab_tag'])
+    cases = list(manifest)
+    gt_names = [manifest[c]['gt']['name'] for c in cases]
 
-    train(cases, gt_names, net_name, dem_name, ratio, verbose)
+    train(
+        cases, gt_names, net_name, dem_name, ratio, verbose,
+        manifest=manifest
+    )
 
 
 def main():
     # Init
     options = parse_inputs()
     c = color_codes()
+    timer = StageTimer()
 
     # Data loading (or preparation)
     d_path = options['val_dir']
-    gt_names = sorted(
-        filter(
-            lambda xi: not os.path.isdir(xi)
-                       and re.search(options['lab_tag'], xi),
-            os.listdir(d_path)
-        ),
-        key=find_number
-    )
-    cases_pre = [str(find_number(r)) for r in gt_names]
-    gt_names = [
-        gt for c, gt in zip(cases_pre, gt_names)
-        if find_file('Z{:}.jpg'.format(c), d_path)
-    ]
-    cases = [
-        c for c in cases_pre if find_file('Z{:}.jpg'.format(c), d_path)
-    ]
+    with timer.stage('manifest'):
+        manifest = build_manifest(d_path, options['lab_tag'])
+    cases = list(manifest)
+    gt_names = [manifest[c]['gt']['name'] for c in cases]
 
     print(
         '%s[%s] %s<Tree detection pipeline>%s' % (
@@ -478,12 +1095,45 @@ def main():
     )
 
     ''' <Detection task> '''
+    pipeline = open_pipeline(options, timer)
+    savings = {}
     net_name = 'tree-detection.nDEM.unet'
-    train(cases, gt_names, net_name, 'nDEM')
+    savings['nDEM'] = train(
+        cases, gt_names, net_name, 'nDEM', previews=options['previews'],
+        manifest=manifest, pyramids=options['pyramids'], timer=timer,
+        pipeline=pipeline
+    )
     net_name = 'tree-detection.DEM.unet'
-    train(cases, gt_names, net_name, 'DEM')
+    savings['DEM'] = train(
+        cases, gt_names, net_name, 'DEM', previews=options['previews'],
+        manifest=manifest, pyramids=options['pyramids'], timer=timer,
+        pipeline=pipeline
+    )
 
-    eval(cases, gt_names)
+    eval(
+        cases, gt_names, manifest=manifest, timer=timer, pipeline=pipeline,
+        savings=savings
+    )
+
+    timer.close()
+    report_file = options['report']
+    if report_file is None:
+        report_file = os.path.join(
+            d_path, 'tree_detection.{:}.report.json'.format(
+                time.strftime('%Y%m%d-%H%M%S', time.localtime(timer.t_start))
+            )
+        )
+    report = timer.write(report_file, options=options)
+    print('{:}Run report{:} ({:})'.format(c['b'], c['nc'], report_file))
+    for stage, s in report['stages'].items():
+        print(
+            '{:<12s} {:3d} calls / wall {:} / cpu {:} / peak {:6.1f} MB'
+            .format(
+                stage, s['calls'], time_to_string(s['wall_s']),
+                time_to_string(s['cpu_s'] + s['children_cpu_s']),
+                s['peak_rss'] / 2 ** 20
+            )
+        )
 
 
 if __name__ == '__main__':
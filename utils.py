@@ -1,26 +1,47 @@
 import cv2
+import hashlib
+import json
 import os
 import re
-import torch
-from functools import reduce
+import struct
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from scipy import ndimage as nd
+
+# torch, scipy and skimage are imported by the functions that need them.
+# Importing them takes seconds and most entry points (metrics, --help) do
+# not need them.
+
+
+def default_device():
+    """
+    Function to get the default device (the first cuda device if
+    available).
+    :return: The torch device.
+    """
+    import torch
+    return torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
 
 def to_torch_var(
         np_array,
-        device=torch.device("cuda:0" if torch.cuda.is_available() else "cpu"),
+        device=None,
         requires_grad=False,
-        dtype=torch.float32
+        dtype=None
 ):
     """
     Function to convert a numpy array into a torch tensor for a given device
     :param np_array: Original numpy array
-    :param device: Device where the tensor will be loaded
+    :param device: Device where the tensor will be loaded (the default
+     device if None)
     :param requires_grad: Whether it requires autograd or not
-    :param dtype: Datatype for the tensor
+    :param dtype: Datatype for the tensor (float32 if None)
     :return:
     """
+    import torch
+    if device is None:
+        device = default_device()
+    if dtype is None:
+        dtype = torch.float32
     var = torch.tensor(
         np_array,
         requires_grad=requires_grad,
@@ -77,6 +98,96 @@ def color_codes():
     return codes
 
 
+def array_hash(array):
+    """
+    Function to compute a hash of the contents of a numpy array.
+    :param array: Numpy array.
+    :return: Hexadecimal string with the SHA1 hash.
+    """
+    data = np.ascontiguousarray(array).view(np.uint8)
+    return hashlib.sha1(data).hexdigest()
+
+
+def save_prediction(filename, pred, unc, **metadata):
+    """
+    Function to store the raw prediction and uncertainty maps of a case.
+    Both maps are stored as float16 arrays on a compressed npz file, together
+    with their metadata (as a JSON string).
+    :param filename: Name of the npz file.
+    :param pred: Prediction map.
+    :param unc: Uncertainty map.
+    :param metadata: Any JSON serialisable information related to the
+     prediction (ratio, model name, input hash, ...).
+    :return: None.
+    """
+    np.savez_compressed(
+        filename,
+        pred=np.asarray(pred, dtype=np.float16),
+        unc=np.asarray(unc, dtype=np.float16),
+        metadata=json.dumps(metadata)
+    )
+
+
+def load_prediction(filename):
+    """
+    Function to load the raw prediction and uncertainty maps of a case.
+    :param filename: Name of the npz file.
+    :return: The prediction and uncertainty maps (as float32) and the
+     metadata dictionary.
+    """
+    with np.load(filename) as data:
+        pred = data['pred'].astype(np.float32)
+        unc = data['unc'].astype(np.float32)
+        metadata = json.loads(str(data['metadata']))
+    return pred, unc, metadata
+
+
+def imread_reduced(filename, ratio, shape=None):
+    """
+    Function to read an image downsampled by an integer ratio. JPEG files
+    can be decoded directly at 1/2, 1/4 or 1/8 of their size (DCT domain
+    scaling), so we decode at the largest of these factors not greater than
+    the ratio and then reduce the image to its final size with an area
+    interpolation (a block average). That way we never need the full
+    resolution image in memory.
+    :param filename: Name of the image file.
+    :param ratio: Downsampling ratio.
+    :param shape: Shape of the original image. If None, it is read from the
+     header of the image.
+    :return: The downsampled image (rows // ratio, columns // ratio,
+     channels).
+    """
+    reduced_flags = {
+        1: cv2.IMREAD_COLOR,
+        2: cv2.IMREAD_REDUCED_COLOR_2,
+        4: cv2.IMREAD_REDUCED_COLOR_4,
+        8: cv2.IMREAD_REDUCED_COLOR_8,
+    }
+    if shape is None:
+        shape = image_shape(filename)
+    factor = max(f for f in reduced_flags if f <= ratio)
+    im = cv2.imread(filename, reduced_flags[factor])
+    final_shape = (shape[1] // ratio, shape[0] // ratio)
+    if im.shape[1::-1] != final_shape:
+        im = cv2.resize(im, final_shape, interpolation=cv2.INTER_AREA)
+    return im
+
+
+def downsample_mask(mask, ratio):
+    """
+    Function to downsample a binary mask by an integer ratio with a block
+    maximum (a pixel is positive if any pixel of its block is positive).
+    :param mask: Binary mask.
+    :param ratio: Downsampling ratio.
+    :return: The downsampled mask (uint8).
+    """
+    rows, cols = mask.shape[0] // ratio, mask.shape[1] // ratio
+    blocks = mask[:rows * ratio, :cols * ratio].reshape(
+        (rows, ratio, cols, ratio)
+    )
+    return blocks.any(axis=(1, 3)).astype(np.uint8)
+
+
 def find_file(name, dirname):
     """
 
@@ -92,6 +203,167 @@ def find_file(name, dirname):
     return os.path.join(dirname, result[0]) if result else None
 
 
+def find_number(string):
+    return int(''.join(filter(str.isdigit, string)))
+
+
+def image_shape(filename):
+    """
+    Function to get the shape of an image without decoding it. The shape
+    is read from the header for JPEG (SOF marker) and PNG (IHDR chunk)
+    files. Any other format is decoded with opencv.
+    :param filename: Name of the image file.
+    :return: Shape of the image (rows, columns, channels).
+    """
+    with open(filename, 'rb') as f:
+        header = f.read(2)
+        if header == b'\xff\xd8':
+            # JPEG markers. SOF markers (0xC0-0xCF, except DHT, JPG and
+            # DAC) contain the shape. Markers without length are skipped.
+            while True:
+                byte = f.read(1)
+                if not byte:
+                    break
+                if byte != b'\xff':
+                    continue
+                marker = f.read(1)
+                while marker == b'\xff':
+                    marker = f.read(1)
+                marker = ord(marker) if marker else 0
+                if marker in (0x01, 0xd8) or 0xd0 <= marker <= 0xd7:
+                    continue
+                if marker == 0xd9 or marker == 0:
+                    break
+                length = struct.unpack('>H', f.read(2))[0]
+                sof = 0xc0 <= marker <= 0xcf
+                if sof and marker not in (0xc4, 0xc8, 0xcc):
+                    _, rows, cols, channels = struct.unpack(
+                        '>BHHB', f.read(6)
+                    )
+                    return rows, cols, channels
+                f.seek(length - 2, os.SEEK_CUR)
+        elif header + f.read(6) == b'\x89PNG\r\n\x1a\n':
+            f.read(8)
+            cols, rows, _, color = struct.unpack('>IIBB', f.read(10))
+            channels = {0: 1, 2: 3, 3: 3, 4: 2, 6: 4}.get(color, 3)
+            return rows, cols, channels
+    im = cv2.imread(filename, cv2.IMREAD_UNCHANGED)
+    shape = im.shape if im.ndim == 3 else im.shape + (1,)
+    return shape
+
+
+def _file_entry(entry, cached=None):
+    """
+    Function to describe a file of the manifest.
+    :param entry: os.DirEntry of the file.
+    :param cached: Previous description of the file (if any). It is reused
+     if the size and modification time of the file did not change.
+    :return: Dictionary with the name, size, modification time and shape.
+    """
+    stat = entry.stat()
+    if cached is not None and cached['size'] == stat.st_size and \
+            cached['mtime'] == stat.st_mtime:
+        return cached
+    return {
+        'name': entry.name,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'shape': list(image_shape(entry.path)),
+    }
+
+
+def build_manifest(dirname, lab_tag='top', cache_name='.manifest.json'):
+    """
+    Function to index all the cases of a folder of mosaics with a single
+    scan of the folder. For each case (defined by the ground truth files
+    containing the label tag) we store the ground truth, the mosaic
+    (Z{case}.jpg), all the DEMs (Z{case}{dem}.jpg) and the tree mask
+    (mosaic{case}tree*) with their sizes, modification times and shapes
+    (read from the headers). Cases without a mosaic are ignored.
+    The manifest is cached as a JSON file inside the folder. The cases are
+    always matched from the names of the folder (a cheap listing), but
+    only new or modified files (by size and modification time) are read
+    again, and the cache is only rewritten if any entry changed. Other files
+    of the folder (predictions, models, reports...) are ignored.
+    :param dirname: Folder with the mosaics.
+    :param lab_tag: Tag to be found on all the ground truth filenames.
+    :param cache_name: Name of the cache file inside the folder.
+    :return: Dictionary of cases (sorted by case number) with their
+     files.
+    """
+    cache_file = os.path.join(dirname, cache_name)
+    try:
+        with open(cache_file) as f:
+            cached = json.load(f)
+        cached_files = {
+            f['name']: f
+            for case in cached['cases'].values()
+            for f in [case['gt'], case['mosaic'], case['trees']] + list(
+                case['dems'].values()
+            ) if f is not None
+        }
+    except (OSError, ValueError, KeyError, TypeError):
+        cached = None
+        cached_files = {}
+
+    entries = {
+        e.name: e for e in os.scandir(dirname)
+        if e.is_file() and e.name != cache_name
+    }
+
+    def describe(name):
+        return _file_entry(entries[name], cached_files.get(name))
+
+    # Only images are considered as ground truth (there might be other
+    # files with the tag, like the cached points).
+    image_ext = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp')
+    gt_names = sorted(
+        filter(
+            lambda x: re.search(lab_tag, x) and
+            x.lower().endswith(image_ext),
+            entries
+        ),
+        key=find_number
+    )
+    cases = {}
+    for gt in gt_names:
+        case = str(find_number(gt))
+        mosaic = 'Z{:}.jpg'.format(case)
+        if mosaic not in entries:
+            continue
+        prefix = 'Z{:}'.format(case)
+        dems = {
+            name[len(prefix):-4]: describe(name)
+            for name in sorted(entries)
+            if name.startswith(prefix) and name.endswith('.jpg') and
+            name != mosaic and not name[len(prefix)].isdigit()
+        }
+        trees = sorted(
+            filter(
+                lambda x: re.search('mosaic{:}tree'.format(case), x), entries
+            )
+        )
+        cases[case] = {
+            'gt': describe(gt),
+            'mosaic': describe(mosaic),
+            'dems': dems,
+            'trees': describe(trees[0]) if trees else None,
+        }
+
+    manifest = {
+        'lab_tag': lab_tag,
+        'cases': cases,
+    }
+    if manifest != cached:
+        try:
+            with open(cache_file, 'w') as f:
+                json.dump(manifest, f, indent=1)
+        except OSError:
+            pass
+
+    return cases
+
+
 def get_dirs(path):
     """
     Function to get the folder name of the patients given a path.
@@ -109,25 +381,30 @@ def get_dirs(path):
     return patient_paths
 
 
-def remove_small_regions(img_vol, min_size=3):
+def remove_small_regions(img_vol, min_size=3, connectivity=None):
     """
         Function that removes blobs with a size smaller than a minimum from a mask
-        volume.
+        volume. The areas of all the blobs are computed at once with a
+        bincount over the labels and the new mask is obtained with a lookup
+        table, so the cost is linear with the number of pixels.
         :param img_vol: Mask volume. It should be a numpy array of type bool.
         :param min_size: Minimum size for the blobs.
+        :param connectivity: Connectivity for the blobs (as defined by
+         scipy.ndimage.generate_binary_structure). By default all neighbours
+         are used (8-connectivity for 2D masks, 26-connectivity for 3D).
         :return: New mask without the small blobs.
     """
-    blobs, _ = nd.measurements.label(
+    from scipy import ndimage as nd
+    if connectivity is None:
+        connectivity = img_vol.ndim
+    blobs, _ = nd.label(
         img_vol,
-        nd.morphology.generate_binary_structure(3, 3)
+        nd.generate_binary_structure(img_vol.ndim, connectivity)
     )
-    labels = list(filter(bool, np.unique(blobs)))
-    areas = [np.count_nonzero(np.equal(blobs, lab)) for lab in labels]
-    nu_labels = [lab for lab, a in zip(labels, areas) if a >= min_size]
-    nu_mask = reduce(
-        lambda x, y: np.logical_or(x, y),
-        [np.equal(blobs, lab) for lab in nu_labels]
-    ) if nu_labels else np.zeros_like(img_vol)
+    areas = np.bincount(blobs.ravel())
+    valid = areas >= min_size
+    valid[0] = False
+    nu_mask = valid[blobs]
     return nu_mask
 
 
@@ -145,6 +422,174 @@ def border_point(image, point, margin=100):
     return np.logical_or(point < margin, (top - point) < margin).any()
 
 
+def border_points(shape, points, margin=100):
+    """
+    Vectorised version of border_point. It checks all the points at once
+    using the same convention (points are compared against the image shape
+    as they are).
+    :param shape: Shape of the image.
+    :param points: Array of points with shape (N, 2).
+    :param margin: Margin of error.
+    :return: Boolean array with the points that are on the border.
+    """
+    points = np.reshape(np.asarray(points, dtype=np.float64), (-1, 2))
+    top = np.array(shape[:2])
+    return np.logical_or(points < margin, (top - points) < margin).any(axis=1)
+
+
+def rescale_points(points, shape, new_shape):
+    """
+    Function to convert (x, y) pixel coordinates from an image to another
+    image of the same scene with a different resolution. Coordinates are
+    pixel centres, hence the half pixel shift.
+    :param points: Array of (x, y) points with shape (N, 2).
+    :param shape: Shape of the original image (rows, columns).
+    :param new_shape: Shape of the target image (rows, columns).
+    :return: Array of (x, y) points on the new image.
+    """
+    scale = np.array(
+        [new_shape[1] / shape[1], new_shape[0] / shape[0]]
+    )
+    return (np.reshape(points, (-1, 2)) + 0.5) * scale - 0.5
+
+
+def points_in_mask(points, mask):
+    """
+    Function to check which (x, y) points fall inside a binary mask with a
+    single vectorised lookup.
+    :param points: Array of (x, y) points with shape (N, 2).
+    :param mask: Binary image.
+    :return: Boolean array with the points inside the mask.
+    """
+    points = np.reshape(points, (-1, 2))
+    cols = np.clip(np.round(points[:, 0]).astype(int), 0, mask.shape[1] - 1)
+    rows = np.clip(np.round(points[:, 1]).astype(int), 0, mask.shape[0] - 1)
+    return mask[rows, cols] > 0
+
+
+def peaks_from_probability(
+        prob, shape=None, threshold=0.5, size=3, margin=100
+):
+    """
+    Function to find the tree tops directly on a (low resolution)
+    probability map. Instead of thresholding an upsampled map and computing
+    its connected components, we find the local maxima above a threshold
+    (non-maxima suppression with a maximum filter). Flat maxima (plateaus)
+    are merged into their centroid. Finally, the points are rescaled to the
+    resolution of the original mosaic.
+    :param prob: Probability map (2D array).
+    :param shape: Shape of the original mosaic. If None, the points are
+     returned in the coordinates of the probability map.
+    :param threshold: Minimum probability for a peak.
+    :param size: Size of the window for the non-maxima suppression.
+    :param margin: Margin of the border to discard points (on the final
+     resolution).
+    :return: Array of (x, y) points with shape (N, 2).
+    """
+    from scipy import ndimage as nd
+    peaks = np.logical_and(
+        prob > threshold, prob >= nd.maximum_filter(prob, size=size)
+    )
+    _, _, _, centroids = cv2.connectedComponentsWithStats(
+        peaks.astype(np.uint8)
+    )
+    points = centroids[1:]
+    if shape is None:
+        shape = prob.shape
+    else:
+        points = rescale_points(points, prob.shape, shape)
+
+    return points[np.logical_not(border_points(shape, points, margin))]
+
+
+def centroids_from_thresholds(prob, thresholds):
+    """
+    Function to compute the centroids of the connected components of a
+    probability map for a list of thresholds at once. The map is quantised
+    to the threshold grid and labelled only once into flat zones (connected
+    regions with the same level). The component tree is then defined on the
+    much smaller graph of adjacent flat zones: the components for each
+    threshold are the connected components of the zones above it, and
+    their areas and centroids come from the accumulated zone statistics.
+    We use 8-connectivity, as opencv does.
+    :param prob: Probability map (2D array).
+    :param thresholds: List of thresholds. Components are defined as
+     prob > threshold (like the thresholded masks).
+    :return: List of arrays of (x, y) centroids (one per threshold, in the
+     same order as the thresholds).
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    from skimage.measure import label
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    order = np.argsort(thresholds)
+    # The level of a pixel is the number of thresholds it is greater than.
+    # Level 0 is the background for all thresholds.
+    levels = np.searchsorted(thresholds[order], prob, side='left')
+    zones = label(levels, background=0, connectivity=2)
+    n_zones = zones.max() + 1
+
+    # Flat zone statistics.
+    rows, cols = np.indices(prob.shape)
+    flat_zones = zones.ravel()
+    area = np.bincount(flat_zones, minlength=n_zones).astype(np.float64)
+    sum_x = np.bincount(flat_zones, cols.ravel(), minlength=n_zones)
+    sum_y = np.bincount(flat_zones, rows.ravel(), minlength=n_zones)
+    zone_level = np.zeros(n_zones, dtype=levels.dtype)
+    zone_level[flat_zones] = levels.ravel()
+
+    # Adjacency between flat zones (8-connectivity).
+    height, width = prob.shape
+    shifts = [
+        ((slice(None), slice(0, width - 1)), (slice(None), slice(1, width))),
+        ((slice(0, height - 1), slice(None)), (slice(1, height), slice(None))),
+        (
+            (slice(0, height - 1), slice(0, width - 1)),
+            (slice(1, height), slice(1, width))
+        ),
+        (
+            (slice(0, height - 1), slice(1, width)),
+            (slice(1, height), slice(0, width - 1))
+        ),
+    ]
+    edges = []
+    for s_a, s_b in shifts:
+        z_a, z_b = zones[s_a], zones[s_b]
+        neighbours = np.logical_and(
+            z_a != z_b, np.logical_and(z_a > 0, z_b > 0)
+        )
+        z_a, z_b = z_a[neighbours], z_b[neighbours]
+        # Each pair is encoded as a single integer to remove duplicates.
+        edges.append(
+            np.minimum(z_a, z_b).astype(np.int64) * n_zones +
+            np.maximum(z_a, z_b)
+        )
+    edges = np.unique(np.concatenate(edges))
+    edges = np.stack(np.divmod(edges, n_zones), axis=1)
+    edge_level = np.minimum(zone_level[edges[:, 0]], zone_level[edges[:, 1]])
+
+    centroids = [None] * len(order)
+    for k, t_idx in enumerate(order):
+        valid = zone_level > k
+        k_edges = edges[edge_level > k]
+        graph = coo_matrix(
+            (np.ones(len(k_edges)), (k_edges[:, 0], k_edges[:, 1])),
+            shape=(n_zones, n_zones)
+        )
+        n_comp, comps = connected_components(graph, directed=False)
+        comps = comps[valid]
+        comp_area = np.bincount(comps, area[valid], minlength=n_comp)
+        comp_x = np.bincount(comps, sum_x[valid], minlength=n_comp)
+        comp_y = np.bincount(comps, sum_y[valid], minlength=n_comp)
+        found = comp_area > 0
+        centroids[t_idx] = np.stack(
+            [comp_x[found] / comp_area[found], comp_y[found] / comp_area[found]],
+            axis=1
+        )
+
+    return centroids
+
+
 def list_from_binary(filename):
     """
     Function to take a binary image and output the center of masses of its
@@ -163,19 +608,149 @@ def list_from_image(im):
     return list_from_mask(mask)
 
 
-def list_from_mask(mask):
+def list_from_mask(mask, margin=100, min_size=None):
+    """
+    Function to take a binary mask and output the center of masses of its
+     connected regions that are not on the border of the image.
+    :param mask: Binary mask.
+    :param margin: Margin of the border to discard points.
+    :param min_size: Minimum size for the regions. If not None, smaller
+     regions are removed before computing the centroids.
+    :return: List of (x, y) points.
+    """
+    if min_size is not None:
+        mask = remove_small_regions(mask, min_size, 2).astype(np.uint8)
+
     # Compute connected components
     n_labels, _, _, centroids = cv2.connectedComponentsWithStats(mask)
-    # print(
-    #     "crownSegmenterEvaluator, found {:d} {:d} points"
-    #     " for file {:}".format(n_labels, len(centroids), filename)
-    # )
 
-    # print(" listFromBinary, found  {:d}".format(len(centroids)))
-    # print(centroids)
+    # The background (always the first label) and the border centroids are
+    # discarded. The background is removed by index, since its centroid
+    # might be on the border too.
+    centroids = centroids[1:]
+    border = border_points(mask.shape, centroids, margin)
+
+    return list(centroids[np.logical_not(border)])
+
+
+def _strip_components(mask, start, stop):
+    """
+    Function to compute the connected components of a strip of rows of a
+    mask. Only the first and last row of labels are kept (to merge
+    components across strips), together with the area and the sum of
+    coordinates of each component (to compute the centroids incrementally).
+    :param mask: Binary mask.
+    :param start: First row of the strip.
+    :param stop: Last row of the strip (not included).
+    :return: The number of components (without background), the first and
+     last row of labels, the areas and the sum of the (x, y) coordinates.
+    """
+    strip = mask[start:stop].astype(np.uint8, copy=False)
+    n_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(
+        strip, connectivity=8
+    )
+    areas = stats[1:, cv2.CC_STAT_AREA].astype(np.float64)
+    sums = centroids[1:] * np.expand_dims(areas, -1)
+    sums[:, 1] += start * areas
+    return n_labels - 1, labels[0].copy(), labels[-1].copy(), areas, sums
+
+
+def _border_pairs(bottom, top, bottom_offset, top_offset):
+    """
+    Function to find which components of two consecutive strips touch each
+    other (8-connectivity) given the last row of labels of the first strip
+    and the first row of labels of the second.
+    :param bottom: Last row of labels from the first strip.
+    :param top: First row of labels from the second strip.
+    :param bottom_offset: Global index of the first label of the first strip.
+    :param top_offset: Global index of the first label of the second strip.
+    :return: Array of unique pairs of global component indices.
+    """
+    width = len(bottom)
+    pairs = []
+    for shift in (-1, 0, 1):
+        b = bottom[max(0, -shift):width - max(0, shift)]
+        t = top[max(0, shift):width - max(0, -shift)]
+        touch = np.logical_and(b > 0, t > 0)
+        pairs.append(
+            np.stack([
+                b[touch] - 1 + bottom_offset, t[touch] - 1 + top_offset
+            ], axis=1)
+        )
+    return np.unique(np.concatenate(pairs), axis=0)
+
+
+def list_from_mask_tiled(mask, margin=100, tile_rows=2048, n_jobs=None):
+    """
+    Tiled version of list_from_mask for very large masks. The mask is split
+    into strips of rows that are labelled in parallel (opencv releases the
+    GIL), so only a few strips of labels are in memory at any given time.
+    Components touching across strips are merged with a union-find, and
+    their centroids are computed from the accumulated areas and
+    coordinates. The points are the same as those of list_from_mask,
+    although their order might differ (opencv does not guarantee any
+    particular order for its labels either).
+    :param mask: Binary mask.
+    :param margin: Margin of the border to discard points.
+    :param tile_rows: Number of rows per strip.
+    :param n_jobs: Number of threads (None uses the default of the
+     ThreadPoolExecutor).
+    :return: List of (x, y) points.
+    """
+    height, width = mask.shape[:2]
+    limits = [
+        (start, min(start + tile_rows, height))
+        for start in range(0, height, tile_rows)
+    ]
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        strips = list(pool.map(
+            lambda lim: _strip_components(mask, *lim), limits
+        ))
+
+    n_strip, firsts, lasts, areas, sums = zip(*strips)
+    offsets = np.cumsum((0,) + n_strip)
+    n_comp = offsets[-1]
+    areas = np.concatenate(areas)
+    sums = np.concatenate(sums).reshape((-1, 2))
+
+    # Union-find. The root of each component is its lowest global index,
+    # which keeps the output order deterministic (strips are top to bottom).
+    parent = list(range(n_comp))
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for k in range(len(limits) - 1):
+        pairs = _border_pairs(
+            lasts[k], firsts[k + 1], offsets[k], offsets[k + 1]
+        )
+        for a, b in pairs:
+            root_a, root_b = find(a), find(b)
+            if root_a != root_b:
+                parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    # Path compression for all the components at once.
+    parent = np.array(parent, dtype=np.int64)
+    roots = parent[parent]
+    while (roots != parent).any():
+        parent = roots
+        roots = parent[parent]
+
+    comp_areas = np.bincount(roots, areas, minlength=n_comp)
+    comp_sums = np.stack([
+        np.bincount(roots, sums[:, 0], minlength=n_comp),
+        np.bincount(roots, sums[:, 1], minlength=n_comp),
+    ], axis=1)
+    final = np.flatnonzero(roots == np.arange(n_comp))
+    comp_areas = comp_areas[final]
+    comp_sums = comp_sums[final]
 
-    new_centroids = [c for c in centroids if not border_point(mask, c)]
-    # print(" listFromBinary, refined  {:d}".format(len(new_centroids)))
-    # print(new_centroids)
+    # Unlike opencv, there is no background component, so only the border
+    # centroids are discarded.
+    centroids = comp_sums / np.expand_dims(comp_areas, -1)
+    border = border_points(mask.shape, centroids, margin)
 
-    return new_centroids[1:]
\ No newline at end of file
+    return list(centroids[np.logical_not(border)])